@@ -0,0 +1,187 @@
+import asyncio
+import os
+import statistics
+import time
+from collections import OrderedDict, deque
+
+# Admission control 設定
+# 每個 model 同時最多跑幾個 agent runs，超過的先排隊，隊伍滿了就直接回 429，避免流量高峰時同時對上游開太多 streams 被 rate limit
+AGENT_MAX_CONCURRENT_RUNS = int(os.getenv("AGENT_MAX_CONCURRENT_RUNS", "32"))  # 沒有個別設定的 model 使用這個上限
+AGENT_MODEL_CONCURRENCY = os.getenv("AGENT_MODEL_CONCURRENCY", "")  # 個別 model 的上限，例如 "gpt-5-mini=32,gpt-4.1=8"
+AGENT_ADMISSION_QUEUE_SIZE = int(os.getenv("AGENT_ADMISSION_QUEUE_SIZE", "64"))  # 每個 model 最多幾個 runs 排隊
+AGENT_ADMISSION_MAX_QUEUED_PER_USER = int(os.getenv("AGENT_ADMISSION_MAX_QUEUED_PER_USER", "4"))  # 每個 client (client_key) 最多幾個 runs 排隊
+AGENT_ADMISSION_TIMEOUT = float(os.getenv("AGENT_ADMISSION_TIMEOUT", "30"))  # 秒，排隊超過這個時間就放棄
+AGENT_ADMISSION_RETRY_AFTER = 5  # 秒，被拒絕時建議 client 多久後重試
+
+def parse_model_concurrency(value: str) -> dict:
+    limits = {}
+    for pair in value.split(","):
+        model, _, limit = pair.partition("=")
+        if model.strip() and limit.strip().isdigit():
+            limits[model.strip()] = int(limit)
+    return limits
+
+class AdmissionRejected(Exception):
+    """隊伍已滿或排隊逾時，retry_after 是建議 client 重試前等待的秒數"""
+
+    def __init__(self, reason: str, retry_after: int = AGENT_ADMISSION_RETRY_AFTER):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+class AdmissionTicket:
+    """一個 run 的名額，admitted 之後一定要 release (或用 async with)"""
+
+    def __init__(self, pool: "ModelAdmission", client_key):
+        self.pool = pool
+        self.client_key = client_key
+        self.admitted = False
+        self.released = False
+        self.queued_at = time.monotonic()
+        self.wait_ms = 0
+        self._future: asyncio.Future | None = None
+
+    @property
+    def position(self) -> int:
+        """目前在隊伍中的位置 (1 開始)，已經拿到名額時是 0"""
+        return 0 if self.admitted else self.pool.position(self)
+
+    async def wait(self, timeout: float = AGENT_ADMISSION_TIMEOUT):
+        if self.admitted:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(self._future), timeout)
+        except asyncio.TimeoutError:
+            self.release()
+            self.pool.stats["timed_out"] += 1
+            raise AdmissionRejected("queue_timeout")
+        except asyncio.CancelledError:
+            self.release()
+            raise
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.pool.release(self)
+
+    async def __aenter__(self):
+        await self.wait()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+class ModelAdmission:
+    """
+    單一 model 的名額和等待隊伍
+    等待隊伍依 client_key 分開，有名額時輪流從每個 client 的隊伍取一個，一個 client 送很多 requests 不會讓其他人一直等
+    client_key 必須由 server 決定 (例如 client IP)，不能用 client 自己送來的 user_id；None 表示無法辨識，共用一個隊伍且不套用每個 client 的上限
+    """
+
+    def __init__(self, model: str, limit: int):
+        self.model = model
+        self.limit = limit
+        self.active = 0
+        self.waiters: OrderedDict = OrderedDict()  # client_key -> deque of tickets，順序就是輪流的順序
+        self.recent_wait_ms = deque(maxlen=1000)  # 最近 admitted 的 runs 排隊等了多久
+        self.stats = { "admitted": 0, "queued": 0, "rejected": 0, "timed_out": 0 }
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(tickets) for tickets in self.waiters.values())
+
+    def reserve(self, client_key) -> AdmissionTicket:
+        """有名額就直接 admitted，沒有就排進隊伍；隊伍已滿時丟出 AdmissionRejected"""
+        ticket = AdmissionTicket(self, client_key)
+        if self.active < self.limit and not self.waiters:
+            self._admit(ticket)
+            return ticket
+
+        if self.queue_depth >= AGENT_ADMISSION_QUEUE_SIZE:
+            self.stats["rejected"] += 1
+            raise AdmissionRejected("queue_full")
+        if client_key is not None and len(self.waiters.get(client_key, ())) >= AGENT_ADMISSION_MAX_QUEUED_PER_USER:
+            self.stats["rejected"] += 1
+            raise AdmissionRejected("user_queue_full")
+
+        ticket._future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(client_key, deque()).append(ticket)
+        self.stats["queued"] += 1
+        return ticket
+
+    def position(self, ticket: AdmissionTicket) -> int:
+        # 依輪流的順序估算前面還有幾個 runs
+        queues = list(self.waiters.values())
+        ahead = 0
+        for round_index in range(max((len(q) for q in queues), default=0)):
+            for tickets in queues:
+                if round_index < len(tickets):
+                    ahead += 1
+                    if tickets[round_index] is ticket:
+                        return ahead
+        return ahead
+
+    def release(self, ticket: AdmissionTicket):
+        if ticket.admitted:
+            self.active -= 1
+            self._admit_next()
+            return
+
+        # 還在排隊就被取消 (client 斷線、逾時)
+        tickets = self.waiters.get(ticket.client_key)
+        if tickets and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del self.waiters[ticket.client_key]
+
+    def _admit(self, ticket: AdmissionTicket):
+        ticket.admitted = True
+        ticket.wait_ms = round((time.monotonic() - ticket.queued_at) * 1000)
+        self.active += 1
+        self.stats["admitted"] += 1
+        self.recent_wait_ms.append(ticket.wait_ms)
+        if ticket._future is not None and not ticket._future.done():
+            ticket._future.set_result(None)
+
+    def _admit_next(self):
+        while self.active < self.limit and self.waiters:
+            client_key, tickets = next(iter(self.waiters.items()))
+            ticket = tickets.popleft()
+            if tickets:
+                self.waiters.move_to_end(client_key)  # 這個 client 排到最後，下一個名額給其他 clients
+            else:
+                del self.waiters[client_key]
+            self._admit(ticket)
+
+    def snapshot(self) -> dict:
+        waits = sorted(self.recent_wait_ms)
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "queue_depth": self.queue_depth,
+            "queued_users": len(self.waiters),
+            "wait_ms_p50": statistics.median(waits) if waits else 0,
+            "wait_ms_p95": waits[int(len(waits) * 0.95)] if waits else 0,
+            **self.stats
+        }
+
+class AdmissionController:
+    """以 model 分開的 admission control，每個 model 各自的名額和隊伍"""
+
+    def __init__(self, default_limit: int = AGENT_MAX_CONCURRENT_RUNS, limits: dict | None = None):
+        self.default_limit = default_limit
+        self.limits = limits or {}
+        self.pools: dict[str, ModelAdmission] = {}
+
+    def pool(self, model: str) -> ModelAdmission:
+        if model not in self.pools:
+            self.pools[model] = ModelAdmission(model, self.limits.get(model, self.default_limit))
+        return self.pools[model]
+
+    def reserve(self, model: str, client_key) -> AdmissionTicket:
+        return self.pool(model).reserve(client_key)
+
+    def snapshot(self) -> dict:
+        return { model: pool.snapshot() for model, pool in self.pools.items() }
+
+agent_admission = AdmissionController(limits=parse_model_concurrency(AGENT_MODEL_CONCURRENCY))
@@ -1,16 +1,24 @@
 from dataclasses import dataclass
 from pydantic import BaseModel, Field
-from agents import Agent, Runner, function_tool, RunContextWrapper, ModelSettings, set_default_openai_client, WebSearchTool, FileSearchTool
-from tavily import AsyncTavilyClient
-from datetime import datetime
+from agents import Agent, Runner, RunConfig, function_tool, RunContextWrapper, ModelSettings, set_default_openai_client, WebSearchTool, FileSearchTool
 from openai import AsyncOpenAI
 import braintrust
 import os
 import asyncio
 import aiosqlite
+import hashlib
 import json
 import pathlib
-from utils import count_tokens
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from utils import num_tokens_for_item, anum_tokens_for_items, convert_agent_tools, num_tokens_for_functions
+from guardrail_classifier import get_local_guardrail
+from http_clients import http_clients
+from search_cache import search_cache
+from search_output import pack_search_results
+from metrics import context_trim_total, follow_up_questions_total, guardrail_decisions_total, stage_seconds, tool_call_seconds
 
 ROOT_DIR = pathlib.Path(__file__).parent.absolute()
 
@@ -18,25 +26,35 @@ braintrust_logger = None
 openai_client = None
 
 # Load prompts from files
-_prompt_cache = {}
+# 檔案修改時間變了就重新讀取，改 prompts/*.md 不用重啟 server
+_prompt_cache = {}  # key -> (mtime, prompt)
 def load_prompt(key: str) -> str:
-    if key not in _prompt_cache:
+    prompt_path = ROOT_DIR / "prompts" / f"{key}.md"
+    mtime = prompt_path.stat().st_mtime_ns
+    cached = _prompt_cache.get(key)
+    if cached is None or cached[0] != mtime:
         print(f"Loading prompt: {key}")
-        prompt_path = ROOT_DIR / "prompts" / f"{key}.md"
         with open(prompt_path, "r", encoding="utf-8") as f:
-            _prompt_cache[key] = f.read()
-    return _prompt_cache[key]
+            _prompt_cache[key] = (mtime, f.read())
+    return _prompt_cache[key][1]
 
-async def get_previous_items(db, thread_id: str) -> tuple[list, dict]:
+def prompt_instructions(key: str):
+    """Agent 的 dynamic instructions，每次 run 都透過 load_prompt 取得最新的 prompt"""
+    def instructions(wrapper: RunContextWrapper, agent: Agent) -> str:
+        return load_prompt(key)
+    return instructions
+
+async def get_previous_items(db, thread_id: str) -> tuple[list, dict, list]:
     """
-    根據 thread_id 從 agent_turns 取得最後一筆對話的 raw_items 和 metadata
+    根據 thread_id 從 agent_turns 取得最後一筆對話的 raw_items、metadata 和每個 item 的 token 數
     如果沒有找到，返回空列表和空字典
     """
     input_items = []
     metadata = {}
+    item_tokens = []
 
     async with db.execute(
-        "SELECT raw_items, metadata FROM agent_turns WHERE thread_id = ? ORDER BY id DESC LIMIT 1",
+        "SELECT raw_items, metadata, raw_items_tokens FROM agent_turns WHERE thread_id = ? ORDER BY id DESC LIMIT 1",
         (thread_id,)
     ) as cursor:
         row = await cursor.fetchone()
@@ -51,37 +69,146 @@ async def get_previous_items(db, thread_id: str) -> tuple[list, dict]:
 
                 if row[1]:
                     metadata = json.loads(row[1])
+
+                # 寫入時已經算好的 token 數
+                if row[2]:
+                    item_tokens = json.loads(row[2])
             except Exception as e:
                 print(f"Error loading raw_items: {e}")
 
-    return input_items, metadata
+    # 舊資料沒有 token 數 (或對不上) 的話才重新計算
+    if len(item_tokens) != len(input_items):
+        item_tokens = await anum_tokens_for_items(input_items)
+
+    return input_items, metadata, item_tokens
+
+async def count_raw_items_tokens(raw_items: list, known_tokens: dict) -> list:
+    """
+    計算每個 raw item (JSON 字串) 的 token 數
+    known_tokens 是 {item JSON 字串: token 數}，沿用上一輪已算過的結果，只有新的 items 才需要 tokenize
+    """
+    new_items = [item_str for item_str in raw_items if item_str not in known_tokens]
+    new_tokens = await anum_tokens_for_items([json.loads(item_str) for item_str in new_items])
+    known_tokens = { **known_tokens, **dict(zip(new_items, new_tokens)) }
+
+    return [known_tokens[item_str] for item_str in raw_items]
 
 # Context Engineering 閾值設定
 TOOL_CALL_OUTPUT_TRIM_THRESHOLD = 150000  # 當 tokens 超過此值時，簡化 function_call_output
 TURN_BASED_TRIM_THRESHOLD = 200000  # 當 tokens 超過此值時，開始移除舊的對話輪次
 TURN_BASED_TARGET_TOKENS = 50000  # Turn-based trimming 的目標 token 數量
 
-async def context_editing(input_items: list, used_tokens: int) -> list:
+TOOL_CALL_OUTPUT_PLACEHOLDER = "Tool results removed (context limit). Re-run the tool if needed."
+
+# Prompt cache 友善的剪裁策略
+# legacy: 超過閾值後每一輪都清空所有 tool outputs，每輪都會改到歷史中段，讓 provider 的 prefix cache 失效
+# cache_aware: 保留最近幾個 turns 的 tool outputs，可清除的量累積夠大才一次清除，讓 prefix 在兩次剪裁之間保持不變
+CONTEXT_TRIM_POLICY = os.getenv("CONTEXT_TRIM_POLICY", "cache_aware")
+TOOL_CALL_OUTPUT_KEEP_TURNS = 1  # cache_aware: 最近幾個 turns 的 tool outputs 不清除
+TOOL_CALL_OUTPUT_TRIM_MIN_TOKENS = 30000  # cache_aware: 可清除的 tool outputs 累積到這個 tokens 數才清除
+
+def prompt_cache_key_for_thread(thread_id: str) -> str:
+    """同一個 thread 的 requests 使用固定的 prompt_cache_key，讓 provider 把它們路由到同一份 prefix cache"""
+    return "thread-" + hashlib.sha256(thread_id.encode("utf-8")).hexdigest()[:32]
+
+# Context compaction 模式
+# trim: 超過閾值時清空 tool outputs、移除最舊的 turns (原本的作法)
+# summary: 背景產生 rolling summary，下一輪用 summary 取代被移除的舊 turns
+CONTEXT_COMPACTION_MODE = os.getenv("CONTEXT_COMPACTION_MODE", "trim")
+SUMMARY_ITEM_PREFIX = "<conversation_summary>"
+
+def build_summary_item(summary: str) -> dict:
+    return {
+        "role": "developer",
+        "content": f"{SUMMARY_ITEM_PREFIX}\nSummary of the earlier conversation with this user:\n{summary}\n</conversation_summary>"
+    }
+
+def is_summary_item(item: dict) -> bool:
+    return item.get("role") == "developer" and str(item.get("content", "")).startswith(SUMMARY_ITEM_PREFIX)
+
+def summary_item_hash(item: dict) -> str:
+    """用來確認 summary 涵蓋的 items 和目前的歷史對話是否一致"""
+    return hashlib.sha1(json.dumps(item, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def split_into_turns(input_items: list, item_tokens: list) -> list:
+    """
+    按 user role 切分 turns
+    回傳 [(turn 索引, turn 的 tokens, [(item, tokens), ...]), ...]
+    """
+    turns = []  # nested list
+    current_turn = []
+
+    for item, tokens in zip(input_items, item_tokens):
+        if item.get("role") == "user" and current_turn:
+            # 遇到新的 user message，結束當前 turn
+            turns.append(current_turn)
+            current_turn = [(item, tokens)]
+        else:
+            current_turn.append((item, tokens))
+
+    # 添加最後一個 turn
+    if current_turn:
+        turns.append(current_turn)
+
+    # 每個 turn 的 tokens 數量直接加總已知的 item tokens，不需要重新 tokenize
+    return [(i, sum(t for _, t in turn), turn) for i, turn in enumerate(turns)]
+
+async def context_editing(input_items: list, used_tokens: int, item_tokens: list, thread_summary: dict | None = None) -> tuple[list, list]:
     """
     對 input_items 進行 context engineering，根據 token 使用情況進行剪裁
 
     Args:
         input_items: 要處理的對話記錄
         used_tokens: 前一次對話使用的 tokens 數量
+        item_tokens: 每個 input item 的 token 數，和 input_items 一一對應
+        thread_summary: summary 模式下 thread 已經產生好的 rolling summary (見 context_summary.py)
 
     Returns:
-        處理後的 input_items
+        處理後的 input_items 和對應的 item_tokens
     """
     print(f"previous used_tokens: {used_tokens}")
 
+    item_tokens = list(item_tokens)
+
+    # Context Engineering 0: Rolling summary
+    # summary 模式下，用背景產生好的 summary 取代它涵蓋的舊 items
+    if CONTEXT_COMPACTION_MODE == "summary" and thread_summary:
+        count = thread_summary["item_count"]
+        if 0 < count <= len(input_items) and summary_item_hash(input_items[count - 1]) == thread_summary["item_hash"]:
+            summary_item = build_summary_item(thread_summary["summary"])
+            input_items = [summary_item] + input_items[count:]
+            item_tokens = [num_tokens_for_item(summary_item)] + item_tokens[count:]
+            used_tokens = sum(item_tokens)
+            print(f"Applied conversation summary: replaced {count} items, remaining tokens: {used_tokens}")
+            context_trim_total.inc(trigger="summary")
+
     # Context Engineering 1: Tool call output trimming
     # 當 tokens 超過閾值時，簡化 function_call_output 內容
     if used_tokens > TOOL_CALL_OUTPUT_TRIM_THRESHOLD:
         print(f"Trigger tool call output filter: used_tokens={used_tokens}")
-        for item in input_items:
-            if item.get("type") == "function_call_output":
-                print(" remove function_call_output! ")
-                item["output"] = "Tool results removed (context limit). Re-run the tool if needed."
+        candidates = [
+            i for i, item in enumerate(input_items)
+            if item.get("type") == "function_call_output" and item.get("output") != TOOL_CALL_OUTPUT_PLACEHOLDER
+        ]
+
+        if CONTEXT_TRIM_POLICY == "cache_aware":
+            # 最近幾個 turns 的 tool outputs 保留，後續追問常常還會用到
+            user_indexes = [i for i, item in enumerate(input_items) if item.get("role") == "user"]
+            keep_from = user_indexes[-TOOL_CALL_OUTPUT_KEEP_TURNS] if len(user_indexes) >= TOOL_CALL_OUTPUT_KEEP_TURNS else 0
+            candidates = [i for i in candidates if i < keep_from]
+
+            # 量不夠大就先不動，避免每一輪都改到 prefix
+            trimmable_tokens = sum(item_tokens[i] for i in candidates)
+            if trimmable_tokens < TOOL_CALL_OUTPUT_TRIM_MIN_TOKENS:
+                print(f"Skip tool call output filter: only {trimmable_tokens} trimmable tokens")
+                candidates = []
+
+        if candidates:
+            context_trim_total.inc(trigger="tool_output")
+        for i in candidates:
+            print(" remove function_call_output! ")
+            input_items[i]["output"] = TOOL_CALL_OUTPUT_PLACEHOLDER
+            item_tokens[i] = num_tokens_for_item(input_items[i])  # 只重算被改到的 item
 
         print(f"After tool call filter")
 
@@ -90,34 +217,7 @@ async def context_editing(input_items: list, used_tokens: int) -> list:
     if used_tokens > TURN_BASED_TRIM_THRESHOLD:
         print(f"Trigger turn-based message filter: used_tokens={used_tokens}")
 
-        # 按 user role 切分 turns
-        turns = []  # nested list
-        current_turn = []
-
-        for item in input_items:
-            if item.get("role") == "user" and current_turn:
-                # 遇到新的 user message，結束當前 turn
-                turns.append(current_turn)
-                current_turn = [item]
-            else:
-                current_turn.append(item)
-
-        # 添加最後一個 turn
-        if current_turn:
-            turns.append(current_turn)
-
-        # 計算每個 turn 的 tokens 數量
-        turn_tokens = []
-        for i, turn in enumerate(turns):
-            turn_content = ""
-            for item in turn:
-                if item.get("content"):
-                    turn_content += str(item.get("content", ""))
-                if item.get("output"):
-                    turn_content += str(item.get("output", ""))
-
-            tokens = count_tokens(turn_content)
-            turn_tokens.append((i, tokens, turn))
+        turn_tokens = split_into_turns(input_items, item_tokens)
 
         # 從最舊的 turn 開始移除，直到總 tokens 低於目標值
         total_tokens = sum(tokens for _, tokens, _ in turn_tokens)
@@ -132,18 +232,29 @@ async def context_editing(input_items: list, used_tokens: int) -> list:
 
         # 重建 items
         input_items = []
+        item_tokens = []
         for _, _, turn in turn_tokens:
-            input_items.extend(turn)
+            input_items.extend(item for item, _ in turn)
+            item_tokens.extend(tokens for _, tokens in turn)
 
         print(f"Token management: removed {removed_turns} turns, remaining tokens: {total_tokens}")
+        if removed_turns:
+            context_trim_total.inc(trigger="turn_based")
 
-    return input_items
+    return input_items, item_tokens
 
-async def save_agent_turn(db, thread_id: str, user_id: int, query: str, chunks_result: list, raw_items: list, metadata: dict):
+async def save_agent_turn(db, thread_id: str, user_id: int, query: str, chunks_result: list, raw_items: list, metadata: dict, raw_items_tokens: list | None = None, commit: bool = True):
     """
     儲存對話記錄到 agent_turns
     如果是新的 thread_id，也會在 agent_threads 建立記錄
+    raw_items_tokens 是每個 raw item 的 token 數，一起存起來下次就不用再 tokenize
+    (每筆 turn 的 raw_items 都是到這一輪為止的完整對話，所以 sum(raw_items_tokens) 就是整段對話的 token 數，不另外在 agent_threads 維護累計值)
+    commit=False 時由呼叫者決定何時 commit (批次寫入多輪對話用同一個 transaction)
+    回傳新的 agent_turns.id
     """
+    if raw_items_tokens is None:
+        raw_items_tokens = await count_raw_items_tokens(raw_items, {})
+
     # 檢查 thread_id 是否已存在於 agent_threads
     async with db.execute(
         "SELECT id FROM agent_threads WHERE thread_id = ?",
@@ -154,37 +265,116 @@ async def save_agent_turn(db, thread_id: str, user_id: int, query: str, chunks_r
     if not thread_exists:
         # 建立新的 thread
         await db.execute(
-            "INSERT INTO agent_threads (thread_id, user_id) VALUES (?, ?)",
+            "INSERT INTO agent_threads (thread_id, user_id, updated_at) VALUES (?, ?, datetime('now'))",
             (thread_id, user_id)
         )
         print(f"Created new thread: {thread_id}")
+    else:
+        # 更新最後活動時間，retention 以此判斷 thread 是否過期
+        await db.execute(
+            "UPDATE agent_threads SET updated_at = datetime('now') WHERE thread_id = ?",
+            (thread_id,)
+        )
 
     # 準備要儲存的資料
     raw_items_json = json.dumps(raw_items, ensure_ascii=False)
     output_json = json.dumps(chunks_result, ensure_ascii=False)
     metadata_json = json.dumps(metadata, ensure_ascii=False)
+    raw_items_tokens_json = json.dumps(raw_items_tokens)
 
     # 插入新的 agent_turn
-    await db.execute("""
-        INSERT INTO agent_turns (thread_id, user_id, input, output, raw_items, metadata)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (thread_id, user_id, query, output_json, raw_items_json, metadata_json))
-
-    await db.commit()
+    cursor = await db.execute("""
+        INSERT INTO agent_turns (thread_id, user_id, input, output, raw_items, metadata, raw_items_tokens, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, datetime('now'))
+    """, (thread_id, user_id, query, output_json, raw_items_json, metadata_json, raw_items_tokens_json))
+    turn_id = cursor.lastrowid
+
+    if commit:
+        await db.commit()
     print(f"Saved conversation to database for thread: {thread_id}")
+    return turn_id
+
+async def list_user_threads(db, user_id: int, before_id: int | None = None, limit: int = 20) -> list[dict]:
+    """
+    依 keyset pagination 列出使用者的 threads (新的在前)
+    只讀 agent_threads 和每個 thread 第一筆 turn 的 input 當標題，不碰 raw_items
+    """
+    sql = """
+        SELECT t.id, t.thread_id,
+            (SELECT input FROM agent_turns WHERE thread_id = t.thread_id ORDER BY id LIMIT 1) AS title,
+            (SELECT COUNT(*) FROM agent_turns WHERE thread_id = t.thread_id) AS turn_count
+        FROM agent_threads t
+        WHERE t.user_id = ?
+    """
+    params = [user_id]
+    if before_id is not None:
+        sql += " AND t.id < ?"
+        params.append(before_id)
+    sql += " ORDER BY t.id DESC LIMIT ?"
+    params.append(limit)
+
+    async with db.execute(sql, params) as cursor:
+        rows = await cursor.fetchall()
+
+    return [
+        { "id": row[0], "thread_id": row[1], "title": row[2], "turn_count": row[3] }
+        for row in rows
+    ]
+
+async def get_thread_owner(db, thread_id: str) -> int | None:
+    """thread 所屬的 user_id，thread 不存在時回傳 None"""
+    async with db.execute("SELECT user_id FROM agent_threads WHERE thread_id = ?", (thread_id,)) as cursor:
+        row = await cursor.fetchone()
+    return row[0] if row else None
+
+async def list_thread_turns(db, thread_id: str, after_id: int | None = None, limit: int = 20) -> list[dict]:
+    """
+    依 keyset pagination 列出 thread 的對話記錄 (舊的在前)
+    只取 input / output / metadata，不讀很大的 raw_items 欄位
+    """
+    sql = "SELECT id, input, output, metadata FROM agent_turns WHERE thread_id = ?"
+    params = [thread_id]
+    if after_id is not None:
+        sql += " AND id > ?"
+        params.append(after_id)
+    sql += " ORDER BY id ASC LIMIT ?"
+    params.append(limit)
+
+    async with db.execute(sql, params) as cursor:
+        rows = await cursor.fetchall()
+
+    return [
+        {
+            "id": row[0],
+            "input": row[1],
+            "output": json.loads(row[2]) if row[2] else [],
+            "metadata": json.loads(row[3]) if row[3] else {}
+        }
+        for row in rows
+    ]
 
 def init_braintrust():
     global braintrust_logger, openai_client
     braintrust_logger = braintrust.init_logger(project=os.getenv("BRAINTRUST_PROJECT"))
-    openai_client = braintrust.wrap_openai(AsyncOpenAI())
+    openai_client = braintrust.wrap_openai(AsyncOpenAI(http_client=http_clients.get("openai")))
     set_default_openai_client(openai_client) # 設定 OpenAI Agents SDK 預設的 OpenAI Client 改用 braintrust 包裝過的版本
     return braintrust_logger, openai_client
 
-tavily_client = None
-def get_tavily_client():
-    global tavily_client
-    tavily_client = AsyncTavilyClient()
-    return tavily_client
+TAVILY_API_URL = "https://api.tavily.com"
+
+async def tavily_search(query: str, **params) -> dict:
+    """
+    直接呼叫 Tavily search REST API (和 AsyncTavilyClient.search 相同的 request / response)
+    AsyncTavilyClient 每次呼叫都建立再關閉一個 httpx client，改用共用 client 才能重用 connections
+    """
+    client = http_clients.get("tavily", base_url=TAVILY_API_URL)
+    response = await client.post(
+        "/search",
+        json={ "query": query, **params },
+        headers={ "Authorization": f"Bearer {os.getenv('TAVILY_API_KEY')}" }
+    )
+    response.raise_for_status()
+    return response.json()
 
 # Custom Agent Context
 @dataclass
@@ -204,15 +394,18 @@ async def knowledge_search(wrapper: RunContextWrapper[CustomAgentContext], query
 
     print(f"  ⚙️ Calling knowledge_search with query: {query}")
 
-    response = await get_tavily_client().search(query)
+    # 相同的搜尋 (正規化後) 直接用快取，同時進行的相同搜尋只打一次 Tavily
+    with tool_call_seconds.time(tool="knowledge_search"):
+        response = await search_cache.search(query, tavily_search)
 
+    # 完整的 response 留在 context，給 model 的只有去重、排序後放進 token budget 的內容
     wrapper.context.search_source[query] = response
 
-    result = [ x["content"] for x in response["results"] ]
+    result, stats = await pack_search_results(query, response)
 
-    print(f"  ⚙️ knowledge_search result: {result}")
+    print(f"  ⚙️ knowledge_search result: {stats}")
 
-    return str(result)
+    return result
 
 class GuardrailResult(BaseModel):
     allow: bool
@@ -226,7 +419,7 @@ def create_guardrail_agent() -> Agent:
     """Create and return a guardrail agent instance"""
     return Agent(
         name="Guardrail Agent",
-        instructions=load_prompt("guardrail"),
+        instructions=prompt_instructions("guardrail"),
         model="gpt-4.1-mini",
         output_type=GuardrailResult,
     )
@@ -240,12 +433,13 @@ def create_followup_questions_agent() -> Agent:
         output_type=ExtractFollowupQuestionsResult,
     )
 
+LEAD_AGENT_MODEL = "gpt-5-mini"  # admission control 依這個 model 計算同時進行的 runs
+
 def create_lead_agent() -> Agent[CustomAgentContext]:
     """Create and return a lead agent instance"""
-    today = datetime.now().strftime("%Y-%m-%d")
     return Agent[CustomAgentContext](
         name="Lead Agent",
-        instructions=load_prompt("lead"),
+        instructions=prompt_instructions("lead"),
         tools=[knowledge_search],
         #tools=[
             #WebSearchTool(),
@@ -254,7 +448,7 @@ def create_lead_agent() -> Agent[CustomAgentContext]:
             #  vector_store_ids=[os.getenv("OPENAI_VECTOR_STORE_ID")],
             #)
         #],
-        model="gpt-5-mini",
+        model=LEAD_AGENT_MODEL,
         model_settings=ModelSettings(
             reasoning={
                 "effort": "low",
@@ -263,6 +457,67 @@ def create_lead_agent() -> Agent[CustomAgentContext]:
         )
     )
 
+def create_summary_agent() -> Agent:
+    """Create and return a conversation summary agent instance (cheap model, runs in the background)"""
+    return Agent(
+        name="Conversation Summary Agent",
+        instructions=prompt_instructions("summary"),
+        model="gpt-4.1-mini",
+    )
+
+class AgentRegistry:
+    """
+    agents 在 lifespan 開始時建立一次，所有 requests 共用 (Runner 不會修改 agent)
+    prompts 是 dynamic instructions，today's date 等每個 request 不同的值放在 user message，所以不需要每次重建
+    tool schemas 轉換和它們的 token 數也只算一次 (估計沒有 response usage 的 turn 的 context 大小時使用)
+    """
+
+    factories = {
+        "guardrail": create_guardrail_agent,
+        "followup_questions": create_followup_questions_agent,
+        "lead": create_lead_agent,
+        "summary": create_summary_agent
+    }
+
+    def __init__(self):
+        self.agents: dict[str, Agent] = {}
+        self.tool_schemas: dict[str, list] = {}
+        self._tools_tokens: dict[str, int] = {}
+
+    async def build(self):
+        for name in self.factories:
+            self.get(name)
+            await self.tools_tokens(name)
+        print(f"Agents ready: {self._tools_tokens}")
+
+    def get(self, name: str) -> Agent:
+        # lifespan 以外 (scripts、benchmarks) 第一次使用時才建立
+        if name not in self.agents:
+            self.agents[name] = self.factories[name]()
+        return self.agents[name]
+
+    async def tools_tokens(self, name: str) -> int:
+        """agent tool schemas 佔用的 tokens"""
+        if name not in self._tools_tokens:
+            self.tool_schemas[name] = await convert_agent_tools(self.get(name))
+            self._tools_tokens[name] = num_tokens_for_functions(self.tool_schemas[name])
+        return self._tools_tokens[name]
+
+agent_registry = AgentRegistry()
+
+# 背景 tasks 需要保留 reference，避免還沒執行完就被 garbage collect
+_background_tasks = set()
+def run_in_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def wait_background_tasks():
+    """等待目前所有背景 tasks 結束 (shutdown 和 benchmark 使用)"""
+    if _background_tasks:
+        await asyncio.gather(*list(_background_tasks), return_exceptions=True)
+
 # Just for demo, not used in the actual system
 @braintrust.traced
 async def extract_conversation_metadata():
@@ -273,9 +528,143 @@ async def extract_conversation_metadata():
         "user_intent": "investment"
     }
 
+# Input guardrail 設定
+# incremental: 之前的 turns 都已經檢查過，只送新問題 + 最近幾則訊息的文字 (讓「那0056呢？」這種追問有上下文)
+# full: 每次都送整段對話 (舊做法)，成本和延遲會隨著對話變長
+GUARDRAIL_MODE = os.getenv("GUARDRAIL_MODE", "incremental")
+GUARDRAIL_CONTEXT_MESSAGES = 4  # incremental 模式帶入最近幾則 user / assistant 訊息
+GUARDRAIL_CONTEXT_MAX_CHARS = 500  # 每則訊息最多帶入的字數
+GUARDRAIL_CACHE_SIZE = 4096  # 最多快取幾個問題的判斷結果
+# 本地 classifier (guardrail_classifier.py) 很有把握的問題直接判斷，不用等 guardrail agent
+GUARDRAIL_LOCAL_CLASSIFIER = os.getenv("GUARDRAIL_LOCAL_CLASSIFIER", "0") == "1"  # 預設關閉，標註資料足夠校正時才會真的啟用
+GUARDRAIL_LOCAL_REFUSAL = "抱歉，我專注於投資理財與商業相關的問題，這個問題超出我能協助的範圍。如果有理財或商業方面的疑問，歡迎再問我！"
+
+_guardrail_cache: OrderedDict = OrderedDict()  # 正規化後的問題 -> GuardrailResult
+
+def normalize_guardrail_query(query: str) -> str:
+    """全形半形、大小寫、空白、結尾標點不同的問題視為同一個問題"""
+    query = unicodedata.normalize("NFKC", query).casefold()
+    return " ".join(query.split()).rstrip("?!.。？！ ")
+
+def item_text(item) -> str:
+    """取出 message item 的文字，lead agent 的 user message 只取 <query> 內的原始問題"""
+    content = item.get("content")
+    if isinstance(content, list):
+        content = "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    if not isinstance(content, str):
+        return ""
+
+    match = re.search(r"<query>(.*?)</query>", content, re.S)
+    return match.group(1).strip() if match else content.strip()
+
+def guardrail_context(input_items) -> list:
+    """最近幾則 user / assistant 訊息的文字，不含 tool calls、tool outputs 和 reasoning"""
+    messages = []
+    for item in reversed(input_items):
+        if len(messages) >= GUARDRAIL_CONTEXT_MESSAGES:
+            break
+        if item.get("role") not in ("user", "assistant"):
+            continue
+        text = item_text(item)
+        if text:
+            messages.append({ "role": item["role"], "content": text[:GUARDRAIL_CONTEXT_MAX_CHARS] })
+    return list(reversed(messages))
+
 @braintrust.traced
-async def check_input_guardrail(input_items):
-    input_guardrail_agent = create_guardrail_agent()
+async def check_input_guardrail(input_items, query: str, run_config: RunConfig | None = None) -> tuple[GuardrailResult, dict]:
+    """
+    檢查新問題是否允許回答，回傳 (GuardrailResult, 檢查資訊)，檢查資訊會存進 turn metadata
+    沒有上下文的判斷結果會以正規化後的問題快取起來，同樣的問題不用再問一次 model
+    快取 (放行和拒絕) 都只用在沒有歷史對話的 thread，因為有上下文時同一句話的意思可能不同
+    順序: 快取 -> 本地 classifier -> guardrail agent
+    """
+    started = time.perf_counter()
+    history_turns = sum(1 for item in input_items if item.get("role") == "user")
+    key = normalize_guardrail_query(query)
+
+    # 快取的是沒有上下文的判斷，只用在沒有歷史對話的問題；有歷史時 (例如被拒絕後說「還是回答吧」) 一定帶上下文問 guardrail agent
+    cached = _guardrail_cache.get(key) if history_turns == 0 else None
+    if cached is not None:
+        _guardrail_cache.move_to_end(key)
+        verdict = cached
+        source = "cache"
+        context_items = 0
+    elif GUARDRAIL_LOCAL_CLASSIFIER and (local_guardrail := get_local_guardrail()) is not None \
+            and history_turns == 0 and (local_allow := local_guardrail.decide(query)) is not None:
+        # 本地只判斷沒有歷史對話的問題 (有上下文時交給 guardrail agent)；不快取，classifier 本身就只要幾十微秒
+        verdict = GuardrailResult(allow=local_allow, refusal_answer="" if local_allow else GUARDRAIL_LOCAL_REFUSAL)
+        source = "local"
+        context_items = 0
+    else:
+        if GUARDRAIL_MODE == "full":
+            guardrail_items = input_items + [{ "role": "user", "content": query }]
+        else:
+            guardrail_items = guardrail_context(input_items) + [{ "role": "user", "content": query }]
+
+        result = await Runner.run(agent_registry.get("guardrail"), input=guardrail_items, run_config=run_config)
+        verdict = result.final_output
+        source = GUARDRAIL_MODE
+        context_items = len(guardrail_items) - 1
+
+        if context_items == 0:
+            _guardrail_cache[key] = verdict
+            while len(_guardrail_cache) > GUARDRAIL_CACHE_SIZE:
+                _guardrail_cache.popitem(last=False)
+
+    info = {
+        "allow": verdict.allow,
+        "source": source,
+        "history_turns": history_turns,
+        "context_items": context_items,
+        "latency_ms": round((time.perf_counter() - started) * 1000)
+    }
+    stage_seconds.observe(time.perf_counter() - started, stage="guardrail")
+    guardrail_decisions_total.inc(source=source, allow=verdict.allow)
+    return verdict, info
+
+# Follow-up questions 設定
+# 只用最新的問題產生 (不送整段對話)，和 lead agent 同時進行，一完成就送出，超過 time budget 就不送
+FOLLOWUP_QUESTIONS_TIMEOUT = float(os.getenv("FOLLOWUP_QUESTIONS_TIMEOUT", "8"))  # 秒
+FOLLOWUP_QUESTIONS_CACHE_SIZE = 1024  # 最多快取幾個問題的 follow-up questions
+
+_followup_questions_cache: OrderedDict = OrderedDict()  # 正規化後的問題 -> follow-up questions
 
-    result = await Runner.run(input_guardrail_agent, input=input_items)
-    return result    
\ No newline at end of file
+@braintrust.traced
+async def generate_followup_questions(query: str, run_config: RunConfig | None = None) -> tuple[list | None, dict]:
+    """
+    回傳 (follow-up questions, 資訊)，逾時或失敗時 questions 是 None，不影響主要回答
+    相同的問題 (正規化後) 直接使用快取
+    """
+    started = time.perf_counter()
+    key = normalize_guardrail_query(query)
+
+    questions = _followup_questions_cache.get(key)
+    if questions is not None:
+        _followup_questions_cache.move_to_end(key)
+        source = "cache"
+    else:
+        try:
+            result = await asyncio.wait_for(
+                Runner.run(agent_registry.get("followup_questions"), input=query, run_config=run_config),
+                FOLLOWUP_QUESTIONS_TIMEOUT
+            )
+            questions = result.final_output_as(ExtractFollowupQuestionsResult).followup_questions
+            source = "model"
+
+            _followup_questions_cache[key] = questions
+            while len(_followup_questions_cache) > FOLLOWUP_QUESTIONS_CACHE_SIZE:
+                _followup_questions_cache.popitem(last=False)
+        except asyncio.TimeoutError:
+            print(f"Follow-up questions skipped: exceeded {FOLLOWUP_QUESTIONS_TIMEOUT}s")
+            source = "timeout"
+        except Exception as e:
+            print(f"Follow-up questions failed: {e!r}")
+            source = "error"
+
+    info = {
+        "source": source,
+        "latency_ms": round((time.perf_counter() - started) * 1000)
+    }
+    stage_seconds.observe(time.perf_counter() - started, stage="follow_up_questions")
+    follow_up_questions_total.inc(source=source)
+    return questions, info
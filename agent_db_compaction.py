@@ -0,0 +1,184 @@
+"""
+Background compaction and retention for the agent conversation database.
+
+Every agent_turns row stores a full raw_items snapshot of the conversation so far,
+but get_previous_items only ever reads the latest one. This job:
+
+1. Slims older turns down to input / output / metadata (raw_items and raw_items_tokens set to NULL)
+2. Deletes threads whose last activity is older than AGENT_DB_RETENTION_DAYS
+3. Returns freed pages to the filesystem with incremental VACUUM in small steps
+
+Each step works in small batches on its own connection and yields between
+batches, so the request path never waits long for the shard's write lock.
+
+Run once manually:
+  python agent_db_compaction.py
+"""
+import asyncio
+import math
+import os
+import time
+
+import aiosqlite
+
+from agent_store import AGENT_DB_BUSY_TIMEOUT_MS, AGENT_DB_SHARDS, shard_path
+
+AGENT_DB_COMPACTION_INTERVAL = int(os.getenv("AGENT_DB_COMPACTION_INTERVAL", "600"))  # 秒，0 代表不啟動背景 compaction
+AGENT_DB_RETENTION_DAYS = int(os.getenv("AGENT_DB_RETENTION_DAYS", "0"))  # 0 代表永久保留
+COMPACTION_BATCH_SIZE = 200  # 每個 write transaction 處理的筆數
+INCREMENTAL_VACUUM_PAGES = 256  # 每一步 incremental vacuum 釋放的 pages 數
+INCREMENTAL_VACUUM_EXTRA_STEPS = 2  # 比開始時 free pages 需要的步數多跑幾步，應付執行期間新產生的 free pages
+STEP_PAUSE_SECONDS = 0.05  # 每個 batch 之間讓出 write lock 的時間
+
+last_compaction_report = {}
+
+async def db_size_bytes(db) -> int:
+    async with db.execute("PRAGMA page_count") as cursor:
+        page_count = (await cursor.fetchone())[0]
+    async with db.execute("PRAGMA page_size") as cursor:
+        page_size = (await cursor.fetchone())[0]
+    return page_count * page_size
+
+async def slim_old_turns(db) -> int:
+    """把每個 thread 最新一筆以外的 raw_items 清掉，回傳處理的筆數"""
+    slimmed = 0
+    last_id = 0
+
+    while True:
+        async with db.execute("""
+            SELECT t.id FROM agent_turns t
+            WHERE t.id > ?
+              AND t.raw_items IS NOT NULL
+              AND t.id < (SELECT MAX(id) FROM agent_turns WHERE thread_id = t.thread_id)
+            ORDER BY t.id
+            LIMIT ?
+        """, (last_id, COMPACTION_BATCH_SIZE)) as cursor:
+            ids = [row[0] for row in await cursor.fetchall()]
+
+        if not ids:
+            break
+
+        placeholders = ", ".join("?" for _ in ids)
+        await db.execute(f"UPDATE agent_turns SET raw_items = NULL, raw_items_tokens = NULL WHERE id IN ({placeholders})", ids)
+        await db.commit()
+
+        slimmed += len(ids)
+        last_id = ids[-1]
+        await asyncio.sleep(STEP_PAUSE_SECONDS)
+
+    return slimmed
+
+async def expire_threads(db, retention_days: int) -> int:
+    """刪除超過 retention 天數沒有活動的 threads，回傳刪除的 thread 數"""
+    if retention_days <= 0:
+        return 0
+
+    expired = 0
+    while True:
+        async with db.execute(
+            "SELECT thread_id FROM agent_threads WHERE updated_at < datetime('now', ?) LIMIT ?",
+            (f"-{retention_days} days", COMPACTION_BATCH_SIZE)
+        ) as cursor:
+            thread_ids = [row[0] for row in await cursor.fetchall()]
+
+        if not thread_ids:
+            break
+
+        placeholders = ", ".join("?" for _ in thread_ids)
+        await db.execute(f"DELETE FROM agent_turns WHERE thread_id IN ({placeholders})", thread_ids)
+        await db.execute(f"DELETE FROM agent_threads WHERE thread_id IN ({placeholders})", thread_ids)
+        await db.commit()
+
+        expired += len(thread_ids)
+        await asyncio.sleep(STEP_PAUSE_SECONDS)
+
+    return expired
+
+async def freelist_count(db) -> int:
+    async with db.execute("PRAGMA freelist_count") as cursor:
+        return (await cursor.fetchone())[0]
+
+async def incremental_vacuum(db) -> int:
+    """
+    分多次小步驟釋放 free pages，回傳實際釋放的 pages 數
+    步數有上限 (依開始時的 free pages 數計算)，其他 connections 一直在產生新的 free pages 時也會結束，剩下的留給下一次
+    """
+    async with db.execute("PRAGMA auto_vacuum") as cursor:
+        if (await cursor.fetchone())[0] != 2:
+            print("  auto_vacuum is not INCREMENTAL, run migrate_agent_db.py to enable it")
+            return 0
+
+    before = await freelist_count(db)
+    max_steps = math.ceil(before / INCREMENTAL_VACUUM_PAGES) + INCREMENTAL_VACUUM_EXTRA_STEPS
+    freelist = before
+    for _ in range(max_steps):
+        if freelist == 0:
+            break
+
+        # incremental_vacuum 每次 step 只釋放一個 page，要把結果 fetch 完才會真的執行完
+        async with db.execute(f"PRAGMA incremental_vacuum({INCREMENTAL_VACUUM_PAGES})") as cursor:
+            await cursor.fetchall()
+        await db.commit()
+        await asyncio.sleep(STEP_PAUSE_SECONDS)
+        freelist = await freelist_count(db)
+
+    return max(0, before - freelist)
+
+async def compact_shard(db_path: str, retention_days: int = AGENT_DB_RETENTION_DAYS) -> dict:
+    if not os.path.exists(db_path):
+        return {}
+
+    started = time.perf_counter()
+
+    # 使用獨立的 connection，不佔用 request path 的 connection pool
+    async with aiosqlite.connect(db_path) as db:
+        await db.execute(f"PRAGMA busy_timeout={AGENT_DB_BUSY_TIMEOUT_MS};")
+
+        size_before = await db_size_bytes(db)
+        slimmed_turns = await slim_old_turns(db)
+        expired_threads = await expire_threads(db, retention_days)
+        released_pages = await incremental_vacuum(db)
+        size_after = await db_size_bytes(db)
+
+    return {
+        "db_path": db_path,
+        "slimmed_turns": slimmed_turns,
+        "expired_threads": expired_threads,
+        "released_pages": released_pages,
+        "size_before": size_before,
+        "size_after": size_after,
+        "reclaimed_bytes": size_before - size_after,
+        "duration_seconds": round(time.perf_counter() - started, 3)
+    }
+
+async def compact_all_shards(num_shards: int = AGENT_DB_SHARDS, retention_days: int = AGENT_DB_RETENTION_DAYS) -> dict:
+    global last_compaction_report
+
+    shards = []
+    for shard in range(num_shards):
+        report = await compact_shard(shard_path(shard), retention_days)
+        if report:
+            shards.append(report)
+            print(f"Compacted {report['db_path']}: slimmed {report['slimmed_turns']} turns, "
+                  f"expired {report['expired_threads']} threads, reclaimed {report['reclaimed_bytes']} bytes "
+                  f"in {report['duration_seconds']}s")
+
+    last_compaction_report = {
+        "finished_at": time.time(),
+        "reclaimed_bytes": sum(r["reclaimed_bytes"] for r in shards),
+        "shards": shards
+    }
+    return last_compaction_report
+
+async def compaction_loop(interval: int = AGENT_DB_COMPACTION_INTERVAL):
+    """在 app lifespan 內以背景 task 執行，每 interval 秒 compact 一次"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await compact_all_shards()
+        except Exception as e:
+            print(f"Error during agent db compaction: {e}")
+
+if __name__ == "__main__":
+    report = asyncio.run(compact_all_shards())
+    print(f"Total reclaimed: {report['reclaimed_bytes']} bytes")
@@ -0,0 +1,138 @@
+import asyncio
+import itertools
+import time
+import uuid
+from collections import deque
+
+from sse import DeltaCoalescer, encode_json
+
+# Resumable run 設定
+# agent run 不再綁在 HTTP response 上: run 在背景 task 執行，events 存在 ring buffer，
+# client 斷線重連時帶 Last-Event-ID 就能從斷掉的地方繼續收，不需要重新問一次
+RUN_EVENT_BUFFER_SIZE = 4096  # 每個 run 最多保留幾個 events，超過的話最舊的會被丟掉
+RUN_RETENTION_SECONDS = 60  # run 結束後 buffer 再保留多久，讓晚一點重連的 client 還能補收
+RUN_DETACHED_GRACE_SECONDS = 30  # 沒有任何 client 連著的 run 等多久才中止
+DISCONNECT_POLL_INTERVAL = 1.0  # 秒，多久檢查一次 SSE client 是否已經斷線
+
+class AgentRun:
+    """一次 agent run 的 events，每個 event 有遞增的 seq，subscriber 可以從任何還在 buffer 內的 seq 開始收"""
+
+    def __init__(self, run_id: str, thread_id: str):
+        self.run_id = run_id
+        self.thread_id = thread_id
+        self.events: deque = deque(maxlen=RUN_EVENT_BUFFER_SIZE)  # (seq, event dict, 編碼好的 JSON)
+        self.next_seq = 0
+        self.done = False
+        self.finished_at = None
+        self.subscribers = 0
+        self.task: asyncio.Task | None = None
+        self._changed = asyncio.Event()
+        self._coalescer = DeltaCoalescer(self._append)  # 連續的 content deltas 先合併再放進 buffer，減少 frames 數量
+        self._detach_timer: asyncio.TimerHandle | None = None
+
+    def event_id(self, seq: int) -> str:
+        return f"{self.run_id}:{seq}"
+
+    def publish(self, event: dict):
+        self._coalescer.push(event)
+
+    def _append(self, event: dict):
+        # 每個 event 只編碼一次，所有 subscribers (包含重連補送) 共用
+        self.events.append((self.next_seq, event, encode_json(event)))
+        self.next_seq += 1
+        self._notify()
+
+    def finish(self):
+        self._coalescer.flush()
+        self.done = True
+        self.finished_at = time.time()
+        self._notify()
+
+    def _notify(self):
+        # 喚醒所有正在等待的 subscribers，之後的等待使用新的 Event
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def subscribe(self, after_seq: int | None = None, is_disconnected=None):
+        """
+        從 after_seq 之後開始 yield (seq, event, data)，先補送 buffer 內的 events，再繼續即時轉送
+        is_disconnected 是 Request.is_disconnected，client 斷線時結束 subscription (run 本身繼續跑)
+        """
+        self.subscribers += 1
+        if self._detach_timer is not None:
+            self._detach_timer.cancel()
+            self._detach_timer = None
+
+        seq = 0 if after_seq is None else after_seq + 1
+        try:
+            while True:
+                changed = self._changed
+                if self.events:
+                    first_seq = self.events[0][0]
+                    if seq < first_seq:
+                        print(f"Run {self.run_id}: events {seq}..{first_seq - 1} already dropped from the ring buffer")
+                        seq = first_seq
+                    for event_seq, event, data in itertools.islice(self.events, seq - first_seq, None):
+                        yield event_seq, event, data
+                        seq = event_seq + 1
+
+                if self.done and seq >= self.next_seq:
+                    return
+
+                try:
+                    await asyncio.wait_for(changed.wait(), DISCONNECT_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    if is_disconnected is not None and await is_disconnected():
+                        return
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                self._detach_timer = asyncio.get_running_loop().call_later(RUN_DETACHED_GRACE_SECONDS, self._abort_if_detached)
+
+    def _abort_if_detached(self):
+        self._detach_timer = None
+        if self.subscribers == 0 and not self.done and self.task is not None:
+            print(f"Run {self.run_id}: no client attached for {RUN_DETACHED_GRACE_SECONDS}s, aborting")
+            self.task.cancel()
+
+class AgentRunRegistry:
+    """以 run id 管理進行中和剛結束的 runs"""
+
+    def __init__(self):
+        self.runs: dict[str, AgentRun] = {}
+
+    def get(self, run_id: str) -> AgentRun | None:
+        return self.runs.get(run_id)
+
+    def start(self, thread_id: str, events) -> AgentRun:
+        """在背景 task 消化 events (async iterator of dicts)，把每個 event 放進 run 的 buffer"""
+        run = AgentRun(uuid.uuid4().hex, thread_id)
+        self.runs[run.run_id] = run
+        run.task = asyncio.create_task(self._produce(run, events))
+        return run
+
+    async def _produce(self, run: AgentRun, events):
+        try:
+            async for event in events:
+                run.publish(event)
+        except asyncio.CancelledError:
+            # 被中止的 run 也要送出結束訊號，重連的 EventSource 收到 DONE 才會停止，不會一直重連
+            run.publish({ "message": "DONE", "aborted": True })
+            raise
+        except Exception as e:
+            # 讓 client 收到結束訊號，避免 EventSource 不斷重連
+            print(f"Run {run.run_id} failed: {e!r}")
+            run.publish({ "message": "DONE", "error": True })
+        finally:
+            await events.aclose()
+            run.finish()
+            asyncio.get_running_loop().call_later(RUN_RETENTION_SECONDS, self.runs.pop, run.run_id, None)
+
+    async def cancel_all(self):
+        """shutdown 時中止所有還在跑的 runs"""
+        tasks = [run.task for run in self.runs.values() if run.task is not None and not run.task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+agent_runs = AgentRunRegistry()
@@ -0,0 +1,116 @@
+import asyncio
+from collections import OrderedDict
+
+from agent_core import CONTEXT_COMPACTION_MODE, get_previous_items
+from agent_store import agent_store
+from context_summary import get_thread_summary
+from conversation_metadata import count_thread_turns, get_thread_metadata
+
+LATEST_TURN_ID_CACHE_SIZE = 10000  # 最多記住幾個 threads 的最新 turn id
+
+# thread_id -> 最新的 agent_turns.id，每次存完一輪 (persist_turn) 就更新
+# sessions 每一輪開始前和它比對，不用每輪都查資料庫；只看得到這個 process 寫入的 turns
+_latest_turn_ids: OrderedDict = OrderedDict()
+
+def note_turn_saved(thread_id: str, turn_id: int):
+    _latest_turn_ids[thread_id] = turn_id
+    _latest_turn_ids.move_to_end(thread_id)
+    while len(_latest_turn_ids) > LATEST_TURN_ID_CACHE_SIZE:
+        _latest_turn_ids.popitem(last=False)
+
+async def get_last_turn_id(db, thread_id: str) -> int | None:
+    async with db.execute("SELECT MAX(id) FROM agent_turns WHERE thread_id = ?", (thread_id,)) as cursor:
+        row = await cursor.fetchone()
+    return row[0]
+
+async def latest_turn_id(thread_id: str) -> int | None:
+    """thread 最新的 turn id，快取裡沒有時才查資料庫"""
+    if thread_id in _latest_turn_ids:
+        return _latest_turn_ids[thread_id]
+    async with agent_store.connection(thread_id) as db:
+        turn_id = await get_last_turn_id(db, thread_id)
+    if turn_id is not None:
+        note_turn_saved(thread_id, turn_id)
+    return turn_id
+
+class AgentSession:
+    """
+    WebSocket 連線期間的對話 state: 歷史 items (已經解析好)、每個 item 的 token 數、metadata、rolling summary 和累計的 token 用量
+    只在連線時 (或 state 失效時) 讀完整歷史，之後每一輪結束都直接更新記憶體內的 state
+    同一個 thread 也可能由 SSE、batch 或另一個分頁寫入，所以每一輪開始前先和快取的最新 turn id 比對，不同就重新讀取
+    """
+
+    def __init__(self, thread_id: str, user_id: int):
+        self.thread_id = thread_id
+        self.user_id = user_id
+        self.input_items = []
+        self.previous_metadata = {}
+        self.item_tokens = []
+        self.thread_metadata = None
+        self.thread_summary = None
+        self.turn_count = 0
+        self.loaded = False
+        self.last_turn_id = None  # 記憶體內的 state 對應到的最後一個 agent_turns.id
+        self.pending_write: asyncio.Task | None = None  # 中止的 turn 在背景寫入，重新讀取前要先等它寫完
+        self.token_usage = { "turns": 0, "input_tokens": 0, "output_tokens": 0, "total_tokens": 0 }
+
+    async def load(self):
+        if self.pending_write is not None:
+            await asyncio.gather(self.pending_write, return_exceptions=True)
+            self.pending_write = None
+
+        async with agent_store.connection(self.thread_id) as db:
+            self.input_items, self.previous_metadata, self.item_tokens = await get_previous_items(db, self.thread_id)
+            self.thread_metadata = await get_thread_metadata(db, self.thread_id)
+            self.turn_count = await count_thread_turns(db, self.thread_id)
+            self.thread_summary = await get_thread_summary(db, self.thread_id) if CONTEXT_COMPACTION_MODE == "summary" else None
+            self.last_turn_id = await get_last_turn_id(db, self.thread_id)
+        if self.last_turn_id is not None:
+            note_turn_saved(self.thread_id, self.last_turn_id)
+        self.loaded = True
+
+    async def history(self) -> tuple[list, dict, list]:
+        """回傳 (input_items, previous_metadata, item_tokens) 的複本，context editing 可以放心修改"""
+        if not self.loaded:
+            await self.load()
+        else:
+            last_turn_id = await latest_turn_id(self.thread_id)
+            if last_turn_id != self.last_turn_id:
+                print(f"Session state is stale for thread {self.thread_id} (turn {self.last_turn_id} -> {last_turn_id}), reloading")
+                await self.load()
+        return list(self.input_items), dict(self.previous_metadata), list(self.item_tokens)
+
+    def record_turn(self, turn_id: int, run_items: list, raw_items_tokens: list, metadata: dict, token_usage=None):
+        """這一輪已經存進資料庫 (id 為 turn_id)，下一輪的歷史就是這一輪的 run_items"""
+        self.last_turn_id = turn_id
+        self.input_items = run_items
+        self.item_tokens = raw_items_tokens
+        self.previous_metadata = metadata
+        self.turn_count += 1
+        self.token_usage["turns"] += 1
+        if token_usage is not None:
+            self.token_usage["input_tokens"] += token_usage.input_tokens
+            self.token_usage["output_tokens"] += token_usage.output_tokens
+            self.token_usage["total_tokens"] += token_usage.total_tokens
+
+    def track_metadata_refresh(self, task: asyncio.Task, query: str):
+        # 先記下這一輪已經在更新 metadata，避免下一輪重複觸發；抽取完成後換成新的 metadata
+        previous = self.thread_metadata["metadata"] if self.thread_metadata else {}
+        self.thread_metadata = { "metadata": previous, "turn_count": self.turn_count, "query": query }
+
+        def on_done(task: asyncio.Task):
+            if not task.cancelled() and task.exception() is None and task.result() is not None:
+                self.thread_metadata = task.result()
+        task.add_done_callback(on_done)
+
+    def track_summary(self, task: asyncio.Task):
+        # rolling summary 在背景更新，產生新的 summary 時換掉記憶體內的 (不用每輪重新讀取)
+        def on_done(task: asyncio.Task):
+            if not task.cancelled() and task.exception() is None and task.result() is not None:
+                self.thread_summary = task.result()
+        task.add_done_callback(on_done)
+
+    def invalidate(self, pending_write: asyncio.Task | None = None):
+        """run 被中止時 state 不再可靠，下一輪等背景寫入完成後重新從資料庫讀取"""
+        self.loaded = False
+        self.pending_write = pending_write
@@ -0,0 +1,117 @@
+import asyncio
+import hashlib
+import os
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+# Sharding 設定
+# 每個 shard 是一個獨立的 SQLite 檔案，各自擁有自己的 write lock
+# shard 0 沿用原本的 data/agent.db，所以 AGENT_DB_SHARDS=1 時和舊版完全相同
+AGENT_DB_PATH = os.getenv("AGENT_DB_PATH", "data/agent.db")
+AGENT_DB_SHARDS = int(os.getenv("AGENT_DB_SHARDS", "1"))
+AGENT_DB_POOL_SIZE = int(os.getenv("AGENT_DB_POOL_SIZE", "4"))  # 每個 shard 的 connection 上限
+AGENT_DB_BUSY_TIMEOUT_MS = 5000
+
+def shard_path(shard: int) -> str:
+    """回傳第 shard 個 SQLite 檔案路徑，shard 0 就是 data/agent.db"""
+    if shard == 0:
+        return AGENT_DB_PATH
+    root, ext = os.path.splitext(AGENT_DB_PATH)
+    return f"{root}_{shard}{ext}"
+
+def shard_for_thread(thread_id: str, num_shards: int) -> int:
+    """
+    用 jump consistent hash 決定 thread_id 落在哪個 shard
+    增加 shard 數量時只有約 1/N 的 threads 需要搬家，rebalance 的成本比 hash % N 小很多
+    https://arxiv.org/abs/1406.2294
+    """
+    key = int.from_bytes(hashlib.blake2b(thread_id.encode("utf-8"), digest_size=8).digest(), "big")
+    b, j = -1, 0
+    while j < num_shards:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+class SQLitePool:
+    """
+    單一 SQLite 檔案的 connection pool
+    connection 在第一次需要時才建立，用完放回 idle queue 重複使用，避免每個 request 都重新開檔
+    """
+
+    def __init__(self, db_path: str, size: int = AGENT_DB_POOL_SIZE):
+        self.db_path = db_path
+        self.size = size
+        self._idle: asyncio.Queue = asyncio.Queue()
+        self._created = 0
+
+    async def _connect(self) -> aiosqlite.Connection:
+        db = await aiosqlite.connect(self.db_path)
+        # Enable WAL mode for better performance
+        await db.execute("PRAGMA journal_mode=WAL;")
+        await db.execute(f"PRAGMA busy_timeout={AGENT_DB_BUSY_TIMEOUT_MS};")
+        return db
+
+    async def _acquire(self) -> aiosqlite.Connection:
+        if not self._idle.empty():
+            return self._idle.get_nowait()
+
+        if self._created < self.size:
+            self._created += 1
+            try:
+                return await self._connect()
+            except Exception:
+                self._created -= 1
+                raise
+
+        # pool 已滿，等其他 request 歸還 connection
+        return await self._idle.get()
+
+    @asynccontextmanager
+    async def connection(self):
+        db = await self._acquire()
+        try:
+            yield db
+        except BaseException:
+            # 確保放回 pool 的 connection 沒有殘留的 transaction
+            if db.in_transaction:
+                await db.rollback()
+            raise
+        finally:
+            self._idle.put_nowait(db)
+
+    async def close(self):
+        while not self._idle.empty():
+            db = self._idle.get_nowait()
+            await db.close()
+            self._created -= 1
+
+class ShardedAgentStore:
+    """
+    agent_threads / agent_turns 的 routing layer
+    同一個 thread_id 的所有資料都在同一個 shard，所以 get_previous_items 和 save_agent_turn 只需要拿到正確的 connection
+    """
+
+    def __init__(self, num_shards: int = AGENT_DB_SHARDS, pool_size: int = AGENT_DB_POOL_SIZE):
+        if num_shards < 1:
+            raise ValueError(f"num_shards must be >= 1, got {num_shards}")
+        self.num_shards = num_shards
+        self.pools = [SQLitePool(shard_path(i), pool_size) for i in range(num_shards)]
+
+    def shard_for(self, thread_id: str) -> int:
+        return shard_for_thread(thread_id, self.num_shards)
+
+    def connection(self, thread_id: str):
+        """取得 thread_id 所在 shard 的 connection (async context manager)"""
+        return self.pools[self.shard_for(thread_id)].connection()
+
+    def shard_connection(self, shard: int):
+        """直接取得指定 shard 的 connection，給需要掃過所有 shards 的功能使用"""
+        return self.pools[shard].connection()
+
+    async def close(self):
+        for pool in self.pools:
+            await pool.close()
+
+agent_store = ShardedAgentStore()
@@ -0,0 +1,96 @@
+import os
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from my_retriever import get_embeddings
+from search_cache import TIME_SENSITIVE_PATTERN
+
+# Semantic answer cache 設定 (預設關閉)
+# 很多 threads 的第一個問題都差不多 (0050 報酬率、台積電股利、定存利率...)，
+# 沒有歷史對話的第一輪如果和快取的問題 embedding 夠相似，直接重播快取的回答和 follow-up questions，不跑 guardrail / lead agent / 搜尋
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "0") == "1"
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.92"))  # cosine similarity 超過這個值才算命中
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "512"))  # 最多快取幾個回答，滿了先丟最少命中的
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "21600"))  # 秒，一般回答保留多久
+ANSWER_CACHE_FRESH_TTL = int(os.getenv("ANSWER_CACHE_FRESH_TTL", "600"))  # 秒，跟時間有關的問題 (股價、今天...) 只保留這麼久
+ANSWER_CACHE_EMBEDDING_MODEL = "text-embedding-3-small"
+
+@dataclass
+class CachedAnswer:
+    query: str
+    embedding: np.ndarray  # 已經 l2 normalize
+    events: list  # 重播給 client 的 events (content、following_questions)
+    answer: str
+    expires_at: float
+    created_at: float = field(default_factory=time.time)
+    hits: int = 0
+    last_hit_at: float | None = None
+
+@dataclass
+class AnswerCacheMatch:
+    entry: CachedAnswer | None  # 沒有命中時是 None
+    similarity: float
+    embedding: np.ndarray | None  # 問題的 embedding，沒命中時用來存新的回答
+
+class AnswerCache:
+    """以 query embedding 的 cosine similarity 查詢的回答快取 (存在記憶體，每個 process 各自一份)"""
+
+    def __init__(self):
+        self.entries: list[CachedAnswer] = []
+        self.stats = { "lookups": 0, "hits": 0, "stores": 0, "errors": 0 }
+
+    async def lookup(self, query: str) -> AnswerCacheMatch:
+        self.stats["lookups"] += 1
+        try:
+            embedding = np.asarray(await get_embeddings(query, ANSWER_CACHE_EMBEDDING_MODEL), dtype=np.float32)
+        except Exception as e:
+            # 查不到就當作沒命中，照常回答
+            print(f"Answer cache lookup failed: {e!r}")
+            self.stats["errors"] += 1
+            return AnswerCacheMatch(None, 0.0, None)
+        embedding /= np.linalg.norm(embedding) or 1.0
+
+        now = time.time()
+        self.entries = [entry for entry in self.entries if entry.expires_at > now]
+        if not self.entries:
+            return AnswerCacheMatch(None, 0.0, embedding)
+
+        similarities = np.stack([entry.embedding for entry in self.entries]) @ embedding
+        best = int(np.argmax(similarities))
+        similarity = float(similarities[best])
+        if similarity < ANSWER_CACHE_SIMILARITY:
+            return AnswerCacheMatch(None, similarity, embedding)
+
+        entry = self.entries[best]
+        entry.hits += 1
+        entry.last_hit_at = now
+        self.stats["hits"] += 1
+        return AnswerCacheMatch(entry, similarity, embedding)
+
+    def store(self, match: AnswerCacheMatch, query: str, answer: str, events: list):
+        if match.embedding is None or not answer:
+            return
+
+        ttl = ANSWER_CACHE_FRESH_TTL if TIME_SENSITIVE_PATTERN.search(query) else ANSWER_CACHE_TTL
+        self.entries.append(CachedAnswer(query, match.embedding, events, answer, time.time() + ttl))
+        self.stats["stores"] += 1
+        if len(self.entries) > ANSWER_CACHE_SIZE:
+            # 剛放進去的不算，其他的依 (命中次數, 建立時間) 最小的先丟
+            self.entries.remove(min(self.entries[:-1], key=lambda entry: (entry.hits, entry.created_at)))
+
+    def snapshot(self) -> dict:
+        top_entries = sorted(self.entries, key=lambda entry: entry.hits, reverse=True)[:10]
+        return {
+            "enabled": ANSWER_CACHE_ENABLED,
+            "size": len(self.entries),
+            "hit_ratio": round(self.stats["hits"] / self.stats["lookups"], 3) if self.stats["lookups"] else None,
+            **self.stats,
+            "top_entries": [
+                { "query": entry.query, "hits": entry.hits, "expires_in": round(entry.expires_at - time.time()) }
+                for entry in top_entries
+            ]
+        }
+
+answer_cache = AnswerCache()
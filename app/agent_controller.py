@@ -1,116 +1,622 @@
-from fastapi import APIRouter
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, Header, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 import json
 import asyncio
-import aiosqlite
+import os
+import statistics
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import aclosing
 from datetime import datetime
 
-from agents import Runner, trace, ItemHelpers
+from pydantic import BaseModel, Field
+
+from agents import Runner, RunConfig, ModelSettings, trace, ItemHelpers
 from agent_core import (
     CustomAgentContext,
-    ExtractFollowupQuestionsResult,
-    create_followup_questions_agent,
-    create_lead_agent,
+    agent_registry,
     init_braintrust,
     check_input_guardrail,
-    extract_conversation_metadata,
+    generate_followup_questions,
     get_previous_items,
     save_agent_turn,
-    context_editing
+    get_thread_owner,
+    context_editing,
+    count_raw_items_tokens,
+    run_in_background,
+    is_summary_item,
+    prompt_cache_key_for_thread,
+    LEAD_AGENT_MODEL,
+    CONTEXT_COMPACTION_MODE,
+    CONTEXT_TRIM_POLICY
 )
+from admission import AdmissionRejected, AdmissionTicket, agent_admission
+from agent_session import AgentSession, note_turn_saved
+from agent_runs import AgentRun, agent_runs
+from agent_store import agent_store
+from answer_cache import ANSWER_CACHE_ENABLED, answer_cache
+from http_clients import http_clients
+from identity import current_user_id
+from metrics import metrics, stage_seconds, tokens_total, turns_total
+from search_cache import search_cache
+from sse import sse_frame
+from turn_writer import TurnWriter, turn_writer
+from context_summary import get_thread_summary, summarize_thread_history
+from conversation_metadata import count_thread_turns, get_thread_metadata, needs_metadata_refresh, refresh_conversation_metadata
+from utils import estimate_cost_usd
 
 router = APIRouter()
-DB_PATH = "data/agent.db"
-
-braintrust_logger, openai_client = init_braintrust()
-
-@router.get("/api/v3/agent_stream")
-async def get_agent_stream_v3(query: str, thread_id: str):
-    response = StreamingResponse(generate_agent_stream_v3(query, thread_id), media_type="text/event-stream")
-    response.headers["X-Accel-Buffering"] = "no"
-    return response
-
-async def generate_agent_stream_v3(query: str, thread_id: str, user_id: int = 1):
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Enable WAL mode for better performance
-        await db.execute("PRAGMA journal_mode=WAL;")
 
-        # Create agents using factory functions
-        extract_followup_questions_agent = create_followup_questions_agent()
-        lead_agent = create_lead_agent()
+# 樂觀模式: lead agent 和 input guardrail 同時開始，guardrail 放行前 events 先暫存，擋下來就取消 lead agent
+SPECULATIVE_LEAD_AGENT = os.getenv("SPECULATIVE_LEAD_AGENT", "0") == "1"
 
-        # 從資料庫讀取歷史對話
-        input_items, previous_metadata = await get_previous_items(db, thread_id)
+# 中止 runs 的統計 (整個 process 累計)
+disconnect_stats = {
+    "aborted_runs": 0,
+    "tokens_used_before_abort": 0,
+    "estimated_tokens_saved": 0
+}
+_completed_run_tokens = deque(maxlen=100)  # 最近完成的 lead agent runs 的 total tokens，用來估計中止省下的 tokens
 
-        # 如果有歷史對話，進行 context editing
-        if input_items:
-            print(f"previous_metadata: {previous_metadata}")
-            previous_tokens_usage = previous_metadata.get("last_token_usage", {}).get("total_tokens", 0)
-            input_items = await context_editing(input_items, previous_tokens_usage)
+# 批次 (離線) runs 設定: 不經過互動 requests 的 admission control，有自己的名額，不會佔用互動流量的名額
+AGENT_BATCH_CONCURRENCY = int(os.getenv("AGENT_BATCH_CONCURRENCY", "8"))  # 每個 batch request 同時跑幾個 runs
+AGENT_BATCH_MAX_CONCURRENT_RUNS = int(os.getenv("AGENT_BATCH_MAX_CONCURRENT_RUNS", "16"))  # 所有 batch requests 加起來同時跑幾個 runs
+AGENT_BATCH_MAX_ITEMS = int(os.getenv("AGENT_BATCH_MAX_ITEMS", "1000"))  # 一個 batch request 最多幾個 queries
+batch_run_slots = asyncio.Semaphore(AGENT_BATCH_MAX_CONCURRENT_RUNS)
+batch_stats = { "batches": 0, "active_runs": 0, "runs": 0, "errors": 0 }
 
-        custom_agent_context = CustomAgentContext(search_source={})
+websocket_stats = { "active_sessions": 0, "sessions": 0, "turns": 0, "cancelled_runs": 0 }
 
-        today_date = datetime.now().strftime("%Y-%m-%d")
-        chunks_result = []
-        tags = []
-        last_token_usage = {}
-
-        with braintrust_logger.start_span(name="agent_v3") as braintrust_span:
-            with trace("FastAPI Agent v3", trace_id=f"trace_{thread_id}"):
-
-                braintrust_span.log(input={ "query": query },
-                                    metadata={ "thread_id": thread_id })
+braintrust_logger, openai_client = init_braintrust()
 
-                guardrail_input_items = input_items + [{ "role": "user", "content": query }]
+def admission_client_key(connection: Request | WebSocket) -> str | None:
+    """
+    admission control 公平排隊用的 key，由 server 決定 (client IP)，不使用 client 自己送來的參數
+    在 reverse proxy 後面時由 uvicorn 的 proxy headers 設定 (forwarded_allow_ips) 換成真正的 client IP
+    """
+    if connection.client is None or not connection.client.host:
+        return None
+    return f"ip:{connection.client.host}"
 
-                # parallel tasks and wait for results together
-                async with asyncio.TaskGroup() as tg:
-                    ta = tg.create_task( check_input_guardrail(guardrail_input_items) ) # Need check whole conversation history
-                    tb = tg.create_task( extract_conversation_metadata() )
+@router.get("/api/v3/agent_stream")
+async def get_agent_stream_v3(query: str, thread_id: str, request: Request, last_event_id: str | None = Header(default=None)):
+    # EventSource 重連時會帶 Last-Event-ID (run_id:seq)，如果 run 還在就從斷掉的地方補送，不重新執行
+    run, after_seq = None, None
+    if last_event_id:
+        run_id, _, seq = last_event_id.partition(":")
+        run = agent_runs.get(run_id)
+        if run is None or run.thread_id != thread_id or not seq.isdigit():
+            # run 已經過了保留時間或不存在: 不重新執行同一個問題，回 204 讓 EventSource 停止重連
+            print(f"Unknown run {run_id} for Last-Event-ID, not re-running")
+            return Response(status_code=204)
+        after_seq = int(seq)
+        print(f"Resume run {run_id} after event {after_seq}")
+
+    if run is None:
+        # 隊伍已滿就直接回 429，不開 stream
+        try:
+            admission = agent_admission.reserve(LEAD_AGENT_MODEL, admission_client_key(request))
+        except AdmissionRejected as e:
+            return JSONResponse({ "error": "busy", "reason": e.reason }, status_code=429, headers={ "Retry-After": str(e.retry_after) })
+        run = agent_runs.start(thread_id, run_agent_v3(query, thread_id, current_user_id(request), admission))
+
+    response = StreamingResponse(stream_run_events(run, after_seq, request), media_type="text/event-stream")
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
 
-                result = ta.result()
-                extract_conversation_metadata_data = tb.result()
+@router.websocket("/ws/agent/{thread_id}")
+async def agent_websocket(websocket: WebSocket, thread_id: str):
+    """
+    一條 WebSocket 連線就是一個多輪對話 session: 歷史對話只在連線時讀一次，之後每一輪都使用記憶體內的 state (AgentSession)
+    client 送 {"type": "query", "query": "..."} 開始一輪、{"type": "cancel"} 中止進行中的那一輪
+    server 送出的 events 和 /api/v3/agent_stream 相同 (一個 message 一個 event)，中止時送 DONE (aborted)
+    """
+    await websocket.accept()
+    user_id = current_user_id(websocket)
+    client_key = admission_client_key(websocket)
+    session = AgentSession(thread_id, user_id)
+    await session.load()
+    websocket_stats["active_sessions"] += 1
+    websocket_stats["sessions"] += 1
+
+    run, forward_task = None, None
+
+    async def forward(run: AgentRun):
+        async for _, _, data in run.subscribe():
+            await websocket.send_text(data.decode("utf-8"))  # 用 text frames，瀏覽器收到的是字串
+
+    try:
+        while True:
+            try:
+                message = json.loads(await websocket.receive_text())
+                message_type, query = message.get("type"), message.get("query")
+            except (ValueError, AttributeError):
+                message_type, query = None, None
+
+            if message_type == "query" and isinstance(query, str) and query:
+                if run is not None and not run.done:
+                    await websocket.send_json({ "message": "ERROR", "error": "run_in_progress" })
+                    continue
+                # 和 SSE 一樣經過 admission control，排隊時會先收到 QUEUED
+                run = agent_runs.start(thread_id, run_agent_v3(query, thread_id, user_id, client_key=client_key, session=session))
+                forward_task = asyncio.create_task(forward(run))
+                websocket_stats["turns"] += 1
+
+            elif message_type == "cancel":
+                if run is not None and not run.done:
+                    # 已經產生的部分會存成 aborted turn，下一輪重新讀取歷史對話；client 會收到 DONE (aborted)
+                    run.task.cancel()
+                    await asyncio.gather(forward_task, return_exceptions=True)
+                    websocket_stats["cancelled_runs"] += 1
+
+            else:
+                await websocket.send_json({ "message": "ERROR", "error": "invalid_message" })
+
+    except WebSocketDisconnect:
+        print(f"WebSocket session closed: thread={thread_id} turns={session.token_usage['turns']} total_tokens={session.token_usage['total_tokens']}")
+    finally:
+        websocket_stats["active_sessions"] -= 1
+        # 連線斷了就沒有人能收 events，不保留 grace period，直接中止
+        if run is not None and not run.done:
+            run.task.cancel()
+        if forward_task is not None:
+            forward_task.cancel()
+            await asyncio.gather(forward_task, return_exceptions=True)
+
+@router.get("/api/v3/agent_metrics")
+async def get_agent_metrics():
+    return {
+        "admission": agent_admission.snapshot(),
+        "disconnect": disconnect_stats,
+        "http": http_clients.snapshot(),
+        "search_cache": search_cache.snapshot(),
+        "answer_cache": answer_cache.snapshot(),
+        "websocket": websocket_stats,
+        "batch": {
+            "max_concurrent_runs": AGENT_BATCH_MAX_CONCURRENT_RUNS,
+            **batch_stats,
+            "turn_writer": turn_writer.snapshot()
+        }
+    }
+
+# 既有的 stats 在 scrape 時才讀取，不需要在 request path 上另外計數
+metrics.callback("agent_search_cache_lookups_total", "knowledge_search cache lookups by result", "counter",
+                 lambda: [({ "result": result }, search_cache.stats[result]) for result in ("hits", "coalesced", "misses", "errors")])
+metrics.callback("agent_answer_cache_lookups_total", "Semantic answer cache lookups by result", "counter",
+                 lambda: [({ "result": "hits" }, answer_cache.stats["hits"]),
+                          ({ "result": "misses" }, answer_cache.stats["lookups"] - answer_cache.stats["hits"] - answer_cache.stats["errors"]),
+                          ({ "result": "errors" }, answer_cache.stats["errors"])])
+metrics.callback("agent_admission_active_runs", "Admitted agent runs per model", "gauge",
+                 lambda: [({ "model": model }, pool.active) for model, pool in agent_admission.pools.items()])
+metrics.callback("agent_admission_queue_depth", "Agent runs waiting for admission per model", "gauge",
+                 lambda: [({ "model": model }, pool.queue_depth) for model, pool in agent_admission.pools.items()])
+metrics.callback("agent_http_new_connections_total", "New upstream connections per HTTP client", "counter",
+                 lambda: [({ "client": name }, stats.new_connections) for name, stats in http_clients.stats.items()])
+metrics.callback("agent_http_requests_total", "Upstream requests per HTTP client", "counter",
+                 lambda: [({ "client": name }, stats.requests) for name, stats in http_clients.stats.items()])
+metrics.callback("agent_websocket_sessions", "Open WebSocket sessions", "gauge",
+                 lambda: [({}, websocket_stats["active_sessions"])])
+metrics.callback("agent_batch_active_runs", "Running batch agent runs", "gauge",
+                 lambda: [({}, batch_stats["active_runs"])])
+
+@router.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+class AgentBatchItem(BaseModel):
+    query: str
+    thread_id: str | None = None  # 沒有給的話每個 query 各自開新的 thread
+
+class AgentBatchRequest(BaseModel):
+    items: list[AgentBatchItem] = Field(min_length=1, max_length=AGENT_BATCH_MAX_ITEMS)
+
+@router.post("/api/v3/agent_batch")
+async def post_agent_batch(batch: AgentBatchRequest, request: Request):
+    # 每個 query 跑完就送出一行 JSON (NDJSON)，順序是完成的順序，用 index 對回原本的 query
+    user_id = current_user_id(request)
+
+    async def generate():
+        async with aclosing(run_agent_batch(batch.items, user_id)) as results:
+            async for result in results:
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+async def run_agent_batch(items: list[AgentBatchItem], user_id: int = 1):
+    """
+    以固定數量的 workers 執行批次 queries，依完成順序 yield 結果
+    同一個 thread_id 的 queries 由同一個 worker 依序執行 (後面的 query 會看到前面的對話)，不同 threads 之間平行執行
+    turns 交給 turn_writer 批次寫入
+    """
+    batch_stats["batches"] += 1
+    threads = OrderedDict()
+    for index, item in enumerate(items):
+        thread_id = item.thread_id or f"batch_{uuid.uuid4().hex}"
+        threads.setdefault(thread_id, []).append((index, item.query))
+
+    pending = deque(threads.items())
+    results = asyncio.Queue()
+
+    async def worker():
+        while pending:
+            thread_id, queries = pending.popleft()
+            # 不能把 turns 寫進別人的 thread
+            async with agent_store.connection(thread_id) as db:
+                owner = await get_thread_owner(db, thread_id)
+            if owner is not None and owner != user_id:
+                batch_stats["errors"] += len(queries)
+                for index, query in queries:
+                    results.put_nowait({ "index": index, "thread_id": thread_id, "query": query, "status": "error", "error": "thread_not_found", "latency_ms": 0 })
+                continue
+            for index, query in queries:
+                results.put_nowait(await run_batch_query(index, query, thread_id, user_id))
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(AGENT_BATCH_CONCURRENCY, len(threads)))]
+    try:
+        for _ in range(len(items)):
+            yield await results.get()
+    finally:
+        # client 斷線時停掉還在跑的 runs (已經產生的部分會存成 aborted turn)
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+async def run_batch_query(index: int, query: str, thread_id: str, user_id: int) -> dict:
+    started = time.perf_counter()
+    result = { "index": index, "thread_id": thread_id, "query": query }
+    answer, tools, following_questions = [], [], []
+
+    try:
+        async with batch_run_slots:
+            batch_stats["active_runs"] += 1
+            try:
+                async with aclosing(run_admitted_agent_v3(query, thread_id, user_id, writer=turn_writer)) as events:
+                    async for event in events:
+                        if "content" in event:
+                            answer.append(event["content"])
+                        elif "following_questions" in event:
+                            following_questions = event["following_questions"]
+                        elif event.get("message") == "CALL_TOOL":
+                            tools.append({ "tool_name": event["tool_name"], "arguments": event["arguments"] })
+            finally:
+                batch_stats["active_runs"] -= 1
+    except Exception as e:
+        # 一個 query 失敗不影響其他 queries
+        print(f"Batch query {index} failed: thread={thread_id} error={e!r}")
+        batch_stats["errors"] += 1
+        return { **result, "status": "error", "error": repr(e), "latency_ms": round((time.perf_counter() - started) * 1000) }
+
+    batch_stats["runs"] += 1
+    return {
+        **result,
+        "status": "ok",
+        "answer": "".join(answer),
+        "following_questions": following_questions,
+        "tools": tools,
+        "latency_ms": round((time.perf_counter() - started) * 1000)
+    }
+
+async def stream_run_events(run: AgentRun, after_seq: int | None, request: Request):
+    async for seq, event, data in run.subscribe(after_seq, request.is_disconnected):
+        yield sse_frame(data, run.event_id(seq))
 
-                if not result.final_output.allow:
-                    content = { "content": result.final_output.refusal_answer }
-                    yield f"data: {json.dumps(content)}\n\n"
+async def generate_agent_stream_v3(query: str, thread_id: str, user_id: int = 1):
+    """run_agent_v3 的 SSE 版本，直接綁在呼叫端上，不經過 run registry (benchmarks 使用)"""
+    async with aclosing(run_agent_v3(query, thread_id, user_id)) as events:
+        async for event in events:
+            yield f"data: {json.dumps(event)}\n\n"
+
+FOLLOW_UP_QUESTIONS_READY = object()  # 放進 lead agent event queue 的標記，follow-up questions task 完成了
+
+def buffer_stream_events(result, follow_up_questions_task: asyncio.Task | None = None) -> tuple[asyncio.Queue, asyncio.Task]:
+    """
+    在背景把 streamed run 的 events 收進 queue，樂觀模式下 guardrail 放行前先暫存不送出
+    follow_up_questions_task 完成時在 queue 放入 FOLLOW_UP_QUESTIONS_READY，和 lead agent 的 events 依完成順序交錯送出
+    """
+    event_queue = asyncio.Queue()
+    if follow_up_questions_task is not None:
+        follow_up_questions_task.add_done_callback(
+            lambda task: None if task.cancelled() else event_queue.put_nowait(FOLLOW_UP_QUESTIONS_READY)
+        )
+
+    async def pump():
+        try:
+            async for event in result.stream_events():
+                event_queue.put_nowait(event)
+        finally:
+            event_queue.put_nowait(None)
+
+    return event_queue, asyncio.create_task(pump())
+
+async def drain_buffered_events(event_queue: asyncio.Queue, pump_task: asyncio.Task):
+    while (event := await event_queue.get()) is not None:
+        yield event
+    await pump_task  # streaming 過程中的 exception 在這裡拋出
+
+def cancel_inflight_runs(inflight: dict):
+    """取消還沒結束的 lead agent run (進行中的 tool calls 會跟著被取消) 和其他背景 tasks"""
+    lead_result = inflight.get("lead_result")
+    if lead_result is not None and not lead_result.is_complete:
+        lead_result.cancel()
+
+    for key in ("guardrail_task", "lead_pump_task", "follow_up_questions_task"):
+        task = inflight.get(key)
+        if task is not None and not task.done():
+            task.cancel()
+
+def estimate_tokens_saved(tokens_used: int, context_tokens: int) -> int:
+    """
+    估計中止 run 省下的 tokens: 最近完成的 runs 的 total tokens 中位數減去中止前已經用掉的
+    還沒有完成過的 run 時，至少會省下再送一次 context 的 input tokens
+    """
+    typical_run_tokens = statistics.median(_completed_run_tokens) if _completed_run_tokens else context_tokens
+    return max(0, typical_run_tokens - tokens_used)
+
+async def persist_turn(thread_id: str, user_id: int, query: str, chunks_result: list, run_items: list, input_items: list, item_tokens: list, metadata: dict, writer: TurnWriter | None = None) -> tuple[list, int]:
+    """
+    儲存一輪對話，歷史 items 的 token 數已知，只需要計算這一輪新增的 items，回傳 (每個 item 的 token 數, turn id)
+    有 writer 時交給它和其他 turns 一起批次寫入
+    """
+    raw_items = [json.dumps(item) for item in run_items]
+    known_tokens = { json.dumps(item): tokens for item, tokens in zip(input_items, item_tokens) }
+    raw_items_tokens = await count_raw_items_tokens(raw_items, known_tokens)
+    if "total_tokens" not in metadata.get("last_token_usage", {}):
+        # 沒有收到 response.completed (中止、被擋下或 answer cache 重播): 用這一輪存下的 items 加上 lead agent tool schemas 估計 context 大小
+        # 不然下一輪的 previous_tokens_usage 會是 0，context editing 就不會修剪 (直接改 metadata，session 記下的也是這個值)
+        tools_tokens = await agent_registry.tools_tokens("lead")
+        metadata["last_token_usage"] = { "total_tokens": tools_tokens + sum(raw_items_tokens), "estimated": True }
+    with stage_seconds.time(stage="save_turn"):
+        if writer is not None:
+            turn_id = await writer.save(thread_id, user_id, query, chunks_result, raw_items, metadata, raw_items_tokens)
+        else:
+            async with agent_store.connection(thread_id) as db:
+                turn_id = await save_agent_turn(db, thread_id, user_id, query, chunks_result, raw_items, metadata, raw_items_tokens)
+    note_turn_saved(thread_id, turn_id)
+    return raw_items_tokens, turn_id
+
+async def run_agent_v3(query: str, thread_id: str, user_id: int = 1, admission: AdmissionTicket | None = None, session: AgentSession | None = None, client_key: str | None = None):
+    """
+    執行一輪對話，依序 yield 要送給 client 的 event dicts
+    先取得 lead agent model 的名額 (依 client_key 公平排隊)，排隊時先送 QUEUED event，排隊逾時或隊伍已滿就送 DONE (error=busy)
+    """
+    if admission is None:
+        try:
+            admission = agent_admission.reserve(LEAD_AGENT_MODEL, client_key)
+        except AdmissionRejected as e:
+            yield { "message": "DONE", "error": "busy", "reason": e.reason, "retry_after": e.retry_after }
+            return
+
+    try:
+        if not admission.admitted:
+            yield { "message": "QUEUED", "position": admission.position }
+            await admission.wait()
+
+        async with aclosing(run_admitted_agent_v3(query, thread_id, user_id, admission.wait_ms, session=session)) as events:
+            async for event in events:
+                yield event
+    except AdmissionRejected as e:
+        print(f"Agent run rejected: thread={thread_id} user={user_id} reason={e.reason}")
+        yield { "message": "DONE", "error": "busy", "reason": e.reason, "retry_after": e.retry_after }
+    finally:
+        admission.release()
+
+async def run_admitted_agent_v3(query: str, thread_id: str, user_id: int, admission_wait_ms: int = 0, writer: TurnWriter | None = None, session: AgentSession | None = None):
+    request_started = time.perf_counter() - admission_wait_ms / 1000  # ttft 包含排隊時間
+
+    # agents 在啟動時就建立好了 (agent_registry)，每個 request 共用
+    lead_agent = agent_registry.get("lead")
+
+    with stage_seconds.time(stage="history_load"):
+        if session is not None:
+            # WebSocket session: 歷史對話、metadata 和 rolling summary 已經在記憶體內，不用再讀資料庫
+            input_items, previous_metadata, item_tokens = await session.history()
+            thread_metadata, turn_count, thread_summary = session.thread_metadata, session.turn_count, session.thread_summary
+        else:
+            # 從資料庫讀取歷史對話 (依 thread_id 路由到對應的 shard，讀完就把 connection 還回 pool)
+            async with agent_store.connection(thread_id) as db:
+                input_items, previous_metadata, item_tokens = await get_previous_items(db, thread_id)
+                thread_summary = await get_thread_summary(db, thread_id) if CONTEXT_COMPACTION_MODE == "summary" else None
+                # 上一輪結束後在背景抽取的 metadata，lead agent 不需要等
+                thread_metadata = await get_thread_metadata(db, thread_id)
+                turn_count = await count_thread_turns(db, thread_id)
+
+    # 如果有歷史對話，進行 context editing
+    if input_items:
+        print(f"previous_metadata: {previous_metadata}")
+        previous_tokens_usage = previous_metadata.get("last_token_usage", {}).get("total_tokens", 0)
+        with stage_seconds.time(stage="context_editing"):
+            input_items, item_tokens = await context_editing(input_items, previous_tokens_usage, item_tokens, thread_summary)
+
+    custom_agent_context = CustomAgentContext(search_source={})
+
+    # 同一個 thread 固定使用同一個 prompt_cache_key，提高 provider prefix cache 的命中率
+    run_config = RunConfig(model_settings=ModelSettings(extra_args={ "prompt_cache_key": prompt_cache_key_for_thread(thread_id) }))
+
+    today_date = datetime.now().strftime("%Y-%m-%d")
+    ttft_ms = None  # 從收到 request 到送出第一個 content delta 的時間
+    chunks_result = []
+    partial_deltas = []  # 還沒收到 message_output_item 的文字，中止時存成部分回答
+    tags = []
+    last_token_usage = {}
+    guardrail_info = None
+    follow_up_questions_info = None
+    answer_cache_info = None
+    answer_match = None
+    turn_saved = False
+
+    # 進行中的 runs / tasks，run 被中止時一起取消
+    inflight = {}
+
+    def on_turn_saved(run_items: list, raw_items_tokens: list, turn_id: int, metadata: dict, token_usage=None):
+        if ttft_ms is not None:
+            stage_seconds.observe(ttft_ms / 1000, stage="ttft")
+        turns_total.inc(status="answer_cache" if "answer_cache" in tags else "blocked" if "gg" in tags else "ok")
+        if token_usage is not None:
+            tokens_total.inc(token_usage.input_tokens, kind="input")
+            tokens_total.inc(token_usage.input_tokens_details.cached_tokens, kind="cached_input")
+            tokens_total.inc(token_usage.output_tokens, kind="output")
+            tokens_total.inc(token_usage.output_tokens_details.reasoning_tokens, kind="reasoning")
+
+        refresh_metadata = needs_metadata_refresh(thread_metadata, turn_count + 1, query)
+        if session is not None:
+            session.record_turn(turn_id, run_items, raw_items_tokens, metadata, token_usage)
+
+        # 第一輪、每 N 輪或換話題時，在背景重新抽取 metadata，下一輪使用
+        if refresh_metadata:
+            refresh_task = run_in_background(refresh_conversation_metadata(thread_id, query, turn_count + 1))
+            if session is not None:
+                session.track_metadata_refresh(refresh_task, query)
+
+    def turn_metadata(**extra) -> dict:
+        return {
+            #"token_usage": asdict(token_usage),
+            "last_token_usage": last_token_usage,
+            "context_compaction": {
+                "mode": CONTEXT_COMPACTION_MODE,
+                "has_summary": bool(input_items) and is_summary_item(input_items[0]),
+                "trim_policy": CONTEXT_TRIM_POLICY
+            },
+            "speculative_lead_agent": SPECULATIVE_LEAD_AGENT,
+            "ttft_ms": ttft_ms,
+            "admission_wait_ms": admission_wait_ms,
+            "guardrail": guardrail_info,
+            "follow_up_questions": follow_up_questions_info,
+            "answer_cache": answer_cache_info,
+            "tags": tags,
+            **extra
+        }
+
+    with braintrust_logger.start_span(name="agent_v3") as braintrust_span:
+        with trace("FastAPI Agent v3", trace_id=f"trace_{thread_id}"):
+
+            braintrust_span.log(input={ "query": query },
+                                metadata={ "thread_id": thread_id })
+
+            query_input_items = input_items + [{ "role": "user", "content": query }]
+
+            try:
+                # 沒有歷史對話的第一輪先查 answer cache，命中就直接重播快取的回答 (快取裡都是 guardrail 放行過的回答)
+                if ANSWER_CACHE_ENABLED and not input_items:
+                    answer_match = await answer_cache.lookup(query)
+                    answer_cache_info = { "hit": answer_match.entry is not None, "similarity": round(answer_match.similarity, 4) }
+
+                    if answer_match.entry is not None:
+                        entry = answer_match.entry
+                        ttft_ms = round((time.perf_counter() - request_started) * 1000)
+                        answer_cache_info.update(cached_query=entry.query, entry_hits=entry.hits)
+                        tags.append("answer_cache")
+
+                        for data in entry.events:
+                            yield data
+                            chunks_result.append(data)
+
+                        done_event = { "message": "DONE" }
+                        chunks_result.append(done_event)
+
+                        run_items = query_input_items + [{ "role": "assistant", "content": entry.answer }]
+                        metadata = turn_metadata()
+                        raw_items_tokens, turn_id = await persist_turn(thread_id, user_id, query, chunks_result, run_items, input_items, item_tokens, metadata, writer)
+                        turn_saved = True
+                        on_turn_saved(run_items, raw_items_tokens, turn_id, metadata)
+
+                        braintrust_span.log(output={ "chunks": chunks_result }, tags=tags, metadata={ "answer_cache": answer_cache_info, "ttft_ms": ttft_ms })
+                        yield done_event
+                        return
+
+                # guardrail 在背景檢查，樂觀模式下 lead agent 不等 guardrail 就開始跑
+                guardrail_task = asyncio.create_task( check_input_guardrail(input_items, query, run_config) )
+                inflight["guardrail_task"] = guardrail_task
+                extract_conversation_metadata_data = thread_metadata["metadata"] if thread_metadata else {}
+
+                agent_input_items = input_items + [ { "role": "user", "content": f"""
+                Today's date: {today_date}
+                User background: <data>{extract_conversation_metadata_data}</data>
+                User Query: <query>{query}</query>
+                """ } ]
+
+                if SPECULATIVE_LEAD_AGENT:
+                    inflight["follow_up_questions_task"] = asyncio.create_task( generate_followup_questions(query, run_config) )
+                    inflight["lead_result"] = Runner.run_streamed(lead_agent, input=agent_input_items, context=custom_agent_context, run_config=run_config)
+                    lead_started = time.perf_counter()
+                    lead_event_queue, inflight["lead_pump_task"] = buffer_stream_events(inflight["lead_result"], inflight["follow_up_questions_task"])
+
+                guardrail_verdict, guardrail_info = await guardrail_task
+
+                if not guardrail_verdict.allow:
+                    if "lead_result" in inflight:
+                        # guardrail 擋下來了，取消已經開始的 lead agent，暫存的輸出全部丟掉
+                        cancel_inflight_runs(inflight)
+                        await asyncio.gather(inflight["lead_pump_task"], inflight["follow_up_questions_task"], return_exceptions=True)
+                        inflight.clear()
+                        print("Speculative lead agent cancelled by guardrail")
+
+                    content = { "content": guardrail_verdict.refusal_answer }
+                    yield content
                     chunks_result.append(content)
                     tags.append("gg")
+
+                    run_items = query_input_items + [{ "role": "assistant", "content": guardrail_verdict.refusal_answer }]
+                    token_usage = None
                 else:
 
-                    agent_input_items = input_items + [ { "role": "user", "content": f"""
-                    Today's date: {today_date}
-                    User background: <data>{extract_conversation_metadata_data}</data>
-                    User Query: <query>{query}</query>
-                    """ } ]
+                    if "lead_result" not in inflight:
+                        # fire async task for follow-up questions
+                        inflight["follow_up_questions_task"] = asyncio.create_task( generate_followup_questions(query, run_config) )
 
-                    # fire async task for follow-up questions
-                    follow_up_questions_task = asyncio.create_task(
-                        Runner.run(extract_followup_questions_agent, input=agent_input_items)
-                    )
+                        inflight["lead_result"] = Runner.run_streamed(lead_agent, input=agent_input_items, context=custom_agent_context, run_config=run_config)
+                        lead_started = time.perf_counter()
+                        lead_event_queue, inflight["lead_pump_task"] = buffer_stream_events(inflight["lead_result"], inflight["follow_up_questions_task"])
+                    # 樂觀模式下 guardrail 放行時，先送出暫存的 events，之後的 events 直接轉送
+                    lead_events = drain_buffered_events(lead_event_queue, inflight["lead_pump_task"])
 
-                    result = Runner.run_streamed(lead_agent, input=agent_input_items, context=custom_agent_context)
+                    result = inflight["lead_result"]
+                    follow_up_questions_sent = False
+                    streamed_think_parts = set()  # 已經送過 THINK_DELTA 的 (reasoning item id, summary index)
 
-                    async for event in result.stream_events():
+                    async for event in lead_events:
                         #print(event)
 
-                        if event.type == "raw_response_event" and event.data.type == "response.output_text.delta":
+                        if event is FOLLOW_UP_QUESTIONS_READY:
+                            # follow-up questions 一完成就送出，不用等 lead agent 結束
+                            follow_up_questions_sent = True
+                            questions, follow_up_questions_info = inflight["follow_up_questions_task"].result()
+                            if questions:
+                                data = { "following_questions": questions }
+                                yield data
+                                chunks_result.append(data)
+
+                        elif event.type == "raw_response_event" and event.data.type == "response.output_text.delta":
                             #print(event.data.delta)
                             data = { "content": event.data.delta }
-                            yield f"data: {json.dumps(data)}\n\n"
+                            partial_deltas.append(event.data.delta)
+                            if ttft_ms is None:
+                                ttft_ms = round((time.perf_counter() - request_started) * 1000)
+                            yield data
 
                         elif event.type == "raw_response_event" and event.data.type == "response.output_item.added" and event.data.item.type == "reasoning":
                             think_chunk = {
                                 "message": "THINK_START",
                             }
-                            yield f"data: {json.dumps(think_chunk)}\n\n"
+                            yield think_chunk
                             chunks_result.append(think_chunk)
+                        elif event.type == "raw_response_event" and event.data.type == "response.reasoning_summary_text.delta":
+                            # 思考摘要邊產生邊送出 (和回答的 deltas 一樣會被合併成較少的 frames)
+                            think_part = (event.data.item_id, event.data.summary_index)
+                            text = event.data.delta
+                            if think_part not in streamed_think_parts:
+                                if event.data.summary_index > 0:
+                                    text = "\n\n" + text  # 同一段思考的下一個摘要段落
+                                streamed_think_parts.add(think_part)
+                            yield { "message": "THINK_DELTA", "text": text }
                         elif event.type == "raw_response_event"  and event.data.type == "response.reasoning_summary_text.done":
                             think_chunk = {
                                 "message": "THINK_TEXT",
                                 "text": event.data.text
                             }
-                            yield f"data: {json.dumps(think_chunk)}\n\n"
+                            # 已經用 THINK_DELTA 送過的摘要不再重送，資料庫裡仍然存完整的 THINK_TEXT
+                            if (event.data.item_id, event.data.summary_index) not in streamed_think_parts:
+                                yield think_chunk
                             chunks_result.append(think_chunk)
                         elif event.type == "raw_response_event" and event.data.type == "response.completed":
                             print("completed")
@@ -124,7 +630,13 @@ async def generate_agent_stream_v3(query: str, thread_id: str, user_id: int = 1)
                                 "output_tokens": event.data.response.usage.output_tokens,
                                 "reasoning_tokens": event.data.response.usage.output_tokens_details.reasoning_tokens,
                                 "total_tokens": event.data.response.usage.total_tokens,
-                                "prompt_cache_hit_ratio": last_prompt_cache_hit_ratio
+                                "prompt_cache_hit_ratio": last_prompt_cache_hit_ratio,
+                                "estimated_cost_usd": estimate_cost_usd(
+                                    lead_agent.model,
+                                    event.data.response.usage.input_tokens,
+                                    event.data.response.usage.input_tokens_details.cached_tokens,
+                                    event.data.response.usage.output_tokens
+                                )
                             }
 
                         elif event.type == "run_item_stream_event":
@@ -139,7 +651,7 @@ async def generate_agent_stream_v3(query: str, thread_id: str, user_id: int = 1)
                                 elif event.item.raw_item.type == "file_search_call": # build-in tool
                                     tool_data = {'message': 'CALL_TOOL', 'tool_name': 'file_search_call', 'arguments': event.item.raw_item.queries }
 
-                                yield f"data: {json.dumps(tool_data)}\n\n"
+                                yield tool_data
                                 chunks_result.append(tool_data)
 
                             elif event.item.type == "tool_call_output_item":
@@ -149,32 +661,83 @@ async def generate_agent_stream_v3(query: str, thread_id: str, user_id: int = 1)
                             elif event.item.type == "message_output_item":
                                 data = { "content": ItemHelpers.text_message_output(event.item) }
                                 chunks_result.append(data)
+                                partial_deltas.clear()
                             else:
                                 pass  # Ignore other event types
 
-                    follow_up_questions_result = await follow_up_questions_task
-                    questions = follow_up_questions_result.final_output_as(ExtractFollowupQuestionsResult).followup_questions
-                    data = { "following_questions": questions }
+                    stage_seconds.observe(time.perf_counter() - lead_started, stage="lead_agent")
+
+                    if not follow_up_questions_sent:
+                        # lead agent 先結束了，最多再等到 follow-up questions 的 time budget
+                        questions, follow_up_questions_info = await inflight["follow_up_questions_task"]
+                        if questions:
+                            data = { "following_questions": questions }
+                            yield data
+                            chunks_result.append(data)
 
-                    yield f"data: {json.dumps(data)}\n\n"
-                    chunks_result.append(data)
+                    run_items = result.to_input_list()
+                    token_usage = result.context_wrapper.usage
 
                 done_event = { "message": "DONE" }
                 chunks_result.append(done_event)
 
                 # 儲存對話到資料庫
-                raw_items = [json.dumps(item) for item in result.to_input_list()]
-                token_usage = result.context_wrapper.usage
-                metadata = {
-                    #"token_usage": asdict(token_usage),
-                    "last_token_usage": last_token_usage,
-                    "tags": tags
-                }
-                await save_agent_turn(db, thread_id, user_id, query, chunks_result, raw_items, metadata)
-
-                braintrust_span.log(output={ "chunks": chunks_result }, tags=tags, metadata={ "total_token_usage": token_usage, "last_token_usage": last_token_usage })
-
-                yield f"data: {json.dumps(done_event)}\n\n" # 這會讓前端終止 streaming，結束整個 streaming response
-
-        print(f"total_token_usage: {result.context_wrapper.usage}")
-        print(f"last_token_usage: {last_token_usage}")
+                metadata = turn_metadata()
+                raw_items_tokens, turn_id = await persist_turn(thread_id, user_id, query, chunks_result, run_items, input_items, item_tokens, metadata, writer)
+                turn_saved = True
+                on_turn_saved(run_items, raw_items_tokens, turn_id, metadata, token_usage)
+                if token_usage is not None:
+                    _completed_run_tokens.append(token_usage.total_tokens)
+
+                # 放行的第一輪存進 answer cache，之後相似的第一個問題可以直接重播
+                if answer_match is not None and guardrail_verdict.allow:
+                    answer = "".join(chunk["content"] for chunk in chunks_result if "content" in chunk)
+                    events = [{ "content": answer }] + [chunk for chunk in chunks_result if "following_questions" in chunk]
+                    answer_cache.store(answer_match, query, answer, events)
+
+                # summary 模式下，在背景更新 rolling summary，下一輪就能直接使用
+                if CONTEXT_COMPACTION_MODE == "summary":
+                    summary_task = run_in_background(summarize_thread_history(thread_id))
+                    if session is not None:
+                        session.track_summary(summary_task)
+
+                braintrust_span.log(output={ "chunks": chunks_result }, tags=tags, metadata={ "total_token_usage": token_usage, "last_token_usage": last_token_usage, "ttft_ms": ttft_ms })
+
+                yield done_event # 這會讓前端終止 streaming，結束整個 streaming response
+
+            except (asyncio.CancelledError, GeneratorExit, Exception) as e:
+                # run 被中止 (沒有 client 連著超過 grace period，或 server 關閉)，或中途發生錯誤 (guardrail、lead agent stream...):
+                # 停掉 lead agent / tool calls / follow-up questions，不然它們會在 request 結束後繼續花 tokens，把已經產生的部分存成 aborted turn
+                cancel_inflight_runs(inflight)
+                failed = isinstance(e, Exception)
+
+                if not turn_saved:
+                    lead_result = inflight.get("lead_result")
+                    tokens_used = lead_result.context_wrapper.usage.total_tokens if lead_result is not None else 0
+                    tokens_saved = estimate_tokens_saved(tokens_used, sum(item_tokens))
+                    turns_total.inc(status="error" if failed else "aborted")
+                    if not failed:
+                        disconnect_stats["aborted_runs"] += 1
+                        disconnect_stats["tokens_used_before_abort"] += tokens_used
+                        disconnect_stats["estimated_tokens_saved"] += tokens_saved
+                    print(f"Agent run {'failed' if failed else 'aborted'}: thread={thread_id} tokens_used={tokens_used} estimated_tokens_saved={tokens_saved} error={e!r}")
+
+                    if partial_deltas:
+                        chunks_result.append({ "content": "".join(partial_deltas) })
+                    chunks_result.append({ "message": "ABORTED" })
+                    tags.append("error" if failed else "aborted")
+
+                    run_items = lead_result.to_input_list() if lead_result is not None else query_input_items
+                    extra = { "error": repr(e) } if failed else {}
+                    metadata = turn_metadata(aborted=True, tokens_used_before_abort=tokens_used, estimated_tokens_saved=tokens_saved, **extra)
+                    # generator 已經被取消 (或正在拋出錯誤)，不能再 await，改在背景儲存
+                    persist_task = run_in_background(persist_turn(thread_id, user_id, query, chunks_result, run_items, input_items, item_tokens, metadata, writer))
+                    if session is not None:
+                        session.invalidate(persist_task)
+                    braintrust_span.log(output={ "chunks": chunks_result }, tags=tags, metadata={ "aborted": True, "estimated_tokens_saved": tokens_saved, **extra })
+
+                # 錯誤往上拋，由 agent_runs (DONE error) 或 batch 的 run_batch_query 回報給 client
+                raise
+
+    print(f"total_token_usage: {token_usage}")
+    print(f"last_token_usage: {last_token_usage}")
@@ -2,13 +2,22 @@ from fastapi import APIRouter
 from fastapi.responses import StreamingResponse
 import json
 import asyncio
+import time
+
+from sse import coalesce_deltas, encode_json, sse_frame, SSE_COALESCE_WINDOW_MS, SSE_COALESCE_MAX_BYTES
 
 router = APIRouter()
 
 # For SSE testing, send fake SSE messages
+# mode=per_token / coalesced 模擬 model 逐 token 輸出，最後的 DONE 訊息附上 frames/sec 和 CPU 時間，用來比較兩種做法
 @router.get("/api/test-sse")
-async def test_sse():
-    response = StreamingResponse(generate_test_sse(), media_type="text/event-stream")
+async def test_sse(mode: str | None = None, duration: float = 60, interval: float = 0.05, token: str = "tok "):
+    if mode in ("per_token", "coalesced"):
+        content = generate_delta_test_sse(mode, duration, interval, token)
+    else:
+        content = generate_test_sse()
+
+    response = StreamingResponse(content, media_type="text/event-stream")
     response.headers["X-Accel-Buffering"] = "no"
     return response
 
@@ -31,3 +40,45 @@ async def generate_test_sse():
         "total_messages": iterations
     }
     yield f"data: {json.dumps(final_message)}\n\n"
+
+async def fake_token_deltas(duration: float, interval: float, token: str):
+    """模擬 response.output_text.delta，每 interval 秒一個 token"""
+    iterations = int(duration / interval)
+    for _ in range(iterations):
+        yield { "content": token }
+        await asyncio.sleep(interval)
+
+async def generate_delta_test_sse(mode: str, duration: float, interval: float, token: str):
+    started = time.perf_counter()
+    cpu_started = time.process_time()  # 整個 process 的 CPU 時間，測試時請避免同時有其他流量
+    frames = 0
+    total_bytes = 0
+
+    if mode == "per_token":
+        # 舊做法: 每個 delta 一個 frame，每個 frame 都用 json.dumps
+        async for event in fake_token_deltas(duration, interval, token):
+            frame = f"data: {json.dumps(event)}\n\n"
+            frames += 1
+            total_bytes += len(frame)
+            yield frame
+    else:
+        async for event in coalesce_deltas(fake_token_deltas(duration, interval, token)):
+            frame = sse_frame(encode_json(event))
+            frames += 1
+            total_bytes += len(frame)
+            yield frame
+
+    elapsed = time.perf_counter() - started
+    final_message = {
+        "type": "DONE",
+        "mode": mode,
+        "coalesce_window_ms": SSE_COALESCE_WINDOW_MS if mode == "coalesced" else 0,
+        "coalesce_max_bytes": SSE_COALESCE_MAX_BYTES if mode == "coalesced" else 0,
+        "tokens": int(duration / interval),
+        "frames": frames,
+        "bytes": total_bytes,
+        "seconds": round(elapsed, 3),
+        "frames_per_second": round(frames / elapsed, 1) if elapsed else 0,
+        "cpu_seconds": round(time.process_time() - cpu_started, 4)
+    }
+    yield f"data: {json.dumps(final_message)}\n\n"
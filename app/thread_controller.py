@@ -0,0 +1,84 @@
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import Response
+import base64
+import hashlib
+import json
+
+from agent_core import get_thread_owner, list_user_threads, list_thread_turns
+from agent_store import agent_store
+from identity import current_user_id
+
+router = APIRouter()
+
+MAX_PAGE_SIZE = 100
+
+def encode_cursor(*parts: int) -> str:
+    return base64.urlsafe_b64encode(":".join(str(p) for p in parts).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, size: int) -> list[int]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        parts = [int(p) for p in base64.urlsafe_b64decode(padded).decode().split(":")]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if len(parts) != size:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return parts
+
+def etag_response(request: Request, content: dict) -> Response:
+    """
+    回傳 JSON 並附上 ETag，如果 client 帶的 If-None-Match 相同就直接回 304，不重送 body
+    """
+    body = json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    etag = f'W/"{hashlib.sha1(body).hexdigest()}"'
+    headers = { "ETag": etag, "Cache-Control": "private, no-cache" }
+
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@router.get("/api/threads")
+async def get_threads(request: Request, cursor: str | None = None, limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE)):
+    user_id = current_user_id(request)
+    # threads 分散在不同 shards，排序鍵是 (id, shard)，cursor 記錄上一頁最後一筆的 (id, shard)
+    cursor_id, cursor_shard = decode_cursor(cursor, 2) if cursor else (None, None)
+
+    threads = []
+    for shard in range(agent_store.num_shards):
+        before_id = cursor_id
+        if cursor_id is not None and shard < cursor_shard:
+            before_id = cursor_id + 1  # 同一個 id 在較小的 shard 排在 cursor 之後
+
+        async with agent_store.shard_connection(shard) as db:
+            rows = await list_user_threads(db, user_id, before_id=before_id, limit=limit + 1)
+
+        threads.extend((row["id"], shard, row) for row in rows)
+
+    threads.sort(key=lambda x: (x[0], x[1]), reverse=True)
+    page = threads[:limit]
+    next_cursor = encode_cursor(page[-1][0], page[-1][1]) if len(threads) > limit else None
+
+    return etag_response(request, {
+        "threads": [row for _, _, row in page],
+        "next_cursor": next_cursor
+    })
+
+@router.get("/api/threads/{thread_id}/turns")
+async def get_thread_turns(request: Request, thread_id: str, cursor: str | None = None, limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE)):
+    after_id = decode_cursor(cursor, 1)[0] if cursor else None
+
+    async with agent_store.connection(thread_id) as db:
+        # 只回傳自己的 thread，別人的 thread 和不存在的一樣回 404 (不透露 thread 是否存在)
+        if await get_thread_owner(db, thread_id) != current_user_id(request):
+            raise HTTPException(status_code=404, detail="Thread not found")
+        rows = await list_thread_turns(db, thread_id, after_id=after_id, limit=limit + 1)
+
+    page = rows[:limit]
+    next_cursor = encode_cursor(page[-1]["id"]) if len(rows) > limit else None
+
+    return etag_response(request, {
+        "thread_id": thread_id,
+        "turns": page,
+        "next_cursor": next_cursor
+    })
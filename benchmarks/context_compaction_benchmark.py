@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Benchmark: input tokens and latency per turn, trim vs summary context compaction.
+
+The same scripted conversation is sent through generate_agent_stream_v3 once with
+CONTEXT_COMPACTION_MODE=trim and once with CONTEXT_COMPACTION_MODE=summary. Each
+mode runs in its own subprocess against a throwaway database. Thresholds are scaled
+down by --scale so trimming and summarizing kick in after a few turns. Background
+summaries are awaited between turns, like a user reading the answer before asking
+the next question.
+
+This calls the real OpenAI and Tavily APIs, so .env must be set up.
+
+Usage:
+  uv run python benchmarks/context_compaction_benchmark.py --turns 10 --scale 0.1
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+QUERIES = [
+    "請問0050這幾年報酬率大概多少?",
+    "那0056呢？跟0050比起來哪個比較適合存股？",
+    "最近台積電配息多少，有建議長期持有嗎?",
+    "台積電最新一季的財報重點是什麼？",
+    "美國聯準會最近的利率決策對台股有什麼影響？",
+    "定存現在利率多少，跟買債券ETF比起來如何？",
+    "如果每月存5000元，想存到第一桶金大概要多久？",
+    "剛剛提到的債券ETF，有哪幾檔比較多人買？",
+    "聯發科和台積電的本益比各是多少？",
+    "幫我整理一下前面聊到的 0050、0056 報酬率數字",
+    "根據前面討論，如果我風險承受度低，你會怎麼配置？",
+    "最早我問的第一個問題是什麼？當時的答案是多少？",
+]
+
+
+async def run_conversation(turns: int, scale: float) -> list:
+    sys.path.insert(0, ROOT_DIR)
+    os.chdir(ROOT_DIR)
+
+    from dotenv import load_dotenv
+    load_dotenv(".env", override=True)
+
+    import agent_core
+    import context_summary
+    from migrate_agent_db import migrate_all
+    from agent_store import agent_store
+    from app.agent_controller import generate_agent_stream_v3
+
+    # Scale thresholds down so compaction happens within a short conversation
+    agent_core.TOOL_CALL_OUTPUT_TRIM_THRESHOLD = int(agent_core.TOOL_CALL_OUTPUT_TRIM_THRESHOLD * scale)
+    agent_core.TURN_BASED_TRIM_THRESHOLD = int(agent_core.TURN_BASED_TRIM_THRESHOLD * scale)
+    agent_core.TURN_BASED_TARGET_TOKENS = int(agent_core.TURN_BASED_TARGET_TOKENS * scale)
+    context_summary.SUMMARY_TRIGGER_TOKENS = int(context_summary.SUMMARY_TRIGGER_TOKENS * scale)
+    context_summary.SUMMARY_KEEP_TOKENS = int(context_summary.SUMMARY_KEEP_TOKENS * scale)
+
+    migrate_all()
+
+    thread_id = f"bench_{agent_core.CONTEXT_COMPACTION_MODE}_{int(time.time())}"
+    results = []
+
+    for i, query in enumerate((QUERIES * 2)[:turns]):
+        started = time.perf_counter()
+        first_token = None
+        async for frame in generate_agent_stream_v3(query, thread_id):
+            if first_token is None and '"content"' in frame:
+                first_token = time.perf_counter() - started
+        latency = time.perf_counter() - started
+
+        summary_started = time.perf_counter()
+        await agent_core.wait_background_tasks()
+        summary_seconds = time.perf_counter() - summary_started
+
+        async with agent_store.connection(thread_id) as db:
+            async with db.execute(
+                "SELECT metadata FROM agent_turns WHERE thread_id = ? ORDER BY id DESC LIMIT 1", (thread_id,)
+            ) as cursor:
+                metadata = json.loads((await cursor.fetchone())[0])
+
+        usage = metadata.get("last_token_usage", {})
+        results.append({
+            "turn": i + 1,
+            "input_tokens": usage.get("input_tokens", 0),
+            "cached_tokens": usage.get("cached_tokens", 0),
+            "latency": round(latency, 2),
+            "ttft": round(first_token or latency, 2),
+            "background_summary_seconds": round(summary_seconds, 2),
+            "has_summary": metadata.get("context_compaction", {}).get("has_summary", False),
+        })
+
+    await agent_store.close()
+    return results
+
+
+def print_report(mode: str, results: list):
+    print(f"\n=== CONTEXT_COMPACTION_MODE={mode} ===")
+    print(f"{'turn':>4} {'input_tokens':>13} {'cached':>8} {'latency(s)':>11} {'ttft(s)':>8} {'summary(s)':>11} {'summary?':>9}")
+    for r in results:
+        print(f"{r['turn']:>4} {r['input_tokens']:>13} {r['cached_tokens']:>8} {r['latency']:>11} {r['ttft']:>8} "
+              f"{r['background_summary_seconds']:>11} {str(r['has_summary']):>9}")
+
+    total_input = sum(r["input_tokens"] for r in results)
+    avg_latency = sum(r["latency"] for r in results) / len(results)
+    print(f"total input tokens: {total_input}, avg latency: {avg_latency:.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare trim and summary context compaction")
+    parser.add_argument("--turns", type=int, default=len(QUERIES))
+    parser.add_argument("--scale", type=float, default=0.1, help="Multiply all compaction thresholds by this factor")
+    parser.add_argument("--child", choices=["trim", "summary"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(asyncio.run(run_conversation(args.turns, args.scale))))
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ("trim", "summary"):
+            env = {
+                **os.environ,
+                "CONTEXT_COMPACTION_MODE": mode,
+                "AGENT_DB_PATH": os.path.join(tmp, f"agent_{mode}.db"),
+                "AGENT_DB_SHARDS": "1",
+                "AGENT_DB_COMPACTION_INTERVAL": "0",
+            }
+            proc = subprocess.run(
+                [sys.executable, __file__, "--child", mode, "--turns", str(args.turns), "--scale", str(args.scale)],
+                env=env, capture_output=True, text=True, check=True
+            )
+            print_report(mode, json.loads(proc.stdout.strip().splitlines()[-1]))
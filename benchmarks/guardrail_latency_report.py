@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Report: input guardrail latency by history length.
+
+Every turn saved by generate_agent_stream_v3 records how its guardrail verdict
+was obtained (GUARDRAIL_MODE=full, incremental, or the verdict cache), the number
+of earlier user turns in the thread and the guardrail latency. Run the server
+for a while with GUARDRAIL_MODE=full, then with the default incremental mode,
+and compare how latency grows with thread length.
+
+Usage:
+  uv run python benchmarks/guardrail_latency_report.py
+"""
+import asyncio
+import json
+import os
+import statistics
+import sys
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from agent_store import agent_store
+
+# (label, min history turns, max history turns)
+HISTORY_BUCKETS = [("0", 0, 0), ("1-2", 1, 2), ("3-5", 3, 5), ("6-10", 6, 10), ("11+", 11, None)]
+
+
+def bucket_for(history_turns: int) -> str:
+    for label, low, high in HISTORY_BUCKETS:
+        if history_turns >= low and (high is None or history_turns <= high):
+            return label
+
+
+async def collect() -> dict:
+    latencies = defaultdict(list)  # (source, bucket) -> [latency_ms]
+
+    for shard in range(agent_store.num_shards):
+        async with agent_store.shard_connection(shard) as db:
+            async with db.execute("SELECT metadata FROM agent_turns WHERE metadata IS NOT NULL") as cursor:
+                rows = await cursor.fetchall()
+
+        for (metadata_str,) in rows:
+            guardrail = json.loads(metadata_str).get("guardrail")
+            if not guardrail:
+                continue
+            latencies[(guardrail["source"], bucket_for(guardrail["history_turns"]))].append(guardrail["latency_ms"])
+
+    await agent_store.close()
+    return latencies
+
+
+def percentile(values: list, p: float) -> int:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def print_report(latencies: dict):
+    print(f"{'source':<12} {'history':>8} {'turns':>6} {'p50 ms':>8} {'p95 ms':>8} {'mean ms':>8}")
+    for source in sorted({source for source, _ in latencies}):
+        for label, _, _ in HISTORY_BUCKETS:
+            values = latencies.get((source, label))
+            if not values:
+                continue
+            print(f"{source:<12} {label:>8} {len(values):>6} {percentile(values, 0.5):>8} {percentile(values, 0.95):>8} "
+                  f"{statistics.mean(values):>8.0f}")
+
+
+if __name__ == "__main__":
+    print_report(asyncio.run(collect()))
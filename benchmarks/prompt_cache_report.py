@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Report: prompt cache hit ratio and estimated cost per turn, by context trim policy.
+
+Every turn saved by generate_agent_stream_v3 records the lead agent's token usage
+and the CONTEXT_TRIM_POLICY that was active. Run the server for a while with
+CONTEXT_TRIM_POLICY=legacy, then with the default cache_aware policy, and compare.
+Only turns with a deep enough history are counted (--min-input-tokens), because
+short conversations never reach the trimming thresholds.
+
+Usage:
+  uv run python benchmarks/prompt_cache_report.py --min-input-tokens 100000
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from agent_store import agent_store
+from utils import estimate_cost_usd
+
+
+async def collect(min_input_tokens: int) -> dict:
+    stats = defaultdict(lambda: {"turns": 0, "input_tokens": 0, "cached_tokens": 0, "cost": 0.0})
+
+    for shard in range(agent_store.num_shards):
+        async with agent_store.shard_connection(shard) as db:
+            async with db.execute("SELECT metadata FROM agent_turns WHERE metadata IS NOT NULL") as cursor:
+                rows = await cursor.fetchall()
+
+        for (metadata_str,) in rows:
+            metadata = json.loads(metadata_str)
+            usage = metadata.get("last_token_usage") or {}
+            if usage.get("input_tokens", 0) < min_input_tokens:
+                continue
+
+            # 舊的 turns 沒有記錄 policy，當時的行為就是 legacy
+            policy = metadata.get("context_compaction", {}).get("trim_policy", "legacy")
+            s = stats[policy]
+            s["turns"] += 1
+            s["input_tokens"] += usage["input_tokens"]
+            s["cached_tokens"] += usage.get("cached_tokens", 0)
+            s["cost"] += usage.get("estimated_cost_usd") or estimate_cost_usd(
+                "gpt-5-mini", usage["input_tokens"], usage.get("cached_tokens", 0), usage.get("output_tokens", 0)
+            )
+
+    await agent_store.close()
+    return stats
+
+
+def print_report(stats: dict):
+    print(f"{'policy':<12} {'turns':>6} {'avg input':>10} {'cache hit %':>12} {'cost/turn (USD)':>16}")
+    for policy, s in sorted(stats.items()):
+        hit_ratio = s["cached_tokens"] / s["input_tokens"] * 100 if s["input_tokens"] else 0
+        print(f"{policy:<12} {s['turns']:>6} {s['input_tokens'] // s['turns']:>10} {hit_ratio:>12.2f} {s['cost'] / s['turns']:>16.6f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare prompt cache hit ratio and cost per turn by trim policy")
+    parser.add_argument("--min-input-tokens", type=int, default=0, help="Only count turns with at least this many input tokens")
+    args = parser.parse_args()
+
+    print_report(asyncio.run(collect(args.min_input_tokens)))
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Benchmark: time-to-first-token with and without the speculative lead agent.
+
+Each query is sent through generate_agent_stream_v3 on a fresh thread, once with
+SPECULATIVE_LEAD_AGENT=0 (lead agent starts after the input guardrail allows the
+query) and once with SPECULATIVE_LEAD_AGENT=1 (lead agent starts in parallel and
+its events are buffered until the guardrail allows the query). Each mode runs in
+its own subprocess against a throwaway database. The last query is expected to
+be blocked, to check that the speculative run is cancelled and nothing leaks.
+
+This calls the real OpenAI and Tavily APIs, so .env must be set up.
+
+Usage:
+  uv run python benchmarks/speculative_ttft_benchmark.py --rounds 3
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+QUERIES = [
+    "請問0050這幾年報酬率大概多少?",
+    "最近台積電配息多少，有建議長期持有嗎?",
+    "定存現在利率多少，跟買債券ETF比起來如何？",
+    "請幫我寫一首關於貓咪的詩",  # off-topic, blocked by the guardrail
+]
+
+
+async def run_queries(rounds: int) -> list:
+    sys.path.insert(0, ROOT_DIR)
+    os.chdir(ROOT_DIR)
+
+    from dotenv import load_dotenv
+    load_dotenv(".env", override=True)
+
+    from migrate_agent_db import migrate_all
+    from agent_store import agent_store
+    from app.agent_controller import generate_agent_stream_v3
+
+    migrate_all()
+
+    results = []
+    for r in range(rounds):
+        for i, query in enumerate(QUERIES):
+            thread_id = f"bench_ttft_{r}_{i}_{int(time.time())}"
+            started = time.perf_counter()
+            first_frame = None
+            async for frame in generate_agent_stream_v3(query, thread_id):
+                if first_frame is None and '"content"' in frame:
+                    first_frame = time.perf_counter() - started
+            latency = time.perf_counter() - started
+
+            async with agent_store.connection(thread_id) as db:
+                async with db.execute(
+                    "SELECT metadata FROM agent_turns WHERE thread_id = ? ORDER BY id DESC LIMIT 1", (thread_id,)
+                ) as cursor:
+                    metadata = json.loads((await cursor.fetchone())[0])
+            blocked = "gg" in metadata.get("tags", [])
+
+            results.append({
+                "query": i,
+                "ttft": round(first_frame or latency, 3),
+                "latency": round(latency, 3),
+                "blocked": blocked,
+            })
+
+    await agent_store.close()
+    return results
+
+
+def print_report(mode: str, results: list):
+    print(f"\n=== SPECULATIVE_LEAD_AGENT={mode} ===")
+    print(f"{'query':>5} {'ttft p50(s)':>12} {'ttft max(s)':>12} {'latency p50(s)':>15} {'blocked':>8}")
+    for i in range(len(QUERIES)):
+        rows = [r for r in results if r["query"] == i]
+        ttfts = [r["ttft"] for r in rows]
+        latencies = [r["latency"] for r in rows]
+        print(f"{i:>5} {statistics.median(ttfts):>12.3f} {max(ttfts):>12.3f} {statistics.median(latencies):>15.3f} "
+              f"{str(any(r['blocked'] for r in rows)):>8}")
+
+    allowed = [r["ttft"] for r in results if not r["blocked"]]
+    if allowed:
+        print(f"median ttft of allowed queries: {statistics.median(allowed):.3f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare TTFT with the speculative lead agent on and off")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--child", choices=["0", "1"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(asyncio.run(run_queries(args.rounds))))
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ("0", "1"):
+            env = {
+                **os.environ,
+                "SPECULATIVE_LEAD_AGENT": mode,
+                "AGENT_DB_PATH": os.path.join(tmp, f"agent_speculative_{mode}.db"),
+                "AGENT_DB_SHARDS": "1",
+                "AGENT_DB_COMPACTION_INTERVAL": "0",
+            }
+            proc = subprocess.run(
+                [sys.executable, __file__, "--child", mode, "--rounds", str(args.rounds)],
+                env=env, capture_output=True, text=True, check=True
+            )
+            print_report(mode, json.loads(proc.stdout.strip().splitlines()[-1]))
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark: event-loop stall while counting tokens of a long conversation.
+
+A heartbeat task wakes up every 5 ms and records how late it was. While it runs
+we count the tokens of a ~200K-token history twice:
+
+  before: the old utils behaviour, tiktoken.encoding_for_model + encode for every
+          string, synchronously inside the event loop
+  after:  utils.anum_tokens_for_items (cached encoding, encode_ordinary_batch,
+          offloaded to the tokenizer thread pool)
+
+Usage:
+  uv run python benchmarks/tokenizer_event_loop_stall.py
+"""
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import tiktoken
+
+import utils
+
+HEARTBEAT_INTERVAL = 0.005
+
+
+def build_history(target_tokens: int = 200000) -> list:
+    """Synthetic conversation with user / tool output / assistant items"""
+    random.seed(42)
+    words = ["台積電", "配息", "ETF", "0050", "報酬率", "interest", "rate", "market", "dividend", "殖利率", "the", "of"]
+    items = []
+    tokens = 0
+    while tokens < target_tokens:
+        output = " ".join(random.choice(words) for _ in range(3000))
+        items.append({"role": "user", "content": "請問 0050 這幾年報酬率大概多少?"})
+        items.append({"type": "function_call", "call_id": "call_1", "name": "knowledge_search", "arguments": '{"query": "0050 報酬率"}'})
+        items.append({"type": "function_call_output", "call_id": "call_1", "output": output})
+        items.append({"role": "assistant", "type": "message", "content": [{"type": "output_text", "text": output[:2000], "annotations": []}]})
+        tokens += 4000
+    return items
+
+
+def old_num_tokens_for_items(items: list, model: str = "gpt-5") -> list:
+    """Token counting as utils.py did it before the tokenizer service"""
+    result = []
+    for item in items:
+        encoding = tiktoken.encoding_for_model(model)
+        num_tokens = 3
+        for key, value in item.items():
+            if key == "content" and isinstance(value, list):
+                for v2 in value:
+                    if "text" in v2:
+                        num_tokens += len(encoding.encode(str(v2["text"])))
+            elif key in ("content", "output", "arguments", "role", "action", "type"):
+                num_tokens += len(encoding.encode(str(value)))
+            num_tokens += 1
+        result.append(num_tokens)
+    return result
+
+
+async def heartbeat(lags: list, stop: asyncio.Event):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        lags.append((time.perf_counter() - started - HEARTBEAT_INTERVAL) * 1000)
+
+
+async def measure(name: str, work) -> None:
+    lags = []
+    stop = asyncio.Event()
+    hb = asyncio.create_task(heartbeat(lags, stop))
+    await asyncio.sleep(0.05)  # let the heartbeat settle
+
+    started = time.perf_counter()
+    total = await work()
+    elapsed = (time.perf_counter() - started) * 1000
+
+    await asyncio.sleep(0.05)
+    stop.set()
+    await hb
+
+    lags.sort()
+    p99 = lags[int(len(lags) * 0.99) - 1] if lags else 0
+    print(f"{name:<28} tokens={total:<8} wall={elapsed:8.1f} ms  "
+          f"max stall={max(lags):8.1f} ms  p99 stall={p99:6.1f} ms  mean stall={statistics.mean(lags):5.2f} ms")
+
+
+async def main():
+    items = build_history()
+    print(f"History: {len(items)} items\n")
+
+    async def before():
+        return sum(old_num_tokens_for_items(items))
+
+    async def after_cold():
+        return sum(await utils.anum_tokens_for_items(items))
+
+    async def after_warm():
+        # Same history again (next turn): every item hits the content-hash memo
+        return sum(await utils.anum_tokens_for_items(items))
+
+    await measure("before (sync, per call)", before)
+    await measure("after (async, cold memo)", after_cold)
+    await measure("after (async, warm memo)", after_warm)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
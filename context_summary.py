@@ -0,0 +1,114 @@
+import json
+import os
+
+import braintrust
+from agents import Runner
+
+from agent_core import agent_registry, split_into_turns, summary_item_hash
+from agent_store import agent_store
+from utils import anum_tokens_for_items
+
+# Summary-based context compaction 設定 (CONTEXT_COMPACTION_MODE=summary 時使用)
+SUMMARY_TRIGGER_TOKENS = int(os.getenv("SUMMARY_TRIGGER_TOKENS", "100000"))  # 對話超過此 tokens 數才產生 summary
+SUMMARY_KEEP_TOKENS = int(os.getenv("SUMMARY_KEEP_TOKENS", "30000"))  # 最近的 turns 保留原文的 token 數量
+SUMMARY_ITEM_MAX_CHARS = 4000  # 送進 summary agent 時，每個 item 最多保留的字數
+
+async def get_thread_summary(db, thread_id: str) -> dict | None:
+    """讀取 thread 目前的 rolling summary，沒有的話回傳 None"""
+    async with db.execute(
+        "SELECT summary, summary_turn_id, summary_item_count, summary_item_hash FROM agent_threads WHERE thread_id = ?",
+        (thread_id,)
+    ) as cursor:
+        row = await cursor.fetchone()
+
+    if not row or not row[0]:
+        return None
+
+    return {
+        "summary": row[0],
+        "turn_id": row[1],
+        "item_count": row[2],
+        "item_hash": row[3]
+    }
+
+async def save_thread_summary(db, thread_id: str, summary: str, turn_id: int, item_count: int, item_hash: str):
+    await db.execute("""
+        UPDATE agent_threads
+        SET summary = ?, summary_turn_id = ?, summary_item_count = ?, summary_item_hash = ?
+        WHERE thread_id = ?
+    """, (summary, turn_id, item_count, item_hash, thread_id))
+    await db.commit()
+
+def render_transcript(items: list) -> str:
+    """把 input items 轉成給 summary agent 閱讀的文字"""
+    lines = []
+    for item in items:
+        if item.get("type") == "function_call":
+            text = f"[tool call] {item.get('name')}({item.get('arguments')})"
+        elif item.get("type") == "function_call_output":
+            text = f"[tool result] {item.get('output')}"
+        elif item.get("type") == "reasoning":
+            continue
+        elif isinstance(item.get("content"), list):
+            text = f"[{item.get('role', 'assistant')}] " + "".join(
+                part.get("text", "") for part in item["content"] if isinstance(part, dict)
+            )
+        elif item.get("content"):
+            text = f"[{item.get('role')}] {item.get('content')}"
+        else:
+            continue
+
+        lines.append(text[:SUMMARY_ITEM_MAX_CHARS])
+
+    return "\n\n".join(lines)
+
+@braintrust.traced
+async def summarize_thread_history(thread_id: str) -> dict | None:
+    """
+    對話結束後在背景執行
+    如果 thread 的最新對話超過 SUMMARY_TRIGGER_TOKENS，就把最舊的 turns (包含之前的 summary) 濃縮成新的 rolling summary，
+    存到 agent_threads，下一輪 context_editing 會用它取代那些 turns
+    有產生新的 summary 時回傳它 (格式和 get_thread_summary 相同)，否則回傳 None
+    """
+    async with agent_store.connection(thread_id) as db:
+        async with db.execute(
+            "SELECT id, raw_items, raw_items_tokens FROM agent_turns WHERE thread_id = ? ORDER BY id DESC LIMIT 1",
+            (thread_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+
+    if not row or not row[1]:
+        return
+
+    turn_id = row[0]
+    items = [json.loads(item_str) for item_str in json.loads(row[1])]
+    item_tokens = json.loads(row[2]) if row[2] else []
+    if len(item_tokens) != len(items):
+        item_tokens = await anum_tokens_for_items(items)
+
+    total_tokens = sum(item_tokens)
+    if total_tokens <= SUMMARY_TRIGGER_TOKENS:
+        return
+
+    # 和 turn-based trimming 一樣從最舊的 turn 開始挑，只是被挑出來的 turns 會被濃縮而不是丟掉
+    turns = split_into_turns(items, item_tokens)
+    evicted_items = 0
+    while total_tokens > SUMMARY_KEEP_TOKENS and len(turns) > 1:  # 保留至少1個 turn
+        _, tokens, turn = turns.pop(0)
+        total_tokens -= tokens
+        evicted_items += len(turn)
+
+    if evicted_items == 0:
+        return
+
+    print(f"Summarizing {evicted_items} items of thread {thread_id}")
+
+    result = await Runner.run(agent_registry.get("summary"), input=render_transcript(items[:evicted_items]))
+    summary = result.final_output
+
+    item_hash = summary_item_hash(items[evicted_items - 1])
+    async with agent_store.connection(thread_id) as db:
+        await save_thread_summary(db, thread_id, summary, turn_id, evicted_items, item_hash)
+
+    print(f"Saved conversation summary for thread {thread_id}: {evicted_items} items -> {len(summary)} chars")
+    return { "summary": summary, "turn_id": turn_id, "item_count": evicted_items, "item_hash": item_hash }
@@ -0,0 +1,70 @@
+import json
+import os
+
+import braintrust
+
+from agent_core import extract_conversation_metadata, normalize_guardrail_query
+from agent_store import agent_store
+
+# Conversation metadata 設定
+# metadata (user sentiment / intent 等) 不在 request path 上抽取: 每輪結束後在背景更新，存在 agent_threads.metadata，下一輪直接讀取
+# 不需要每輪都更新，每 N 輪或話題改變時才重新抽取
+CONVERSATION_METADATA_REFRESH_TURNS = int(os.getenv("CONVERSATION_METADATA_REFRESH_TURNS", "5"))
+CONVERSATION_METADATA_TOPIC_SIMILARITY = 0.1  # 新問題和上次抽取時的問題 bigram 相似度 (Jaccard) 低於這個值視為換話題
+
+def topic_bigrams(query: str) -> set:
+    text = normalize_guardrail_query(query).replace(" ", "")
+    return { text[i:i + 2] for i in range(max(len(text) - 1, 1)) }
+
+def topic_changed(previous_query: str | None, query: str) -> bool:
+    if not previous_query:
+        return True
+    a, b = topic_bigrams(previous_query), topic_bigrams(query)
+    return len(a & b) / len(a | b) < CONVERSATION_METADATA_TOPIC_SIMILARITY if a | b else False
+
+async def get_thread_metadata(db, thread_id: str) -> dict | None:
+    """讀取 thread 目前的 metadata，還沒抽取過的話回傳 None"""
+    async with db.execute(
+        "SELECT metadata, metadata_turn_count, metadata_query FROM agent_threads WHERE thread_id = ?",
+        (thread_id,)
+    ) as cursor:
+        row = await cursor.fetchone()
+
+    if not row or not row[0]:
+        return None
+
+    return {
+        "metadata": json.loads(row[0]),
+        "turn_count": row[1] or 0,
+        "query": row[2]
+    }
+
+async def count_thread_turns(db, thread_id: str) -> int:
+    async with db.execute("SELECT COUNT(*) FROM agent_turns WHERE thread_id = ?", (thread_id,)) as cursor:
+        row = await cursor.fetchone()
+    return row[0]
+
+async def save_thread_metadata(db, thread_id: str, metadata: dict, turn_count: int, query: str):
+    await db.execute("""
+        UPDATE agent_threads
+        SET metadata = ?, metadata_turn_count = ?, metadata_query = ?
+        WHERE thread_id = ?
+    """, (json.dumps(metadata, ensure_ascii=False), turn_count, query, thread_id))
+    await db.commit()
+
+def needs_metadata_refresh(thread_metadata: dict | None, turn_count: int, query: str) -> bool:
+    if thread_metadata is None:
+        return True
+    if turn_count - thread_metadata["turn_count"] >= CONVERSATION_METADATA_REFRESH_TURNS:
+        return True
+    return topic_changed(thread_metadata["query"], query)
+
+@braintrust.traced
+async def refresh_conversation_metadata(thread_id: str, query: str, turn_count: int) -> dict:
+    """在背景抽取 metadata 並存回 agent_threads (turn 已經存好之後才呼叫)，回傳和 get_thread_metadata 相同格式的結果"""
+    metadata = await extract_conversation_metadata()
+
+    async with agent_store.connection(thread_id) as db:
+        await save_thread_metadata(db, thread_id, metadata, turn_count, query)
+    print(f"Updated conversation metadata of thread {thread_id} at turn {turn_count}")
+    return { "metadata": metadata, "turn_count": turn_count, "query": query }
@@ -1,7 +1,8 @@
 from agents import SQLiteSession, Agent
 from agents.items import TResponseInputItem
-from utils import num_tokens_for_agent_input_items, count_tokens
+from utils import num_tokens_for_agent_tools, anum_tokens_for_items, REPLY_PRIMING_TOKENS
 from pathlib import Path
+import json
 
 # Context Engineering 閾值設定
 TOOL_CALL_OUTPUT_TRIM_THRESHOLD = 150000  # 當 tokens 超過此值時，簡化 function_call_output
@@ -24,27 +25,50 @@ class CustomSQLiteSession(SQLiteSession):
         super().__init__(session_id, db_path, sessions_table, messages_table)
 
         self.agent = agent
+        self._item_tokens: dict[str, int] = {}  # item JSON 字串 -> token 數，每個 item 只算一次
+        self._tools_tokens: int | None = None  # agent tools schema 的 token 數，只算一次
+
+    async def _tokens_of(self, items: list) -> list[int]:
+        """回傳每個 item 的 token 數，只有沒算過的 items 才會 (批次) tokenize"""
+        keys = [json.dumps(item, sort_keys=True) for item in items]
+        missing = [(key, item) for key, item in zip(keys, items) if key not in self._item_tokens]
+        if missing:
+            counts = await anum_tokens_for_items([item for _, item in missing])
+            for (key, _), tokens in zip(missing, counts):
+                self._item_tokens[key] = tokens
+        return [self._item_tokens[key] for key in keys]
+
+    async def add_items(self, items: list[TResponseInputItem]) -> None:
+        # 寫入時就把 token 數算好，之後 get_items 只需要加總
+        await self._tokens_of(items)
+        await super().add_items(items)
 
     async def get_items(self, limit: int | None = None) -> list[TResponseInputItem]:
 
         # Call parent's get_items to get all items
         items = await super().get_items(limit=limit)
 
-        # 拿到 items 已經用了多少 tokens
-        used_tokens = await num_tokens_for_agent_input_items(self.agent, items)
+        if self._tools_tokens is None:
+            self._tools_tokens = await num_tokens_for_agent_tools(self.agent)
+
+        # 拿到 items 已經用了多少 tokens (每個 item 的 token 數是快取的，只有新的 items 需要 tokenize)
+        item_tokens = await self._tokens_of(items)
+        used_tokens = self._tools_tokens + REPLY_PRIMING_TOKENS + sum(item_tokens)
         print(f"num_tokens_for_agent_items: {used_tokens}")
 
         # Context Engineering 1: Tool call output trimming
         # 當 tokens 超過閾值時，簡化 function_call_output 內容
         if used_tokens > TOOL_CALL_OUTPUT_TRIM_THRESHOLD:
             print(f"Trigger tool call output filter: used_tokens={used_tokens}")
-            for item in items:
+            for i, item in enumerate(items):
                 if item.get("type") == "function_call_output":
                     print(" remove function_call_output! ")
                     item["output"] = "Tool results removed (context limit). Re-run the tool if needed."
+                    # 只更新被改到的 item，不用整段重新計算
+                    used_tokens -= item_tokens[i]
+                    item_tokens[i] = (await self._tokens_of([item]))[0]
+                    used_tokens += item_tokens[i]
 
-            # 重新計算 tokens
-            used_tokens = await num_tokens_for_agent_input_items(self.agent, items)
             print(f"After tool call filter: {used_tokens}")
 
         # Context Engineering 2: Turn-based trimming
@@ -52,33 +76,26 @@ class CustomSQLiteSession(SQLiteSession):
         if used_tokens > TURN_BASED_TRIM_THRESHOLD:
             print(f"Trigger turn-based message filter: used_tokens={used_tokens}")
 
-            # 按 user role 切分 turns
+            # 按 user role 切分 turns，每個 turn 是 (item, tokens) 的 list
             turns = []  # nested list
             current_turn = []
 
-            for item in items:
+            for item, tokens in zip(items, item_tokens):
                 if item.get("role") == "user" and current_turn:
                     # 遇到新的 user message，結束當前 turn
                     turns.append(current_turn)
-                    current_turn = [item]
+                    current_turn = [(item, tokens)]
                 else:
-                    current_turn.append(item)
+                    current_turn.append((item, tokens))
 
             # 添加最後一個 turn
             if current_turn:
                 turns.append(current_turn)
 
-            # 計算每個 turn 的 tokens 數量
+            # 每個 turn 的 tokens 數量直接加總已知的 item tokens
             turn_tokens = []
             for i, turn in enumerate(turns):
-                turn_content = ""
-                for item in turn:
-                    if item.get("content"):
-                        turn_content += str(item.get("content", ""))
-                    if item.get("output"):
-                        turn_content += str(item.get("output", ""))
-
-                tokens = count_tokens(turn_content)
+                tokens = sum(t for _, t in turn)
                 turn_tokens.append((i, tokens, turn))
 
             # 從最舊的 turn 開始移除，直到總 tokens 低於目標值
@@ -95,12 +112,11 @@ class CustomSQLiteSession(SQLiteSession):
             # 重建 items
             items = []
             for _, _, turn in turn_tokens:
-                items.extend(turn)
+                items.extend(item for item, _ in turn)
 
             print(f"Token management: removed {removed_turns} turns, remaining tokens: {total_tokens}")
 
-            # 重新計算 tokens
-            used_tokens = await num_tokens_for_agent_input_items(self.agent, items)
+            used_tokens = self._tools_tokens + REPLY_PRIMING_TOKENS + total_tokens
             print(f"After turn filter: {used_tokens}")
 
         return items
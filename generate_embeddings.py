@@ -27,8 +27,10 @@ import tiktoken
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from openai import AsyncOpenAI
 
+from http_clients import http_clients
+
 # Initialize OpenAI client
-async_client = AsyncOpenAI()
+async_client = AsyncOpenAI(http_client=http_clients.get("openai"))
 
 # Initialize tokenizer
 tokenizer = tiktoken.get_encoding("o200k_base")  # gpt-4o uses o200k_base
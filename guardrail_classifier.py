@@ -0,0 +1,198 @@
+"""
+Local fast-path input guardrail
+
+TF-IDF 字元 n-grams + logistic regression，用 input_guardrail_experiments_fixed.csv 訓練
+很有把握的 ALLOW / BLOCK 直接在本地決定，不確定的問題才交給 guardrail agent (LLM)
+
+資料切分和 eval_guardrail.ipynb 相同 (stratified，train 15% / dev 50% / test 35%，random_state=42):
+- thresholds 在 dev set 上校正，dev 的機率是 train + dev 的 out-of-fold 機率 (每個樣本的機率都來自沒看過它的 model)
+- 用 train + dev 訓練的 model 和校正好的 thresholds 在 test set 上回報準確率 / 覆蓋率，test 的 precision 沒達到目標就不啟用
+- 啟用時 production model 用全部標註資料訓練
+dev / test 任一類別的標註太少、校正不出 allow threshold (只能拒絕) 或 test 沒達標時，全部交給 guardrail agent
+
+Usage (回報不同目標 precision 下的準確率 / 覆蓋率 / 延遲):
+  uv run python guardrail_classifier.py
+"""
+import csv
+import functools
+import math
+import os
+import pathlib
+import time
+from collections import Counter
+from dataclasses import dataclass
+
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import StratifiedKFold, cross_val_predict, train_test_split
+from sklearn.pipeline import Pipeline, make_pipeline
+
+ROOT_DIR = pathlib.Path(__file__).parent.absolute()
+
+GUARDRAIL_DATASET_PATH = ROOT_DIR / "input_guardrail_experiments_fixed.csv"
+GUARDRAIL_LOCAL_TARGET_PRECISION = float(os.getenv("GUARDRAIL_LOCAL_TARGET_PRECISION", "0.95"))  # 本地判斷在 dev 校正、test 驗證時至少要有的 precision
+GUARDRAIL_LOCAL_MIN_SAMPLES_PER_CLASS = int(os.getenv("GUARDRAIL_LOCAL_MIN_SAMPLES_PER_CLASS", "10"))  # dev 和 test 的 ALLOW / BLOCK 各至少要有這麼多標註
+GUARDRAIL_LOCAL_CV_FOLDS = 5
+
+@dataclass
+class LocalGuardrail:
+    model: Pipeline
+    allow_threshold: float  # P(allow) >= 這個值才直接放行
+    block_threshold: float  # P(allow) <= 這個值才直接拒絕
+
+    def __post_init__(self):
+        # 把 tf-idf 權重和 logistic regression 係數攤平成 dict，單一問題直接計算，
+        # 不經過 sklearn pipeline (每次呼叫約 1ms 的固定開銷)
+        vectorizer, classifier = self.model[0], self.model[-1]
+        self._analyzer = vectorizer.build_analyzer()
+        coef = classifier.coef_[0]
+        self._features = { term: (vectorizer.idf_[i], coef[i]) for term, i in vectorizer.vocabulary_.items() }
+        self._intercept = classifier.intercept_[0]
+
+    def allow_probability(self, query: str) -> float:
+        """等同 model.predict_proba([query])[0][1] (sublinear tf、l2 normalize)"""
+        score = norm = 0.0
+        for term, count in Counter(self._analyzer(query)).items():
+            if term in self._features:
+                idf, coef = self._features[term]
+                weight = (1 + math.log(count)) * idf
+                score += weight * coef
+                norm += weight * weight
+        z = self._intercept + (score / math.sqrt(norm) if norm else 0.0)
+        return 1 / (1 + math.exp(-z))
+
+    def decide(self, query: str) -> bool | None:
+        """回傳 True (ALLOW) / False (BLOCK)，沒把握的時候回傳 None"""
+        p = self.allow_probability(query)
+        if p >= self.allow_threshold:
+            return True
+        if p <= self.block_threshold:
+            return False
+        return None
+
+def load_dataset() -> tuple[list, list]:
+    with open(GUARDRAIL_DATASET_PATH, newline="", encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    return [row["query"] for row in rows], [row["label"].upper() == "TRUE" for row in rows]
+
+def build_model() -> Pipeline:
+    # char_wb n-grams 不需要斷詞，中英混雜、錯字、大小寫變化都能處理
+    return make_pipeline(
+        TfidfVectorizer(analyzer="char_wb", ngram_range=(1, 2), sublinear_tf=True),
+        LogisticRegression(C=10, class_weight="balanced", max_iter=1000)
+    )
+
+def notebook_split(queries: list, labels: list) -> tuple[tuple, tuple, tuple]:
+    """和 eval_guardrail.ipynb 相同的 stratified split，回傳 (train, dev, test)，每個都是 (queries, labels)"""
+    train_queries, rest_queries, train_labels, rest_labels = train_test_split(
+        queries, labels, test_size=0.85, stratify=labels, random_state=42
+    )
+    dev_queries, test_queries, dev_labels, test_labels = train_test_split(
+        rest_queries, rest_labels, test_size=35 / 85, stratify=rest_labels, random_state=42
+    )
+    return (train_queries, train_labels), (dev_queries, dev_labels), (test_queries, test_labels)
+
+def dev_probabilities(train: tuple, dev: tuple) -> list:
+    """dev 樣本的 P(allow)，由 train + dev 的 k-fold 中沒有用它訓練的 fold model 算出，用來校正 thresholds"""
+    queries, labels = train[0] + dev[0], train[1] + dev[1]
+    folds = StratifiedKFold(n_splits=GUARDRAIL_LOCAL_CV_FOLDS, shuffle=True, random_state=42)
+    probabilities = cross_val_predict(build_model(), queries, labels, cv=folds, method="predict_proba")[:, 1]
+    return list(probabilities[len(train[0]):])
+
+def calibrate_thresholds(probabilities: list, labels: list, target_precision: float) -> tuple[float, float]:
+    """
+    從最有把握的一端往中間放寬 threshold，直到被決定的樣本 precision 低於 target_precision
+    完全沒辦法達到時 threshold 會落在 [0, 1] 之外，也就是永遠交給 LLM
+    """
+    pairs = sorted(zip(probabilities, labels), reverse=True)
+
+    allow_threshold, correct = 1.01, 0
+    for n, (p, label) in enumerate(pairs, start=1):
+        correct += label
+        if correct / n < target_precision:
+            break
+        allow_threshold = p
+
+    block_threshold, correct = -0.01, 0
+    for n, (p, label) in enumerate(reversed(pairs), start=1):
+        correct += not label
+        if correct / n < target_precision:
+            break
+        block_threshold = p
+
+    return allow_threshold, block_threshold
+
+def calibrate(target_precision: float = GUARDRAIL_LOCAL_TARGET_PRECISION) -> dict:
+    """在 dev 校正 thresholds，再用 train + dev 訓練的 model 在 test 上驗證"""
+    train, dev, test = notebook_split(*load_dataset())
+    allow_threshold, block_threshold = calibrate_thresholds(dev_probabilities(train, dev), dev[1], target_precision)
+    guardrail = LocalGuardrail(build_model().fit(train[0] + dev[0], train[1] + dev[1]), allow_threshold, block_threshold)
+    test_result = evaluate(guardrail, *test)
+    return {
+        "allow_threshold": allow_threshold,
+        "block_threshold": block_threshold,
+        "dev": evaluate(guardrail, *dev),
+        "test": test_result,
+        "problem": calibration_problem(dev[1], test[1], allow_threshold, test_result, target_precision)
+    }
+
+def calibration_problem(dev_labels: list, test_labels: list, allow_threshold: float, test_result: dict, target_precision: float) -> str | None:
+    """回傳不能啟用的原因，可以啟用時回傳 None"""
+    for name, labels in (("dev", dev_labels), ("test", test_labels)):
+        allow_count = sum(labels)
+        block_count = len(labels) - allow_count
+        if min(allow_count, block_count) < GUARDRAIL_LOCAL_MIN_SAMPLES_PER_CLASS:
+            return f"only {allow_count} ALLOW / {block_count} BLOCK labels in {name}, need {GUARDRAIL_LOCAL_MIN_SAMPLES_PER_CLASS} of each"
+    if allow_threshold > 1:
+        # 只會拒絕的 classifier 會把正常的第一個問題擋掉，沒有 LLM 可以補救
+        return "calibration found no allow threshold"
+    if test_result["accuracy"] is None or test_result["accuracy"] < target_precision:
+        return f"test precision {test_result['accuracy'] or 0:.1%} below target {target_precision:.0%}"
+    return None
+
+@functools.lru_cache(maxsize=None)
+def get_local_guardrail(target_precision: float = GUARDRAIL_LOCAL_TARGET_PRECISION) -> LocalGuardrail | None:
+    """校正並驗證本地 guardrail，沒通過時回傳 None (全部交給 guardrail agent)；通過時 model 用全部標註資料訓練"""
+    report = calibrate(target_precision)
+    if report["problem"] is not None:
+        print(f"Local guardrail disabled: {report['problem']}")
+        return None
+
+    queries, labels = load_dataset()
+    allow_threshold, block_threshold = report["allow_threshold"], report["block_threshold"]
+    print(f"Local guardrail ready: allow >= {allow_threshold:.3f}, block <= {block_threshold:.3f}, "
+          f"test coverage {report['test']['coverage']:.1%} accuracy {report['test']['accuracy']:.1%}")
+    return LocalGuardrail(build_model().fit(queries, labels), allow_threshold, block_threshold)
+
+def evaluate(guardrail: LocalGuardrail, queries: list, labels: list) -> dict:
+    decided = correct = 0
+    started = time.perf_counter()
+    for query, label in zip(queries, labels):
+        decision = guardrail.decide(query)
+        if decision is not None:
+            decided += 1
+            correct += decision == label
+    elapsed = time.perf_counter() - started
+
+    return {
+        "coverage": decided / len(queries),  # 本地就能決定的比例，其餘交給 LLM
+        "accuracy": correct / decided if decided else None,  # 本地決定的部分的準確率
+        "latency_us": elapsed / len(queries) * 1_000_000
+    }
+
+if __name__ == "__main__":
+    # thresholds 在 dev 上校正 (dev 的數字偏樂觀)，test 是沒參與校正的代表性數字
+    train, dev, test = notebook_split(*load_dataset())
+    for name, (_, labels) in (("train", train), ("dev", dev), ("test", test)):
+        print(f"{name}: {sum(labels)} ALLOW / {len(labels) - sum(labels)} BLOCK")
+    print(f"{'target':>7} {'allow>=':>8} {'block<=':>8} {'dev cov':>8} {'dev acc':>8} {'test cov':>9} {'test acc':>9} {'us/query':>9}  status")
+
+    def percent(value):
+        return f"{value:.1%}" if value is not None else "-"
+
+    for target_precision in (0.85, 0.9, 0.95, 1.0):
+        report = calibrate(target_precision)
+        print(f"{target_precision:>7} {report['allow_threshold']:>8.3f} {report['block_threshold']:>8.3f} "
+              f"{percent(report['dev']['coverage']):>8} {percent(report['dev']['accuracy']):>8} "
+              f"{percent(report['test']['coverage']):>9} {percent(report['test']['accuracy']):>9} "
+              f"{report['test']['latency_us']:>9.0f}  {report['problem'] or 'enabled'}")
@@ -0,0 +1,83 @@
+import importlib.util
+import os
+
+import httpx
+
+# 共用 HTTP client 設定
+# OpenAI / Tavily 的呼叫都走同一組 keep-alive connection pools，不用每次 tool call 都重新做 TCP + TLS handshake
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))  # 每個 client 最多同時幾條 connections
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))  # 閒置時保留幾條
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))  # 秒，閒置多久才關閉
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "120"))  # model streaming 可能很久才有下一個 chunk
+# 有安裝 h2 (pip install "httpx[http2]") 才能開 HTTP/2，一條 connection 可以同時跑多個 requests
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "1") == "1" and importlib.util.find_spec("h2") is not None
+
+class ConnectionStats:
+    """用 httpcore 的 trace extension 計算新建的 connections 和 TLS handshakes，其餘的 requests 都是重用既有 connection"""
+
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self.tls_handshakes = 0
+
+    async def on_request(self, request: httpx.Request):
+        request.extensions["trace"] = self.trace
+
+    async def on_response(self, response: httpx.Response):
+        # 只算有收到 response 的 requests，連線失敗的不算
+        self.requests += 1
+
+    async def trace(self, event_name: str, info: dict):
+        if event_name == "connection.connect_tcp.complete":
+            self.new_connections += 1
+        elif event_name == "connection.start_tls.complete":
+            self.tls_handshakes += 1
+
+    def snapshot(self) -> dict:
+        reused = max(self.requests - self.new_connections, 0)
+        return {
+            "requests": self.requests,
+            "new_connections": self.new_connections,
+            "tls_handshakes": self.tls_handshakes,
+            "reused_connections": reused,
+            "reuse_rate": round(reused / self.requests, 3) if self.requests else None
+        }
+
+class HTTPClientRegistry:
+    """每個上游服務一個 httpx.AsyncClient，第一次使用時建立，lifespan 結束時統一關閉"""
+
+    def __init__(self):
+        self.clients: dict[str, httpx.AsyncClient] = {}
+        self.stats: dict[str, ConnectionStats] = {}
+
+    def get(self, name: str, **kwargs) -> httpx.AsyncClient:
+        client = self.clients.get(name)
+        if client is None or client.is_closed:
+            stats = self.stats.setdefault(name, ConnectionStats())
+            client = httpx.AsyncClient(
+                http2=HTTP2_ENABLED,
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+                ),
+                timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+                event_hooks={ "request": [stats.on_request], "response": [stats.on_response] },
+                **kwargs
+            )
+            self.clients[name] = client
+        return client
+
+    def snapshot(self) -> dict:
+        return {
+            "http2": HTTP2_ENABLED,
+            **{ name: stats.snapshot() for name, stats in self.stats.items() }
+        }
+
+    async def aclose(self):
+        for client in self.clients.values():
+            await client.aclose()
+        self.clients.clear()
+
+http_clients = HTTPClientRegistry()
@@ -0,0 +1,10 @@
+from fastapi import Request, WebSocket
+
+# 使用者身分一律由 server 決定，不接受 client 在 query string / body 指定的 user_id
+# (否則任何人改一下參數就能讀取或寫入別人的 threads)
+# 還沒有登入機制，所有 requests 都是預設使用者；之後接上 session / token 驗證時只需要改 current_user_id
+DEFAULT_USER_ID = 1
+
+def current_user_id(connection: Request | WebSocket) -> int:
+    """目前 request (或 WebSocket 連線) 的使用者"""
+    return DEFAULT_USER_ID
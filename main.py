@@ -1,11 +1,55 @@
 from dotenv import load_dotenv
 load_dotenv(".env", override=True)
 
+import asyncio
+from contextlib import asynccontextmanager, suppress
 from fastapi import FastAPI
 from fastapi.responses import FileResponse
 from fastapi.staticfiles import StaticFiles
 
-app = FastAPI()
+from agent_store import agent_store
+from agent_db_compaction import AGENT_DB_COMPACTION_INTERVAL, compaction_loop
+from agent_core import agent_registry, wait_background_tasks, GUARDRAIL_LOCAL_CLASSIFIER
+from guardrail_classifier import get_local_guardrail
+from agent_runs import agent_runs
+from http_clients import http_clients
+from turn_writer import turn_writer
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 背景 compaction / retention，不會擋住 request path
+    compaction_task = None
+    if AGENT_DB_COMPACTION_INTERVAL > 0:
+        compaction_task = asyncio.create_task(compaction_loop(AGENT_DB_COMPACTION_INTERVAL))
+
+    # 啟動時建立 agents 和它們的 tool schemas，requests 之間共用
+    await agent_registry.build()
+
+    # 啟動時先訓練好本地 guardrail classifier，不要讓第一個 request 等
+    if GUARDRAIL_LOCAL_CLASSIFIER:
+        get_local_guardrail()
+
+    yield
+
+    if compaction_task:
+        compaction_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await compaction_task
+
+    # 中止還在跑的 agent runs，它們的 aborted turn 會在背景寫入
+    await agent_runs.cancel_all()
+
+    # 等背景工作 (例如 rolling summary) 寫完資料庫再關閉 connection pool
+    await wait_background_tasks()
+    await turn_writer.flush()
+
+    # 關閉每個 shard 的 connection pool
+    await agent_store.close()
+
+    # 關閉共用的 HTTP connection pools
+    await http_clients.aclose()
+
+app = FastAPI(lifespan=lifespan)
 
 # 掛載靜態文件目錄
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -18,6 +62,8 @@ async def read_root():
 # 引入 routers
 from app.agent_controller import router as agent_controller
 from app.test_controller import router as test_controller
+from app.thread_controller import router as thread_controller
 
 app.include_router(agent_controller)
-app.include_router(test_controller)        
\ No newline at end of file
+app.include_router(test_controller)
+app.include_router(thread_controller)
\ No newline at end of file
@@ -0,0 +1,126 @@
+import bisect
+import time
+from contextlib import contextmanager
+
+# Prometheus metrics (text exposition format，GET /metrics)
+# 不另外安裝 prometheus_client: 這裡只需要 counters / histograms，observe 只是 dict 查詢加一次 bisect，可以一直開著
+# 整個 process 在同一個 event loop 上更新，不需要 lock；多個 uvicorn workers 時每個 worker 各自一份 (由 Prometheus 分別 scrape)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)  # 秒
+
+def escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in labels.items()) + "}"
+
+def format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.type = "counter"
+        self.labelnames = tuple(labelnames)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.type = "histogram"
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.values: dict[tuple, list] = {}  # labels -> [每個 bucket 的次數 (最後一個是 +Inf), sum, count]
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """with histogram.time(stage="..."): 記錄區塊花了幾秒 (區塊內可以 await)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        for key, (counts, total, count) in self.values.items():
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                yield self.name + "_bucket", { **labels, "le": "+Inf" if bound == float("inf") else format_value(bound) }, cumulative
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, count
+
+class CallbackMetric:
+    """scrape 時才呼叫 collect() 讀值 (例如既有的 stats dicts、目前的 queue 長度)，request path 上沒有任何成本"""
+
+    def __init__(self, name: str, documentation: str, type: str, collect):
+        self.name = name
+        self.documentation = documentation
+        self.type = type  # counter / gauge
+        self.collect = collect  # () -> iterable of (labels dict, value)
+
+    def samples(self):
+        for labels, value in self.collect():
+            yield self.name, labels, value
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: dict[str, Counter | Histogram | CallbackMetric] = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name: str, documentation: str, type: str, collect) -> CallbackMetric:
+        return self.register(CallbackMetric(name, documentation, type, collect))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+# pipeline 各階段的延遲
+# stage: history_load / context_editing / guardrail / ttft / lead_agent / follow_up_questions / save_turn
+stage_seconds = metrics.histogram("agent_stage_seconds", "Latency of each agent pipeline stage in seconds", ("stage",))
+tool_call_seconds = metrics.histogram("agent_tool_call_seconds", "Latency of each function tool call in seconds", ("tool",))
+
+tokens_total = metrics.counter("agent_tokens_total", "Lead agent tokens by kind (input, cached_input, output, reasoning)", ("kind",))
+turns_total = metrics.counter("agent_turns_total", "Saved turns by outcome (ok, blocked, answer_cache, aborted, error)", ("status",))
+guardrail_decisions_total = metrics.counter("agent_guardrail_decisions_total", "Input guardrail decisions by source and verdict", ("source", "allow"))
+follow_up_questions_total = metrics.counter("agent_follow_up_questions_total", "Follow-up questions requests by source (cache, model, timeout, error)", ("source",))
+context_trim_total = metrics.counter("agent_context_trim_total", "Context editing triggers (summary, tool_output, turn_based)", ("trigger",))
@@ -1,29 +1,46 @@
 import sqlite3
 import os
 
-DB_PATH = "data/agent.db"
+from dotenv import load_dotenv
+load_dotenv(".env")  # 和 app 一樣從 .env 讀 AGENT_DB_SHARDS (要在 import agent_store 之前)；命令列上指定的環境變數優先
 
-def migrate():
+from agent_store import AGENT_DB_SHARDS, shard_path
+
+def add_column_if_missing(cursor, table: str, column: str, definition: str) -> bool:
+    """ALTER TABLE ADD COLUMN only when the column does not exist yet"""
+    columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table})").fetchall()]
+    if column in columns:
+        return False
+    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return True
+
+def migrate(db_path: str):
     """
-    Create agent_threads and agent_turns tables if they don't exist.
-    Only runs if data/agent.db doesn't exist yet.
+    Create agent_threads and agent_turns tables and indexes if they don't exist.
+    Every statement is idempotent, so it is safe to run again on an existing
+    database to pick up indexes added later.
     """
 
-    # Check if database already exists
-    if os.path.exists(DB_PATH):
-        print(f"Database {DB_PATH} already exists. Skipping migration.")
-        return
-
-    print(f"Creating database {DB_PATH}...")
+    if os.path.exists(db_path):
+        print(f"Database {db_path} already exists. Applying missing tables and indexes...")
+    else:
+        print(f"Creating database {db_path}...")
 
     # Ensure data directory exists
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
 
     # Create connection and tables
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
 
     try:
+        # Incremental auto_vacuum lets the compaction job return free pages in small steps.
+        # Switching an existing database to it needs one full VACUUM.
+        if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            print("Enabling incremental auto_vacuum (runs a one-time VACUUM)...")
+            cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            cursor.execute("VACUUM")
+
         # Create agent_threads table
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS agent_threads (
@@ -44,6 +61,32 @@ def migrate():
             ON agent_threads(user_id)
         """)
 
+        # Last activity of the thread, used by the retention job
+        if add_column_if_missing(cursor, "agent_threads", "updated_at", "TEXT"):
+            cursor.execute("UPDATE agent_threads SET updated_at = datetime('now') WHERE updated_at IS NULL")
+
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_agent_threads_updated_at
+            ON agent_threads(updated_at)
+        """)
+
+        # Rolling conversation summary (CONTEXT_COMPACTION_MODE=summary), see context_summary.py
+        add_column_if_missing(cursor, "agent_threads", "summary", "TEXT")
+        add_column_if_missing(cursor, "agent_threads", "summary_turn_id", "INTEGER")
+        add_column_if_missing(cursor, "agent_threads", "summary_item_count", "INTEGER")
+        add_column_if_missing(cursor, "agent_threads", "summary_item_hash", "TEXT")
+
+        # Conversation metadata extracted in the background, see conversation_metadata.py
+        add_column_if_missing(cursor, "agent_threads", "metadata", "TEXT")
+        add_column_if_missing(cursor, "agent_threads", "metadata_turn_count", "INTEGER")
+        add_column_if_missing(cursor, "agent_threads", "metadata_query", "TEXT")
+
+        # Keyset pagination of a user's threads: WHERE user_id = ? AND id < ? ORDER BY id DESC
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_agent_threads_user_id_id
+            ON agent_threads(user_id, id)
+        """)
+
         # Create agent_turns table
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS agent_turns (
@@ -57,6 +100,11 @@ def migrate():
             )
         """)
 
+        add_column_if_missing(cursor, "agent_turns", "created_at", "TEXT")
+
+        # JSON list of per-item token counts, aligned with raw_items, computed once when the turn is written
+        add_column_if_missing(cursor, "agent_turns", "raw_items_tokens", "TEXT")
+
         # Create indexes for agent_turns
         cursor.execute("""
             CREATE INDEX IF NOT EXISTS idx_agent_turns_thread_id
@@ -68,11 +116,17 @@ def migrate():
             ON agent_turns(user_id)
         """)
 
+        # Keyset pagination of a thread's turns, also serves "latest turn of a thread" lookups
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_agent_turns_thread_id_id
+            ON agent_turns(thread_id, id)
+        """)
+
         conn.commit()
         print("Migration completed successfully!")
-        print("Created tables:")
-        print("  - agent_threads (with indexes on thread_id, user_id)")
-        print("  - agent_turns (with indexes on thread_id, user_id)")
+        print("Tables:")
+        print("  - agent_threads (with indexes on thread_id, user_id, (user_id, id), updated_at)")
+        print("  - agent_turns (with indexes on thread_id, user_id, (thread_id, id))")
 
     except Exception as e:
         conn.rollback()
@@ -82,5 +136,10 @@ def migrate():
     finally:
         conn.close()
 
+def migrate_all(num_shards: int = AGENT_DB_SHARDS):
+    """Run migration on every shard (data/agent.db, data/agent_1.db, ...)"""
+    for shard in range(num_shards):
+        migrate(shard_path(shard))
+
 if __name__ == "__main__":
-    migrate()
+    migrate_all()
@@ -4,8 +4,10 @@ import aiosqlite
 import json
 from openai import AsyncOpenAI
 
+from http_clients import http_clients
+
 # Initialize OpenAI client
-async_client = AsyncOpenAI()
+async_client = AsyncOpenAI(http_client=http_clients.get("openai"))
 
 
 async def get_embeddings(text, embedding_model: str = "text-embedding-3-small"):
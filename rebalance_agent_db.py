@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Rebalance agent_threads / agent_turns when the number of shards changes.
+
+Usage:
+  python rebalance_agent_db.py --from-shards 1 --to-shards 4
+
+Run it while the app is stopped, then start the app with AGENT_DB_SHARDS set to
+the new shard count. Threads are routed with jump consistent hash, so growing
+from N to M shards only moves about (M - N) / M of the threads.
+
+Each thread is copied to its new shard first and then deleted from the old one.
+If the script is interrupted, simply run it again: a thread that was already
+copied is replaced in the target shard before being copied again.
+"""
+import argparse
+import os
+import sqlite3
+
+from dotenv import load_dotenv
+load_dotenv(".env")  # 和 app 一樣從 .env 讀 agent_store 的設定 (要在 import agent_store 之前)；命令列上指定的環境變數優先
+
+from agent_store import shard_path, shard_for_thread
+from migrate_agent_db import migrate
+
+TABLES = ["agent_threads", "agent_turns"]
+
+
+def table_columns(conn: sqlite3.Connection, table: str) -> list:
+    """Return column names of a table, except the autoincrement id"""
+    rows = conn.execute(f"PRAGMA table_info({table})").fetchall()
+    return [row[1] for row in rows if row[1] != "id"]
+
+
+def move_thread(source: sqlite3.Connection, target: sqlite3.Connection, thread_id: str) -> int:
+    """
+    Copy one thread from source shard to target shard, then delete it from source.
+
+    Returns:
+        Number of agent_turns rows moved
+    """
+    moved_turns = 0
+
+    with target:
+        for table in TABLES:
+            # Drop leftovers of an interrupted run, the source shard is authoritative
+            target.execute(f"DELETE FROM {table} WHERE thread_id = ?", (thread_id,))
+
+            columns = [c for c in table_columns(source, table) if c in table_columns(target, table)]
+            column_list = ", ".join(columns)
+            placeholders = ", ".join("?" for _ in columns)
+
+            # Keep the original id order so "ORDER BY id" still returns turns in sequence
+            rows = source.execute(
+                f"SELECT {column_list} FROM {table} WHERE thread_id = ? ORDER BY id",
+                (thread_id,)
+            ).fetchall()
+            target.executemany(
+                f"INSERT INTO {table} ({column_list}) VALUES ({placeholders})",
+                rows
+            )
+
+            if table == "agent_turns":
+                moved_turns = len(rows)
+
+    with source:
+        for table in TABLES:
+            source.execute(f"DELETE FROM {table} WHERE thread_id = ?", (thread_id,))
+
+    return moved_turns
+
+
+def rebalance(from_shards: int, to_shards: int):
+    print(f"Rebalancing agent db from {from_shards} to {to_shards} shards")
+
+    # Make sure every target shard has the schema
+    for shard in range(to_shards):
+        migrate(shard_path(shard))
+
+    connections = {}
+    for shard in range(max(from_shards, to_shards)):
+        if os.path.exists(shard_path(shard)):
+            connections[shard] = sqlite3.connect(shard_path(shard))
+
+    moved_threads = 0
+    moved_turns = 0
+
+    try:
+        for shard in range(from_shards):
+            source = connections.get(shard)
+            if source is None:
+                print(f"  Shard {shard} ({shard_path(shard)}) does not exist, skipping")
+                continue
+
+            thread_ids = [
+                row[0] for row in source.execute(
+                    "SELECT thread_id FROM agent_threads UNION SELECT thread_id FROM agent_turns"
+                ).fetchall()
+            ]
+
+            for thread_id in thread_ids:
+                target_shard = shard_for_thread(thread_id, to_shards)
+                if target_shard == shard:
+                    continue
+
+                moved_turns += move_thread(source, connections[target_shard], thread_id)
+                moved_threads += 1
+
+            print(f"  ✓ Shard {shard}: scanned {len(thread_ids)} threads")
+
+    finally:
+        for conn in connections.values():
+            conn.close()
+
+    print("\n" + "="*60)
+    print("Summary:")
+    print(f"  Threads moved: {moved_threads}")
+    print(f"  Turns moved: {moved_turns}")
+    if to_shards < from_shards:
+        print(f"  Shards {to_shards}..{from_shards - 1} are now empty and can be removed")
+    print(f"  Start the app with AGENT_DB_SHARDS={to_shards}")
+    print("="*60)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebalance agent db shards")
+    parser.add_argument("--from-shards", type=int, required=True, help="Current number of shards")
+    parser.add_argument("--to-shards", type=int, required=True, help="New number of shards")
+    args = parser.parse_args()
+
+    if args.from_shards < 1 or args.to_shards < 1:
+        parser.error("shard counts must be >= 1")
+
+    rebalance(args.from_shards, args.to_shards)
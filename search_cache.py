@@ -0,0 +1,115 @@
+import asyncio
+import json
+import os
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+
+# knowledge_search 結果快取設定
+# 很多使用者同時問同一個市場事件時，相同的搜尋只打一次 Tavily，同時進行的相同搜尋共用同一個 upstream call (singleflight)
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "1024"))  # 最多快取幾個搜尋結果，0 代表不快取 (仍然會合併同時進行的搜尋)
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "3600"))  # 秒，一般搜尋結果保留多久
+SEARCH_CACHE_FRESH_TTL = int(os.getenv("SEARCH_CACHE_FRESH_TTL", "300"))  # 秒，跟時間有關的搜尋 (股價、新聞、今天...) 只保留這麼久
+
+# 問題裡有這些字就視為需要新鮮資料
+TIME_SENSITIVE_PATTERN = re.compile(
+    r"今天|今日|昨天|本週|這週|最新|即時|現在|目前|股價|匯率|報價|新聞|盤中|收盤|開盤|"
+    r"today|yesterday|latest|now|current|price|news|\d{4}[-/]\d{1,2}[-/]\d{1,2}",
+    re.I
+)
+
+def normalize_search_query(query: str) -> str:
+    """全形半形、大小寫、空白不同的搜尋視為同一個搜尋"""
+    return " ".join(unicodedata.normalize("NFKC", query).casefold().split())
+
+class SearchCache:
+    """以正規化後的 query + 搜尋參數為 key 的 LRU cache，依內容的時效性決定 TTL"""
+
+    def __init__(self, max_size: int = SEARCH_CACHE_SIZE, ttl: int = SEARCH_CACHE_TTL, fresh_ttl: int = SEARCH_CACHE_FRESH_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.fresh_ttl = fresh_ttl
+        self.entries: OrderedDict = OrderedDict()  # key -> (expires_at, response, upstream latency ms)
+        self.inflight: dict[str, asyncio.Task] = {}
+        self.stats = {
+            "hits": 0,
+            "coalesced": 0,  # 等同一個進行中的 upstream call 的搜尋
+            "misses": 0,
+            "errors": 0,
+            "saved_upstream_ms": 0  # hits 和 coalesced 省下的 upstream 延遲 (以原本那次搜尋花的時間估計)
+        }
+
+    def key(self, query: str, params: dict) -> str:
+        return json.dumps([normalize_search_query(query), params], sort_keys=True, ensure_ascii=False)
+
+    def ttl_for(self, query: str, params: dict) -> int:
+        if params.get("topic") == "news" or params.get("time_range") == "day" or TIME_SENSITIVE_PATTERN.search(query):
+            return self.fresh_ttl
+        return self.ttl
+
+    async def search(self, query: str, fetch, **params) -> dict:
+        """
+        回傳快取的結果，沒有的話呼叫 fetch(query, **params)
+        同一個 key 已經有 upstream call 在進行時，直接等它的結果，不再另外呼叫
+        """
+        key = self.key(query, params)
+
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires_at, response, latency_ms = entry
+            if expires_at > time.monotonic():
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                self.stats["saved_upstream_ms"] += latency_ms
+                return response
+            del self.entries[key]
+
+        task = self.inflight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+            started = time.perf_counter()
+            # shield: 其中一個等待的 run 被取消，不會取消其他 runs 也在等的 upstream call
+            response = await asyncio.shield(task)
+            self.stats["saved_upstream_ms"] += max(self._latency_of(key) - round((time.perf_counter() - started) * 1000), 0)
+            return response
+
+        self.stats["misses"] += 1
+        task = asyncio.create_task(self._fetch(key, query, fetch, params))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())  # 所有等待者都被取消時，避免 exception never retrieved 警告
+        self.inflight[key] = task
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key: str, query: str, fetch, params: dict) -> dict:
+        started = time.perf_counter()
+        try:
+            response = await fetch(query, **params)
+        except Exception:
+            # 失敗的結果不快取，下一次搜尋會重新呼叫
+            self.stats["errors"] += 1
+            raise
+        finally:
+            self.inflight.pop(key, None)
+
+        latency_ms = round((time.perf_counter() - started) * 1000)
+        if self.max_size > 0:
+            self.entries[key] = (time.monotonic() + self.ttl_for(query, params), response, latency_ms)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return response
+
+    def _latency_of(self, key: str) -> int:
+        entry = self.entries.get(key)
+        return entry[2] if entry is not None else 0
+
+    def snapshot(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["coalesced"] + self.stats["misses"]
+        return {
+            "size": len(self.entries),
+            "inflight": len(self.inflight),
+            "hit_ratio": round((self.stats["hits"] + self.stats["coalesced"]) / lookups, 3) if lookups else None,
+            **self.stats
+        }
+
+search_cache = SearchCache()
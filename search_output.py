@@ -0,0 +1,102 @@
+import os
+import re
+import unicodedata
+
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from utils import acount_texts
+
+# knowledge_search tool output 設定
+# 搜尋結果的原始內容很長而且彼此重複，整包送給 model 會讓之後每一輪的 input tokens 都很大
+# 所以先去掉重複的段落、依相關性排序，再在 token budget 內組成附上來源編號的文字，完整的 response 仍然存在 search_source
+SEARCH_OUTPUT_MAX_TOKENS = int(os.getenv("SEARCH_OUTPUT_MAX_TOKENS", "1500"))  # 每次搜尋回給 model 的 token 上限
+SEARCH_OUTPUT_RANKING = os.getenv("SEARCH_OUTPUT_RANKING", "score")  # score: Tavily 的 relevance score，similarity: 本地 TF-IDF 和 query 的相似度
+SEARCH_OUTPUT_MIN_TOKENS = 50  # 剩下的 budget 不到這個數量就不再放下一個結果
+SEARCH_OUTPUT_DUPLICATE_THRESHOLD = 0.8  # 和已經放入的結果 (完整內容的) shingles 相似度 (Jaccard) 超過這個值就視為重複的結果
+
+_SENTENCE_BOUNDARY = re.compile(r"(?<=[。！？!?；;])|(?<=\.)\s+|\n+")
+
+def normalize_snippet(text: str) -> str:
+    return "".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+def split_snippets(text: str) -> list:
+    """切成句子，中文以全形標點、英文以句點加空白為界"""
+    return [snippet.strip() for snippet in _SENTENCE_BOUNDARY.split(text or "") if snippet and snippet.strip()]
+
+def shingles(text: str, n: int = 3) -> set:
+    text = normalize_snippet(text)
+    return { text[i:i + n] for i in range(max(len(text) - n + 1, 1)) }
+
+def jaccard(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if a or b else 0.0
+
+def rank_results(query: str, results: list) -> list:
+    if SEARCH_OUTPUT_RANKING == "similarity" and len(results) > 1:
+        # char n-grams 的 TF-IDF 向量已經 l2 normalize，內積就是 cosine similarity
+        matrix = TfidfVectorizer(analyzer="char_wb", ngram_range=(1, 2)).fit_transform(
+            [query] + [result.get("content", "") for result in results]
+        )
+        scores = (matrix[1:] @ matrix[0].T).toarray().ravel()
+    else:
+        scores = [result.get("score", 0) for result in results]
+    order = sorted(range(len(results)), key=lambda i: scores[i], reverse=True)
+    return [results[i] for i in order]
+
+async def pack_search_results(query: str, response: dict, max_tokens: int = SEARCH_OUTPUT_MAX_TOKENS) -> tuple[str, dict]:
+    """
+    把 Tavily response 組成給 model 的 tool output，回傳 (文字, 統計)
+    每個結果以 [n] title (url) 開頭，讓 model 可以引用來源
+    """
+    results = response.get("results", [])
+    seen_snippets = set()
+    kept_shingles = []
+    blocks = []
+    used_tokens = duplicates = 0
+
+    for result in rank_results(query, results):
+        content = result.get("content", "")
+        # 先用完整內容比對: 轉載、改寫過的相同文章整個跳過 (句子去重之後剩下的部分彼此就不像了，要在去重之前比)
+        result_shingles = shingles(content)
+        if any(jaccard(result_shingles, other) >= SEARCH_OUTPUT_DUPLICATE_THRESHOLD for other in kept_shingles):
+            duplicates += 1
+            continue
+
+        # 去掉前面的結果 (和同一個結果內) 已經出現過的句子
+        snippets, result_seen = [], set()
+        for snippet in split_snippets(content):
+            key = normalize_snippet(snippet)
+            if key not in seen_snippets and key not in result_seen:
+                snippets.append(snippet)
+                result_seen.add(key)
+        if not snippets:
+            duplicates += 1
+            continue
+
+        header = f"[{len(blocks) + 1}] {result.get('title', '').strip()} ({result.get('url', '')})"
+        header_tokens, *snippet_tokens = await acount_texts([header] + snippets)
+        remaining = max_tokens - used_tokens - header_tokens
+        if remaining < SEARCH_OUTPUT_MIN_TOKENS:
+            break
+
+        # 放得下多少句就放多少句，超過 budget 的部分截掉
+        taken = []
+        for snippet, tokens in zip(snippets, snippet_tokens):
+            if tokens > remaining:
+                break
+            taken.append(snippet)
+            remaining -= tokens
+        if not taken:
+            continue
+
+        seen_snippets.update(normalize_snippet(snippet) for snippet in taken)
+        kept_shingles.append(result_shingles)
+        blocks.append(header + "\n" + " ".join(taken))
+        used_tokens = max_tokens - remaining
+
+    stats = {
+        "results": len(results),
+        "kept": len(blocks),
+        "duplicates": duplicates,
+        "tokens": used_tokens
+    }
+    return "\n\n".join(blocks) if blocks else "No relevant results found.", stats
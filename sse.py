@@ -0,0 +1,111 @@
+import asyncio
+import json
+import os
+
+try:
+    import orjson
+except ImportError:  # orjson 在 pyproject.toml 的 dependencies 裡；沒有照 uv.lock 安裝的環境退回標準庫
+    orjson = None
+
+# SSE delta coalescing 設定
+# model 每吐一個 token 就有一個 response.output_text.delta，每個都編碼成一個 frame 的話，
+# 同時很多條 streams 時 CPU 和 socket writes 都會很可觀，所以把時間窗內連續的 content deltas 合併成一個 frame
+SSE_COALESCE_WINDOW_MS = int(os.getenv("SSE_COALESCE_WINDOW_MS", "15"))  # 0 代表不合併
+SSE_COALESCE_MAX_BYTES = int(os.getenv("SSE_COALESCE_MAX_BYTES", "512"))  # 累積超過這個大小就立刻送出
+
+_json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+def encode_json(event) -> bytes:
+    """把 event 編碼成 UTF-8 JSON；用 orjson，沒有安裝時退回標準庫 json (輸出相同的 compact JSON)"""
+    if orjson is not None:
+        return orjson.dumps(event)
+    return _json_encoder.encode(event).encode("utf-8")
+
+def sse_frame(data: bytes, event_id: str | None = None) -> bytes:
+    """組成一個 SSE frame，data 是已經編碼好的 JSON"""
+    if event_id is None:
+        return b"data: " + data + b"\n\n"
+    return b"id: " + event_id.encode("ascii") + b"\ndata: " + data + b"\n\n"
+
+def delta_text(event) -> tuple[str, str] | None:
+    """可以合併的 delta event 回傳 (種類, 文字): 回答的 content delta 或 THINK_DELTA，其他 events 回傳 None"""
+    if not isinstance(event, dict):
+        return None
+    if len(event) == 1 and isinstance(event.get("content"), str):
+        return "content", event["content"]
+    if len(event) == 2 and event.get("message") == "THINK_DELTA" and isinstance(event.get("text"), str):
+        return "think", event["text"]
+    return None
+
+def delta_event(kind: str, text: str) -> dict:
+    return { "content": text } if kind == "content" else { "message": "THINK_DELTA", "text": text }
+
+class DeltaCoalescer:
+    """
+    合併連續的同種 deltas (content 或 THINK_DELTA): 第一個 delta 進來後最多等 window_ms，或累積到 max_bytes 就交給 emit
+    其他 events (THINK_START、CALL_TOOL、DONE 等) 或不同種的 delta 會先把累積的文字送出，再交給 emit，所以順序不變
+    用 loop.call_later 計時，每個 delta 只是 append 到 list，不會為每個 token 建立 task
+    """
+
+    def __init__(self, emit, window_ms: int = SSE_COALESCE_WINDOW_MS, max_bytes: int = SSE_COALESCE_MAX_BYTES):
+        self.emit = emit
+        self.window = window_ms / 1000
+        self.max_bytes = max_bytes
+        self._pending = []
+        self._pending_kind = None
+        self._pending_bytes = 0
+        self._timer: asyncio.TimerHandle | None = None
+
+    def push(self, event):
+        delta = delta_text(event) if self.window > 0 else None
+        if delta is None:
+            self.flush()
+            self.emit(event)
+            return
+
+        kind, text = delta
+        if kind != self._pending_kind:
+            self.flush()
+        if not self._pending:
+            self._pending_kind = kind
+            self._timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+        self._pending.append(text)
+        self._pending_bytes += len(text.encode("utf-8"))
+        if self._pending_bytes >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._pending:
+            text = "".join(self._pending)
+            self._pending.clear()
+            self._pending_bytes = 0
+            self.emit(delta_event(self._pending_kind, text))
+        self._pending_kind = None
+
+_END = object()
+
+async def coalesce_deltas(events, window_ms: int = SSE_COALESCE_WINDOW_MS, max_bytes: int = SSE_COALESCE_MAX_BYTES):
+    """DeltaCoalescer 的 async generator 版本，給沒有 run buffer 的 streams 使用"""
+    queue = asyncio.Queue()
+    coalescer = DeltaCoalescer(queue.put_nowait, window_ms, max_bytes)
+
+    async def pump():
+        try:
+            async for event in events:
+                coalescer.push(event)
+        finally:
+            coalescer.flush()
+            queue.put_nowait(_END)
+
+    pump_task = asyncio.create_task(pump())
+    try:
+        while (event := await queue.get()) is not _END:
+            yield event
+        await pump_task  # 上游的 exception 在這裡拋出
+    finally:
+        if not pump_task.done():
+            pump_task.cancel()
+            await asyncio.gather(pump_task, return_exceptions=True)
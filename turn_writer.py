@@ -0,0 +1,94 @@
+import asyncio
+import os
+from collections import defaultdict
+
+from agent_core import save_agent_turn
+from agent_store import agent_store
+
+# 批次寫入設定 (batch endpoint 使用)
+# 很多 runs 同時完成時，每一輪各自開 transaction、各自 commit 會讓 SQLite 一直 fsync
+# 所以把同一段時間內完成的 turns 收集起來，每個 shard 用一個 transaction 一起寫入 (group commit)
+TURN_WRITER_BATCH_SIZE = int(os.getenv("TURN_WRITER_BATCH_SIZE", "50"))  # 累積這麼多 turns 就立刻寫入
+TURN_WRITER_INTERVAL = float(os.getenv("TURN_WRITER_INTERVAL", "0.2"))  # 秒，第一個 turn 進來後最多等這麼久就寫入
+
+class TurnWriter:
+    """
+    save() 把 turn 放進待寫入的清單，等它所在的那一批 commit 之後才返回，
+    所以呼叫者之後讀取歷史對話、在背景更新 metadata 都看得到這一輪
+    """
+
+    def __init__(self, batch_size: int = TURN_WRITER_BATCH_SIZE, interval: float = TURN_WRITER_INTERVAL):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pending = []  # (thread_id, save_agent_turn 的參數, future)
+        self.timer = None
+        self.flush_tasks = set()
+        self.stats = { "turns": 0, "flushes": 0, "transactions": 0, "errors": 0 }
+
+    async def save(self, thread_id: str, user_id: int, query: str, chunks_result: list, raw_items: list, metadata: dict, raw_items_tokens: list) -> int:
+        """回傳新的 agent_turns.id"""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((thread_id, (thread_id, user_id, query, chunks_result, raw_items, metadata, raw_items_tokens), future))
+
+        if len(self.pending) >= self.batch_size:
+            self._start_flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.interval, self._start_flush)
+
+        # shield: 呼叫者被取消時，這一輪仍然會跟著同一批寫入
+        return await asyncio.shield(future)
+
+    def _start_flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+
+        turns, self.pending = self.pending, []
+        task = asyncio.create_task(self._flush(turns))
+        self.flush_tasks.add(task)
+        task.add_done_callback(self.flush_tasks.discard)
+
+    async def _flush(self, turns: list):
+        by_shard = defaultdict(list)
+        for thread_id, args, future in turns:
+            by_shard[agent_store.shard_for(thread_id)].append((args, future))
+        turn_ids = {}
+
+        self.stats["flushes"] += 1
+        for shard, shard_turns in by_shard.items():
+            try:
+                async with agent_store.shard_connection(shard) as db:
+                    for args, future in shard_turns:
+                        turn_ids[future] = await save_agent_turn(db, *args, commit=False)
+                    await db.commit()
+            except Exception as e:
+                # 這個 shard 的 transaction 整批失敗，讓每個等待的呼叫者自己處理
+                print(f"Turn writer failed to write {len(shard_turns)} turns to shard {shard}: {e!r}")
+                self.stats["errors"] += 1
+                for _, future in shard_turns:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.stats["transactions"] += 1
+            self.stats["turns"] += len(shard_turns)
+            for _, future in shard_turns:
+                if not future.done():
+                    future.set_result(turn_ids[future])
+
+    async def flush(self):
+        """立刻寫入所有待寫入的 turns，並等進行中的寫入完成 (關閉前呼叫)"""
+        self._start_flush()
+        if self.flush_tasks:
+            await asyncio.gather(*self.flush_tasks, return_exceptions=True)
+
+    def snapshot(self) -> dict:
+        return {
+            "pending": len(self.pending),
+            "turns_per_transaction": round(self.stats["turns"] / self.stats["transactions"], 2) if self.stats["transactions"] else None,
+            **self.stats
+        }
+
+turn_writer = TurnWriter()
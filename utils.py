@@ -1,42 +1,140 @@
 # https://cookbook.openai.com/examples/how_to_count_tokens_with_tiktoken
+import asyncio
+import functools
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import tiktoken
 
-def num_tokens_from_messages(messages, model="gpt-5"):
-    encoding = tiktoken.encoding_for_model(model)
-
-    tokens_per_message = 3
-    tokens_per_name = 1
-
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            # print(f"  key: {key}, value: {value} type: {type(value)}")
-
-            if key == "content":
-                if isinstance(value, list):
-                    for v2 in value:
-                        for k3, v3 in v2.items():
-                            if k3 == "text":
-                                num_tokens += len(encoding.encode(str(v3)))
-                            elif k3 == 'annotations': # 內建的 web search
-                                for v4 in v3:
-                                    for k5, v5 in v4.items():
-                                        if k5 == "title" or k5 == "url":
-                                            num_tokens += len(encoding.encode(str(v5)))
-                else:
-                    num_tokens += len(encoding.encode(str(value)))
-            elif key in ("output", "arguments", "role", "action", "type"):
-                num_tokens += len(encoding.encode(str(value)))
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+REPLY_PRIMING_TOKENS = 3
+
+# Tokenizer service 設定
+TOKEN_MEMO_SIZE = 50000  # 最多快取幾段文字的 token 數
+TOKEN_MEMO_MIN_CHARS = 64  # 太短的文字直接 encode 比算 hash 還快，不放進 memo
+TOKENIZER_OFFLOAD_CHARS = 20000  # async API 遇到超過這個字數的工作就丟到 thread pool，避免卡住 event loop
+TOKENIZER_THREADS = int(os.getenv("TOKENIZER_THREADS", "4"))
+TOKENIZER_BATCH_MIN_TEXTS = 16  # encode_ordinary_batch 每次呼叫都會建立 thread pool，要 encode 的文字少於這個數量時逐段 encode 比較快
+
+_tokenizer_executor = ThreadPoolExecutor(max_workers=TOKENIZER_THREADS, thread_name_prefix="tokenizer")
+_token_memo: OrderedDict = OrderedDict()  # (model, content hash) -> token 數
+_token_memo_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str = "gpt-5"):
+    """tiktoken.encoding_for_model 會查表並建立物件，每個 model 只做一次"""
+    return tiktoken.encoding_for_model(model)
+
+def count_texts(texts: list, model: str = "gpt-5", offloaded: bool = False) -> list:
+    """
+    一次計算多段文字的 token 數
+    已經算過的文字從 memo 取 (以內容 hash 為 key)，其餘的逐段 encode
+    要 encode 的文字很多時才用 encode_ordinary_batch；offloaded=True (已經在 tokenizer thread pool 裡執行) 時不再另外開 threads
+    """
+    counts = [0] * len(texts)
+    missing = []  # (index, memo key)
+
+    with _token_memo_lock:
+        for i, text in enumerate(texts):
+            if len(text) < TOKEN_MEMO_MIN_CHARS:
+                missing.append((i, None))
+                continue
+            key = (model, hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest())
+            if key in _token_memo:
+                _token_memo.move_to_end(key)
+                counts[i] = _token_memo[key]
+            else:
+                missing.append((i, key))
+
+    if missing:
+        encoding = get_encoding(model)
+        missing_texts = [texts[i] for i, _ in missing]
+        if offloaded or len(missing_texts) < TOKENIZER_BATCH_MIN_TEXTS:
+            missing_counts = [len(encoding.encode_ordinary(text)) for text in missing_texts]
+        else:
+            missing_counts = [len(tokens) for tokens in encoding.encode_ordinary_batch(missing_texts, num_threads=TOKENIZER_THREADS)]
+
+        with _token_memo_lock:
+            for (i, key), tokens in zip(missing, missing_counts):
+                counts[i] = tokens
+                if key is not None:
+                    _token_memo[key] = counts[i]
+            while len(_token_memo) > TOKEN_MEMO_SIZE:
+                _token_memo.popitem(last=False)
+
+    return counts
+
+async def acount_texts(texts: list, model: str = "gpt-5") -> list:
+    """count_texts 的 async 版本，工作量大時在 thread pool 執行 (tiktoken encode 時會釋放 GIL)"""
+    if sum(len(text) for text in texts) < TOKENIZER_OFFLOAD_CHARS:
+        return count_texts(texts, model)
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_tokenizer_executor, count_texts, texts, model, True)
+
+def _item_texts(item) -> list:
+    """取出 input item 中需要計算 token 的文字"""
+    texts = []
+    for key, value in item.items():
+        # print(f"  key: {key}, value: {value} type: {type(value)}")
+
+        if key == "content":
+            if isinstance(value, list):
+                for v2 in value:
+                    for k3, v3 in v2.items():
+                        if k3 == "text":
+                            texts.append(str(v3))
+                        elif k3 == 'annotations': # 內建的 web search
+                            for v4 in v3:
+                                for k5, v5 in v4.items():
+                                    if k5 == "title" or k5 == "url":
+                                        texts.append(str(v5))
             else:
-                pass
+                texts.append(str(value))
+        elif key in ("output", "arguments", "role", "action", "type"):
+            texts.append(str(value))
+        else:
+            pass
+
+    return texts
+
+def _items_tokens_from_counts(items: list, items_texts: list, counts: list) -> list:
+    result = []
+    offset = 0
+    for item, texts in zip(items, items_texts):
+        num_tokens = TOKENS_PER_MESSAGE + TOKENS_PER_NAME * len(item) # for each key
+        num_tokens += sum(counts[offset:offset + len(texts)])
+        offset += len(texts)
+        result.append(num_tokens)
+    return result
+
+def num_tokens_for_items(items: list, model="gpt-5") -> list:
+    """Count tokens of each input item (without the reply priming tokens), encoded as one batch"""
+    items_texts = [_item_texts(item) for item in items]
+    counts = count_texts([t for texts in items_texts for t in texts], model)
+    return _items_tokens_from_counts(items, items_texts, counts)
+
+async def anum_tokens_for_items(items: list, model="gpt-5") -> list:
+    """Async version of num_tokens_for_items, large histories are tokenized in a thread pool"""
+    items_texts = [_item_texts(item) for item in items]
+    counts = await acount_texts([t for texts in items_texts for t in texts], model)
+    return _items_tokens_from_counts(items, items_texts, counts)
+
+def num_tokens_for_item(item, model="gpt-5"):
+    """Count tokens of a single input item, without the reply priming tokens"""
+    return num_tokens_for_items([item], model)[0]
 
-            num_tokens += tokens_per_name # for each key
+def num_tokens_from_messages(messages, model="gpt-5"):
+    return sum(num_tokens_for_items(messages, model)) + REPLY_PRIMING_TOKENS
 
-    num_tokens += 3
-    return num_tokens
+async def anum_tokens_from_messages(messages, model="gpt-5"):
+    return sum(await anum_tokens_for_items(messages, model)) + REPLY_PRIMING_TOKENS
 
-def num_tokens_for_tools(functions, messages, model="gpt-5"):
+def num_tokens_for_functions(functions, model="gpt-5"):
     # Set function settings
     func_init = 7
     prop_init = 3
@@ -45,9 +143,8 @@ def num_tokens_for_tools(functions, messages, model="gpt-5"):
     enum_item = 3
     func_end = 12
 
-    encoding = tiktoken.encoding_for_model(model)
-
     func_token_count = 0
+    lines = []  # 要 encode 的文字，最後一起 batch 計算
     if len(functions) > 0:
         for x in functions:
             if x["type"] != "function": # 不支援內建工具的計算
@@ -66,7 +163,7 @@ def num_tokens_for_tools(functions, messages, model="gpt-5"):
             if f_desc.endswith("."):
                 f_desc = f_desc[:-1]
             line = f_name + ":" + f_desc
-            func_token_count += len(encoding.encode(line))  # Add tokens for set name and description
+            lines.append(line)  # Add tokens for set name and description
             if len(function["parameters"]["properties"]) > 0:
                 func_token_count += prop_init  # Add tokens for start of each property
                 for key in list(function["parameters"]["properties"].keys()):
@@ -78,36 +175,62 @@ def num_tokens_for_tools(functions, messages, model="gpt-5"):
                         func_token_count += enum_init  # Add tokens if property has enum list
                         for item in function["parameters"]["properties"][key]["enum"]:
                             func_token_count += enum_item
-                            func_token_count += len(encoding.encode(item))
+                            lines.append(item)
                     if p_desc.endswith("."):
                         p_desc = p_desc[:-1]
                     line = f"{p_name}:{p_type}:{p_desc}"
-                    func_token_count += len(encoding.encode(line))
+                    lines.append(line)
         func_token_count += func_end
 
+    func_token_count += sum(count_texts(lines, model))
+
+    return func_token_count
+
+def num_tokens_for_tools(functions, messages, model="gpt-5"):
     messages_token_count = num_tokens_from_messages(messages, model)
-    total_tokens = messages_token_count + func_token_count
+    total_tokens = messages_token_count + num_tokens_for_functions(functions, model)
 
     return total_tokens
 
 from agents import RunContextWrapper
 from agents.models.openai_responses import Converter
 
-async def num_tokens_for_agent_input_items(agent, messages, model="gpt-5"):
+async def convert_agent_tools(agent) -> list:
+    """The agent's tools and handoffs converted to Responses API tool schemas"""
     ctx = RunContextWrapper(context=None)
     tools = await agent.get_all_tools(ctx)
 
-    converted = Converter.convert_tools(tools, agent.handoffs).tools
+    return Converter.convert_tools(tools, agent.handoffs).tools
+
+async def num_tokens_for_agent_tools(agent, model="gpt-5"):
+    """Token overhead of the agent's tool schemas, independent of the conversation"""
+    converted = await convert_agent_tools(agent)
 
     #print(f"converted: {converted}")
 
-    return num_tokens_for_tools(converted, messages)
+    return num_tokens_for_functions(converted, model)
+
+async def num_tokens_for_agent_input_items(agent, messages, model="gpt-5"):
+    return await num_tokens_for_agent_tools(agent, model) + await anum_tokens_from_messages(messages, model)
 
 def count_tokens(text: str, model: str = "gpt-5") -> int:
     """Count tokens in a text string using tiktoken encoding for the specified model."""
-    encoding = tiktoken.encoding_for_model(model)
-    tokens = encoding.encode(text)
-    return len(tokens)
+    return count_texts([text], model)[0]
+
+# USD per 1M tokens: (input, cached input, output)
+MODEL_PRICING = {
+    "gpt-5-mini": (0.25, 0.025, 2.00),
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+}
+
+def estimate_cost_usd(model: str, input_tokens: int, cached_tokens: int, output_tokens: int) -> float:
+    """Estimate the cost of one response, cached input tokens are billed at the discounted rate"""
+    if model not in MODEL_PRICING:
+        return 0.0
+    input_price, cached_price, output_price = MODEL_PRICING[model]
+    cost = (input_tokens - cached_tokens) * input_price + cached_tokens * cached_price + output_tokens * output_price
+    return round(cost / 1_000_000, 6)
 
 # Test real usage
 if __name__ == "__main__":  